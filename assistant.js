@@ -1,3 +1,13 @@
+// Longest edge sent to the vision model; larger drawings are downscaled before upload
+const MAX_UPLOAD_DIMENSION = 1568;
+
+// Binary stroke payload version, mirrored by backend/stroke_renderer.py
+const STROKE_FORMAT_VERSION = 1;
+const PEN_WIDTH = 3;
+
+// Pause in drawing after which the drawing is sent for speculative analysis (when enabled)
+const SPECULATION_IDLE_MS = 1500;
+
 class LabRatAssistant {
   constructor() {
     this.apiUrl = 'http://localhost:8000';
@@ -5,9 +15,103 @@ class LabRatAssistant {
     this.ctx = null;
     this.isDrawing = false;
     this.currentNotebook = null;
+    this.canvasEncoder = null;
+    this.encodeRequestId = 0;
+    this.sessionId = (crypto.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random().toString(16).slice(2)}`);
+    this.strokes = [];
+    this.currentStroke = null;
+    this.strokeEpoch = null;
+    this.strokesAcknowledged = 0; // Strokes the backend already holds for this session
+    this.speculationTimer = null;
+    this.speculatedStrokeCount = 0;
+    this.activeRequests = new Map(); // kind (or request id) -> { id, controller } for cancellable requests
+    this.injectedNotebooks = new Map(); // Snowflake tab id -> analysis id of the notebook injected there
+    this.clientId = this.loadClientId();
     this.init();
   }
 
+  loadClientId() {
+    // Stable per-install id so the backend can apply per-student rate limits
+    let clientId = localStorage.getItem('labratClientId');
+    if (!clientId) {
+      clientId = crypto.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+      localStorage.setItem('labratClientId', clientId);
+    }
+    return clientId;
+  }
+
+  newRequestId() {
+    return crypto.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+  }
+
+  beginRequest(kind = null) {
+    // One in-flight request per kind: clicking Analyze again cancels the analysis still running
+    if (kind && this.activeRequests.has(kind)) this.cancelRequest(kind, 'superseded');
+    const active = { id: this.newRequestId(), controller: new AbortController() };
+    this.activeRequests.set(kind || active.id, active);
+    return active;
+  }
+
+  endRequest(kind, active) {
+    const key = kind || active.id;
+    if (this.activeRequests.get(key) === active) this.activeRequests.delete(key);
+  }
+
+  cancelRequest(key, reason = 'client') {
+    const active = this.activeRequests.get(key);
+    if (!active) return;
+    this.activeRequests.delete(key);
+    // Aborting drops the connection; the beacon reaches the backend even if the connection drop is not noticed
+    this.sendCancelBeacon([active.id], reason);
+    active.controller.abort();
+  }
+
+  cancelAllRequests(reason) {
+    const active = Array.from(this.activeRequests.values());
+    if (active.length === 0) return;
+    this.activeRequests.clear();
+    this.sendCancelBeacon(active.map(request => request.id), reason);
+    active.forEach(request => request.controller.abort());
+  }
+
+  sendCancelBeacon(requestIds, reason) {
+    // text/plain keeps the beacon a simple request (no CORS preflight), which matters while the page unloads
+    const body = new Blob([JSON.stringify({ request_ids: requestIds, reason })], { type: 'text/plain' });
+    if (!navigator.sendBeacon || !navigator.sendBeacon(`${this.apiUrl}/api/cancel`, body)) {
+      fetch(`${this.apiUrl}/api/cancel`, { method: 'POST', body, keepalive: true }).catch(() => {});
+    }
+  }
+
+  apiHeaders(contentType = 'application/json') {
+    const headers = { 'X-LabRat-User': this.clientId };
+    if (contentType) headers['Content-Type'] = contentType;
+    // Set by the instructor's setup instructions; requests without it share the default class budget
+    const classId = localStorage.getItem('labratClassId');
+    if (classId) headers['X-LabRat-Class'] = classId;
+    return headers;
+  }
+
+  // Responses requested with X-LabRat-Cell-Refs send notebook cells that repeat a notebook_cells entry
+  // as {cell_ref: id} (backend/serialization.py); put the cells back
+  resolveCellRefs(value) {
+    if (Array.isArray(value)) {
+      value.forEach(item => this.resolveCellRefs(item));
+    } else if (value && typeof value === 'object') {
+      Object.values(value).forEach(item => this.resolveCellRefs(item));
+      if (value.notebook && Array.isArray(value.notebook.cells) && Array.isArray(value.notebook_cells)) {
+        const byId = new Map(value.notebook_cells.filter(cell => cell && cell.id).map(cell => [cell.id, cell]));
+        value.notebook.cells = value.notebook.cells.map(cell => (cell && cell.cell_ref) ? byId.get(cell.cell_ref) : cell);
+      }
+    }
+    return value;
+  }
+
+  async rateLimitError(response) {
+    const body = await response.json().catch(() => ({}));
+    const retryAfter = response.headers.get('Retry-After') || body.retry_after;
+    return `${body.error || 'Too many requests'}${retryAfter ? ` (retry in ${retryAfter}s)` : ''}`;
+  }
+
   init() {
     console.log('Initializing LabRat Assistant, document ready state:', document.readyState);
     
@@ -73,6 +177,19 @@ class LabRatAssistant {
     if (testInjectionBtn) testInjectionBtn.addEventListener('click', () => this.testInjection());
     if (clearCanvasBtn) clearCanvasBtn.addEventListener('click', () => this.clearCanvas());
 
+    // Opt-in: analyze in the background whenever the student pauses, so "Analyze" is usually instant
+    const speculateToggle = document.getElementById('speculate-toggle');
+    if (speculateToggle) {
+      speculateToggle.checked = localStorage.getItem('labratSpeculate') === '1';
+      speculateToggle.addEventListener('change', () => {
+        localStorage.setItem('labratSpeculate', speculateToggle.checked ? '1' : '0');
+        if (!speculateToggle.checked) this.cancelSpeculation();
+      });
+    }
+
+    // Closing the side panel cancels whatever the backend is still generating for it
+    window.addEventListener('pagehide', () => this.cancelAllRequests('panel_closed'));
+
     // Header injection controls
     const headerInsertBtn = document.getElementById('header-insert-snowflake');
     const headerTestBtn = document.getElementById('header-test-injection');
@@ -336,6 +453,7 @@ class LabRatAssistant {
   startDrawing(e) {
     console.log('🖊️  Starting to draw');
     this.isDrawing = true;
+    this.cancelSpeculation();
     
     // Get coordinates and start new path
     const rect = this.canvas.getBoundingClientRect();
@@ -355,6 +473,14 @@ class LabRatAssistant {
     // Start the line
     this.ctx.beginPath();
     this.ctx.moveTo(x, y);
+
+    // Record the stroke as vectors so it can be uploaded instead of a screenshot
+    this.currentStroke = { width: PEN_WIDTH, points: [[x, y, this.strokeTimestamp()]] };
+  }
+
+  strokeTimestamp() {
+    if (this.strokeEpoch === null) this.strokeEpoch = performance.now();
+    return Math.round(performance.now() - this.strokeEpoch);
   }
 
   draw(e) {
@@ -367,7 +493,7 @@ class LabRatAssistant {
     console.log('Drawing to:', x, y);
 
     // Set drawing properties every time (in case they get reset)
-    this.ctx.lineWidth = 3;
+    this.ctx.lineWidth = PEN_WIDTH;
     this.ctx.lineCap = 'round';
     this.ctx.lineJoin = 'round';
     this.ctx.strokeStyle = '#2c3e50'; // Dark blue-gray color for visibility
@@ -375,20 +501,80 @@ class LabRatAssistant {
 
     this.ctx.lineTo(x, y);
     this.ctx.stroke();
+
+    if (this.currentStroke) {
+      this.currentStroke.points.push([x, y, this.strokeTimestamp()]);
+    }
   }
 
   stopDrawing() {
     if (!this.isDrawing) return;
     console.log('Stopping drawing');
     this.isDrawing = false;
+    if (this.currentStroke) {
+      this.strokes.push(this.currentStroke);
+      this.currentStroke = null;
+      this.scheduleSpeculation();
+    }
     // Don't start a new path here - let startDrawing handle it
   }
 
+  speculationEnabled() {
+    return localStorage.getItem('labratSpeculate') === '1';
+  }
+
+  scheduleSpeculation() {
+    // Debounced: only a pause of SPECULATION_IDLE_MS without new strokes sends the drawing
+    this.cancelSpeculation();
+    if (!this.speculationEnabled()) return;
+    this.speculationTimer = setTimeout(() => {
+      this.speculationTimer = null;
+      this.speculate();
+    }, SPECULATION_IDLE_MS);
+  }
+
+  cancelSpeculation() {
+    if (this.speculationTimer) {
+      clearTimeout(this.speculationTimer);
+      this.speculationTimer = null;
+    }
+  }
+
+  async speculate() {
+    // Low-priority background analysis; the backend caches it under the same id the Analyze click will use
+    if (this.strokes.length === 0 || this.strokes.length === this.speculatedStrokeCount) return;
+    const strokeCount = this.strokes.length;
+    try {
+      const response = await fetch(`${this.apiUrl}/api/speculate`, {
+        method: 'POST',
+        headers: { ...this.apiHeaders(), 'X-LabRat-Route': this.sessionId },
+        body: JSON.stringify({
+          strokes: this.encodeStrokes(this.strokes),
+          session_id: this.sessionId,
+          vision_model: 'claude',
+          include_reasoning: true
+        })
+      });
+      const result = await response.json();
+      if (result.success) this.speculatedStrokeCount = strokeCount;
+      console.log(`Speculative analysis: ${result.status || result.error}`);
+    } catch (error) {
+      // Best effort only - the Analyze click still works without it
+      console.log('Speculative analysis request failed:', error.message);
+    }
+  }
+
   clearCanvas() {
     if (this.canvas && this.ctx) {
       // Reset canvas with white background (intentional clearing)
       this.resetCanvasWithBackground();
     }
+    this.strokes = [];
+    this.currentStroke = null;
+    this.strokeEpoch = null;
+    this.strokesAcknowledged = 0;
+    this.cancelSpeculation();
+    this.speculatedStrokeCount = 0;
   }
 
   isCanvasBlank() {
@@ -496,6 +682,51 @@ class LabRatAssistant {
     chatMessages.scrollTop = chatMessages.scrollHeight;
   }
 
+  async sha256Hex(buffer) {
+    const digest = await crypto.subtle.digest('SHA-256', buffer);
+    return Array.from(new Uint8Array(digest), (b) => b.toString(16).padStart(2, '0')).join('');
+  }
+
+  // Load balancers hash on X-LabRat-Route (backend/cache_backends.py) so the same drawing reaches the node
+  // whose cache is warm for it. Stroke updates follow their session, whose strokes live on one node.
+  async routeHeaders(data) {
+    if (data.strokes && data.session_id) return { 'X-LabRat-Route': data.session_id };
+    if (data.image) return { 'X-LabRat-Route': await this.sha256Hex(new TextEncoder().encode(data.image)) };
+    return {};
+  }
+
+  // Content-addressed upload: files the server already stores (e.g. re-analysing the same lab report)
+  // are referenced by hash instead of being sent again, and new ones go up as raw bytes, not base64 JSON.
+  async uploadFilesAsBlobs(files) {
+    const entries = await Promise.all(files.map(async (file) => {
+      const buffer = await file.arrayBuffer();
+      return { file, buffer, hash: await this.sha256Hex(buffer) };
+    }));
+
+    const response = await fetch(`${this.apiUrl}/api/blobs/missing`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ hashes: entries.map((entry) => entry.hash) })
+    });
+    const { missing = [] } = await response.json();
+    const missingSet = new Set(missing);
+    console.log(`${entries.length - missingSet.size} of ${entries.length} file(s) already on the server`);
+
+    await Promise.all(entries.filter((entry) => missingSet.has(entry.hash)).map(async (entry) => {
+      const upload = await fetch(`${this.apiUrl}/api/blobs`, {
+        method: 'POST',
+        headers: { 'Content-Type': entry.file.type || 'application/octet-stream' },
+        body: entry.buffer
+      });
+      const stored = await upload.json();
+      if (!upload.ok || stored.hash !== entry.hash) {
+        throw new Error(stored.error || `Upload of ${entry.file.name} failed`);
+      }
+    }));
+
+    return entries.map((entry) => ({ blob: entry.hash, type: entry.file.type, name: entry.file.name }));
+  }
+
   async fileToBase64(file) {
     console.log(`Converting file to base64: ${file.name} (${file.type})`);
     return new Promise((resolve, reject) => {
@@ -679,7 +910,7 @@ class LabRatAssistant {
     });
     
     document.getElementById('inject-all-btn').addEventListener('click', async () => {
-      await this.injectAllCellsToSnowflake(result.notebook_cells, result.text, tabId);
+      await this.injectAllCellsToSnowflake(result, tabId);
     });
   }
 
@@ -687,7 +918,7 @@ class LabRatAssistant {
     try {
       const response = await this.connectToContentScript(tabId, {
         type: 'INJECT_CODE',
-        code: cell.code,
+        code: cell.id ? this.cellRegion(cell) : cell.code,
         reasoning: reasoning
       });
       
@@ -704,20 +935,37 @@ class LabRatAssistant {
     }
   }
 
-  async injectAllCellsToSnowflake(cells, reasoning, tabId) {
+  // Injected cells start with a marker line so a later patch can find them in the Snowflake editors
+  cellRegion(cell) {
+    return `# %% labrat:${cell.id} ${cell.description || ''}\n${cell.code.replace(/\n+$/, '')}\n\n`;
+  }
+
+  async injectAllCellsToSnowflake(result, tabId) {
+    // A re-run only sends the cells that changed since the notebook already injected in this tab
+    const baseId = this.injectedNotebooks.get(tabId);
+    if (baseId && result.analysis_id && baseId !== result.analysis_id
+        && await this.patchSnowflakeNotebook(baseId, result.analysis_id, tabId)) {
+      return;
+    }
+    
+    // Notebook cells carry the ids patches refer to; plain notebook_cells are the fallback
+    const notebookCells = result.notebook ? result.notebook.cells.filter(cell => cell.cell_type === 'code') : [];
+    const cells = notebookCells.length ? notebookCells : result.notebook_cells;
     // Combine all cells into one code block
-    const combinedCode = cells.map((cell, index) => 
-      `# Cell ${index + 1}: ${cell.description}\n${cell.code}\n`
-    ).join('\n');
+    const combinedCode = cells.map((cell, index) => cell.id
+      ? this.cellRegion(cell)
+      : `# Cell ${index + 1}: ${cell.description}\n${cell.code}\n\n`
+    ).join('');
     
     try {
       const response = await this.connectToContentScript(tabId, {
         type: 'INJECT_CODE',
         code: combinedCode,
-        reasoning: reasoning
+        reasoning: result.text
       });
       
       if (response && response.success) {
+        if (result.analysis_id) this.injectedNotebooks.set(tabId, result.analysis_id);
         this.addMessageToChat(`All ${cells.length} cells injected into Snowflake successfully!`, 'bot');
       } else {
         throw new Error(response?.error || 'Injection failed');
@@ -730,6 +978,33 @@ class LabRatAssistant {
     }
   }
 
+  async patchSnowflakeNotebook(baseId, analysisId, tabId) {
+    try {
+      const response = await fetch(
+        `${this.apiUrl}/api/notebooks/${encodeURIComponent(analysisId)}/patch`,
+        { method: 'POST', headers: this.apiHeaders(), body: JSON.stringify({ base: baseId }) }
+      );
+      const data = await response.json();
+      if (!data.success) return false;
+      
+      const applied = await this.connectToContentScript(tabId, { type: 'APPLY_NOTEBOOK_PATCH', patch: data.patch });
+      if (!applied || !applied.success) {
+        console.log('Notebook patch not applied, re-injecting all cells:', applied && applied.error);
+        return false;
+      }
+      
+      this.injectedNotebooks.set(tabId, analysisId);
+      this.addMessageToChat(`Snowflake notebook updated: ${applied.applied} change(s), ${applied.unchanged} cell(s) unchanged.`, 'bot');
+      if (applied.conflicts.length) {
+        this.addMessageToChat(`${applied.conflicts.length} cell(s) you edited in Snowflake were left as they are.`, 'bot');
+      }
+      return true;
+    } catch (error) {
+      console.log('Notebook patch failed, re-injecting all cells:', error);
+      return false;
+    }
+  }
+
   async generateCodeTemplate() {
     try {
       const result = await this.sendToMultimodalAPI({
@@ -762,6 +1037,8 @@ class LabRatAssistant {
   }
 
   async sendToMultimodalAPI(data) {
+    const kind = data.type === 'drawing_analysis' ? 'drawing_analysis' : null;
+    const active = this.beginRequest(kind);
     try {
       console.log('Sending request to API:', {
         type: data.type,
@@ -774,24 +1051,52 @@ class LabRatAssistant {
       const response = await fetch(`${this.apiUrl}/api/labrat`, {
         method: 'POST',
         headers: {
-          'Content-Type': 'application/json',
+          ...this.apiHeaders(),
+          ...await this.routeHeaders(data),
+          'X-LabRat-Request': active.id,
+          'X-LabRat-Cell-Refs': '1'
         },
+        signal: active.controller.signal,
         body: JSON.stringify({
           type: data.type,
           input: data.context || data.prompt,
           image: data.image,
+          image_meta: data.image_meta,
+          strokes: data.strokes,
+          stroke_base: data.stroke_base,
+          session_id: data.session_id,
           vision_model: data.vision_model,
           include_reasoning: data.include_reasoning !== false,
           verbose: data.verbose !== false
         })
       });
 
+      if (response.status === 409) {
+        // Stroke session conflict - the body tells the caller how to resync
+        return await response.json();
+      }
+
+      if (response.status === 429 || response.status === 413) {
+        return { error: await this.rateLimitError(response), rate_limited: true };
+      }
+
+      if (response.status === 503) {
+        // Upstream model outage: the server answers fast instead of timing out
+        const outage = await response.json();
+        const retryAfter = response.headers.get('Retry-After') || outage.retry_after;
+        return { ...outage, error: `${outage.error || 'The model is temporarily unavailable'}${retryAfter ? ` - try again in ${retryAfter}s` : ''}` };
+      }
+
+      if (response.status === 499) {
+        return { error: 'Request cancelled', cancelled: true };
+      }
+
       if (!response.ok) {
         console.error('API Response not OK:', response.status, response.statusText);
         throw new Error(`HTTP error status: ${response.status}`);
       }
 
-      const result = await response.json();
+      const result = this.resolveCellRefs(await response.json());
       console.log('API Response received:', {
         success: result.success,
         hasText: !!result.text,
@@ -801,13 +1106,19 @@ class LabRatAssistant {
       return result;
 
     } catch (error) {
+      if (error.name === 'AbortError') {
+        return { error: 'Request cancelled', cancelled: true };
+      }
       console.error('API Error:', error);
       return { error: 'Processing failed: ' + error.message };
+    } finally {
+      this.endRequest(kind, active);
     }
   }
 
   async processDrawing() {
     
+    this.cancelSpeculation();
     if (!this.canvas) {
       console.error('Canvas not found');
       return;
@@ -816,31 +1127,60 @@ class LabRatAssistant {
     // Show processing indicator
     this.showProcessingIndicator("Analyzing drawing with vision model...");
 
-    const imageData = this.canvas.toDataURL('image/png');
-    console.log('Canvas image data captured:', imageData.substring(0, 100) + '...');
+    let encoded;
+    try {
+      encoded = await this.encodeCanvasForUpload();
+    } catch (error) {
+      console.log('Canvas encoder failed, falling back to full PNG:', error.message);
+      encoded = this.encodeCanvasAsPng();
+    }
     console.log('Canvas dimensions:', this.canvas.width, 'x', this.canvas.height);
+    console.log('Canvas is blank:', encoded.blank);
     
-    // Check if canvas is blank
-    const isBlank = this.isCanvasBlank();
-    console.log('Canvas is blank:', isBlank);
-    
-    if (isBlank) {
+    if (encoded.blank) {
       this.hideProcessingIndicator();
       this.showMessage('Please draw something on the canvas first!', 'error');
       return;
     }
     
+    const imageData = encoded.image;
+    console.log(`Canvas image encoded: ${encoded.format} ${encoded.width}x${encoded.height}, ${imageData.length} chars`);
+    
     try {
       const visionModel = 'claude';
       
-      const result = await this.sendToMultimodalAPI({
+      const requestData = {
         type: 'drawing_analysis',
-        image: imageData,
         timestamp: Date.now(),
         vision_model: visionModel,
         context: await this.getSnowflakeContext()
-      });
+      };
+      
+      // Prefer the vector strokes (orders of magnitude smaller); fall back to the encoded raster
+      let result = null;
+      if (this.strokes.length > 0) {
+        result = await this.analyzeStrokes(requestData);
+      }
+      if (!result) {
+        result = await this.sendToMultimodalAPI({
+          ...requestData,
+          image: imageData,
+          image_meta: {
+            format: encoded.format,
+            width: encoded.width,
+            height: encoded.height,
+            crop: encoded.crop,
+            scale: encoded.scale,
+            sourceSize: encoded.sourceSize
+          },
+          session_id: this.sessionId
+        });
+      }
 
+      if (result.cancelled) {
+        // Superseded by a newer Analyze click, which owns the processing indicator now
+        return;
+      }
       this.hideProcessingIndicator();
       
       if (result.success) {
@@ -870,6 +1210,123 @@ class LabRatAssistant {
     }
   }
 
+  encodeStrokes(strokes) {
+    // Compact binary stroke list: zig-zag varint deltas of half-pixel coordinates and millisecond timestamps
+    const bytes = [];
+    const writeVarint = (value) => {
+      while (value >= 0x80) {
+        bytes.push((value % 0x80) | 0x80);
+        value = Math.floor(value / 0x80);
+      }
+      bytes.push(value);
+    };
+    const writeSigned = (value) => writeVarint(value >= 0 ? value * 2 : -value * 2 - 1);
+
+    bytes.push(0x4c, 0x52, 0x53, STROKE_FORMAT_VERSION); // "LRS" + version
+    writeVarint(this.canvas.width);
+    writeVarint(this.canvas.height);
+    writeVarint(strokes.length);
+
+    let lastX = 0, lastY = 0, lastT = 0;
+    strokes.forEach(stroke => {
+      writeVarint(Math.round(stroke.width * 10));
+      writeVarint(stroke.points.length);
+      stroke.points.forEach(([x, y, t]) => {
+        const qx = Math.round(x * 2);
+        const qy = Math.round(y * 2);
+        writeSigned(qx - lastX);
+        writeSigned(qy - lastY);
+        writeSigned(t - lastT);
+        lastX = qx;
+        lastY = qy;
+        lastT = t;
+      });
+    });
+
+    const array = Uint8Array.from(bytes);
+    let binary = '';
+    for (let i = 0; i < array.length; i += 0x8000) {
+      binary += String.fromCharCode.apply(null, array.subarray(i, i + 0x8000));
+    }
+    return btoa(binary);
+  }
+
+  async analyzeStrokes(requestData) {
+    // Upload only the strokes added since the last analysis; resync with the full list if the backend lost them
+    for (let attempt = 0; attempt < 2; attempt++) {
+      const base = attempt === 0 ? this.strokesAcknowledged : 0;
+      const strokes = this.strokes.slice(base);
+      const result = await this.sendToMultimodalAPI({
+        ...requestData,
+        strokes: this.encodeStrokes(strokes),
+        stroke_base: base,
+        session_id: this.sessionId
+      });
+
+      if (result.resync) {
+        console.log('Stroke session out of sync, resending all strokes');
+        this.strokesAcknowledged = 0;
+        continue;
+      }
+      if (typeof result.stroke_count === 'number') {
+        this.strokesAcknowledged = result.stroke_count;
+      }
+      console.log(`Stroke upload: ${strokes.length} new strokes, ${result.payload_bytes || '?'} bytes`);
+      return result;
+    }
+    console.log('Could not synchronize strokes with the backend');
+    return null;
+  }
+
+  getCanvasEncoder() {
+    if (!this.canvasEncoder) {
+      this.canvasEncoder = new Worker('canvas-encoder.js');
+    }
+    return this.canvasEncoder;
+  }
+
+  encodeCanvasAsPng() {
+    // Legacy path: full-resolution PNG, resized and re-encoded by the backend
+    return {
+      blank: this.isCanvasBlank(),
+      image: this.canvas.toDataURL('image/png'),
+      format: 'png',
+      width: this.canvas.width,
+      height: this.canvas.height
+    };
+  }
+
+  async encodeCanvasForUpload() {
+    // Crop to the ink, downscale to the model's target size and encode WebP/JPEG in a Web Worker
+    if (!window.Worker || typeof OffscreenCanvas === 'undefined' || !window.createImageBitmap) {
+      return this.encodeCanvasAsPng();
+    }
+
+    const bitmap = await createImageBitmap(this.canvas);
+    const worker = this.getCanvasEncoder();
+    const requestId = ++this.encodeRequestId;
+
+    return new Promise((resolve, reject) => {
+      const onMessage = (event) => {
+        if (event.data.requestId !== requestId) return;
+        worker.removeEventListener('message', onMessage);
+        if (event.data.error) {
+          reject(new Error(event.data.error));
+        } else {
+          resolve(event.data);
+        }
+      };
+      worker.addEventListener('message', onMessage);
+      worker.postMessage({
+        requestId,
+        bitmap,
+        maxDimension: MAX_UPLOAD_DIMENSION,
+        mimeType: 'image/webp',
+        quality: 0.9
+      }, [bitmap]);
+    });
+  }
+
   showProcessingIndicator(message) {
     const resultsSection = document.getElementById('results-section');
     resultsSection.innerHTML = `
@@ -962,7 +1419,7 @@ class LabRatAssistant {
       const notebookResult = await response.json();
       
       if (notebookResult.success) {
-        this.displayNotebook(notebookResult.notebook);
+        this.displayNotebook(notebookResult.notebook, result.analysis_id);
         this.addMessageToChat(`Notebook "${notebookName}" created successfully!`, 'bot');
       } else {
         this.addMessageToChat(`Error creating notebook: ${notebookResult.error}`, 'bot');
@@ -983,7 +1440,7 @@ class LabRatAssistant {
     this.addMessageToChat(preview, 'bot');
   }
 
-  displayNotebook(notebook) {
+  displayNotebook(notebook, analysisId = null) {
     // Create a new section to show the notebook structure
     const resultsSection = document.getElementById('results-section');
     
@@ -997,14 +1454,52 @@ class LabRatAssistant {
           ${notebook.cells.map((cell, i) => this.renderNotebookCell(cell, i)).join('')}
         </div>
         <div style="margin-top: 20px;">
-          <button onclick="this.downloadNotebook('${notebook.name}')" style="background: #28a745; color: white; border: none; padding: 8px 16px; border-radius: 4px; cursor: pointer;">
-            Download Notebook
+          <button class="download-notebook-btn" data-format="ipynb" style="background: #28a745; color: white; border: none; padding: 8px 16px; border-radius: 4px; cursor: pointer; margin-right: 10px;">
+            Download .ipynb
+          </button>
+          <button class="download-notebook-btn" data-format="snowflake" style="background: #007acc; color: white; border: none; padding: 8px 16px; border-radius: 4px; cursor: pointer;">
+            Download for Snowflake
           </button>
         </div>
       </div>
     `;
     
     resultsSection.appendChild(notebookDisplay);
+    
+    notebookDisplay.querySelectorAll('.download-notebook-btn').forEach(btn => {
+      btn.addEventListener('click', () => this.downloadNotebook(notebook, analysisId, btn.dataset.format));
+    });
+  }
+
+  async downloadNotebook(notebook, analysisId, format) {
+    try {
+      // Stored notebooks are exported (and cached, with ETag revalidation) by the server; others are converted once
+      const response = analysisId
+        ? await fetch(`${this.apiUrl}/api/notebooks/${encodeURIComponent(analysisId)}/export?format=${format}`)
+        : await fetch(`${this.apiUrl}/api/create-notebook`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+              cells: notebook.cells.filter(cell => cell.cell_type === 'code'),
+              name: notebook.name,
+              format: format
+            })
+          });
+      if (!response.ok) {
+        const body = await response.json().catch(() => ({}));
+        throw new Error(body.error || `HTTP ${response.status}`);
+      }
+      
+      const url = URL.createObjectURL(await response.blob());
+      const link = document.createElement('a');
+      link.href = url;
+      link.download = `${notebook.name}${format === 'snowflake' ? '_snowflake' : ''}.ipynb`;
+      link.click();
+      setTimeout(() => URL.revokeObjectURL(url), 1000);
+    } catch (error) {
+      console.error('Notebook download error:', error);
+      this.addMessageToChat(`Error downloading notebook: ${error.message}`, 'bot');
+    }
   }
 
   renderNotebookCell(cell, index) {
@@ -1063,6 +1558,12 @@ class LabRatAssistant {
     }
   }
 
+  uploadQuestion() {
+    // Long documents are searched for the parts relevant to this question before anything goes to the model
+    const input = document.getElementById('upload-question');
+    return input && input.value.trim() ? input.value.trim() : null;
+  }
+
   async processUpload() {
     console.log('Starting upload process...');
     const fileInput = document.getElementById('file-input');
@@ -1081,34 +1582,30 @@ class LabRatAssistant {
       console.log(`File ${index + 1}: ${file.name} (${file.type}, ${file.size} bytes)`);
     });
 
-    console.log('Converting files to base64...');
-    const filePromises = Array.from(files).map(async (file, index) => {
-      console.log(`Converting file ${index + 1}: ${file.name}`);
-      const base64 = await this.fileToBase64(file);
-      console.log(`File ${index + 1} converted, base64 length: ${base64.length}`);
-      return {
-        data: base64,
-        type: file.type,
-        name: file.name
-      };
-    });
-
-    const fileData = await Promise.all(filePromises);
-    console.log('All files converted to base64, preparing upload request');
-
     try {
-      console.log(`Sending upload request to ${this.apiUrl}/api/upload`);
-      const response = await fetch(`${this.apiUrl}/api/upload`, {
+      console.log('Hashing files and uploading only content the server does not have yet...');
+      const fileData = await this.uploadFilesAsBlobs(Array.from(files));
+      console.log('All files stored on the server, preparing job submission');
+
+      console.log(`Submitting upload batch to ${this.apiUrl}/api/jobs`);
+      const response = await fetch(`${this.apiUrl}/api/jobs`, {
         method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({ files: fileData })
+        headers: this.apiHeaders(),
+        body: JSON.stringify({ files: fileData, lane: 'bulk', question: this.uploadQuestion() })
       });
 
-      console.log(`Upload response status: ${response.status}`);
-      const result = await response.json();
-      console.log('Upload response received:', result);
+      console.log(`Job submission response status: ${response.status}`);
+      if (response.status === 429 || response.status === 413) {
+        throw new Error(await this.rateLimitError(response));
+      }
+      const submission = await response.json();
+      if (!submission.success) {
+        throw new Error(submission.error || 'Job submission failed');
+      }
+
+      this.showMessage(`Processing ${submission.job_ids.length} file(s) in the background...`, 'info');
+      const result = await this.waitForJobBatch(submission.batch_id, submission.job_ids.length);
+      console.log('Upload batch finished:', result);
 
       if (result.success) {
         console.log(`Upload successful! Processing ${result.results.length} results`);
@@ -1145,6 +1642,38 @@ class LabRatAssistant {
     }
   }
 
+  async waitForJobBatch(batchId, jobCount, pollInterval = 1500) {
+    // Poll the job queue until every job in the batch has finished, then collect the results in order
+    const pageSize = 50;
+    while (true) {
+      const statusResponse = await fetch(`${this.apiUrl}/api/jobs?batch_id=${batchId}&page_size=1&status=queued`);
+      const queued = await statusResponse.json();
+      const runningResponse = await fetch(`${this.apiUrl}/api/jobs?batch_id=${batchId}&page_size=1&status=running`);
+      const running = await runningResponse.json();
+
+      const pending = (queued.total || 0) + (running.total || 0);
+      if (pending === 0) break;
+
+      console.log(`Upload batch ${batchId}: ${jobCount - pending}/${jobCount} done`);
+      await new Promise(resolve => setTimeout(resolve, pollInterval));
+    }
+
+    const results = [];
+    for (let page = 1; ; page++) {
+      const pageResponse = await fetch(`${this.apiUrl}/api/jobs?batch_id=${batchId}&page=${page}&page_size=${pageSize}&include_results=true`,
+        { headers: { 'X-LabRat-Cell-Refs': '1' } });
+      const jobPage = this.resolveCellRefs(await pageResponse.json());
+      jobPage.jobs.forEach(job => {
+        const jobResult = job.result || { error: job.error || `Job ${job.status}` };
+        jobResult.filename = jobResult.filename || job.filename;
+        results.push(jobResult);
+      });
+      if (page >= jobPage.pages) break;
+    }
+
+    return { success: true, results };
+  }
+
   displayResults(result) {
     const resultsSection = document.getElementById('results-section');
     const generatedCode = document.getElementById('generated-code');
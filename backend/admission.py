@@ -0,0 +1,322 @@
+"""Admission control in front of the model endpoints: rate limits, token budgets and fair scheduling.
+
+Every model request is charged against token buckets before it runs: requests and estimated tokens, each
+per user, per class and per client address. User and class come from headers the client chooses, so the
+address buckets cap what one address can spend (at a class's budget by default) however often those headers
+change. A request that would overdraw any of them is rejected immediately with the
+time until it would fit, which the server turns into a 429 with Retry-After. The estimate is prompt length
+plus image size plus the expected answer (see estimate_tokens).
+
+Admitted requests then wait for one of MAX_IN_FLIGHT model slots. Waiting requests are queued per class and
+slots are handed out round-robin across classes, so one busy class cannot starve another; a request that
+waits longer than QUEUE_TIMEOUT_SECONDS is rejected too.
+
+Buckets live in process memory. With several server processes, set LABRAT_ADMISSION_DB to a SQLite file
+so all processes draw from the same buckets (the slot scheduler stays per process). A bucket left alone
+long enough to refill is the same as a new one, so idle buckets are dropped.
+"""
+import base64
+import io
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+from PIL import Image
+
+from cancellation import current_token
+from job_queue import _Transaction
+
+USER_REQUESTS_PER_MINUTE = float(os.getenv('LABRAT_USER_RPM', '12'))
+USER_REQUEST_BURST = float(os.getenv('LABRAT_USER_BURST', '6'))
+USER_TOKENS_PER_MINUTE = float(os.getenv('LABRAT_USER_TPM', '40000'))
+CLASS_REQUESTS_PER_MINUTE = float(os.getenv('LABRAT_CLASS_RPM', '240'))
+CLASS_TOKENS_PER_MINUTE = float(os.getenv('LABRAT_CLASS_TPM', '800000'))
+# One client address: a classroom behind NAT, or a client rotating its user and class headers
+ADDRESS_REQUESTS_PER_MINUTE = float(os.getenv('LABRAT_ADDRESS_RPM', str(CLASS_REQUESTS_PER_MINUTE)))
+ADDRESS_TOKENS_PER_MINUTE = float(os.getenv('LABRAT_ADDRESS_TPM', str(CLASS_TOKENS_PER_MINUTE)))
+# Every bucket holds a minute's worth except the user request burst; after this long any bucket is full again
+IDLE_BUCKET_SECONDS = max(60.0, USER_REQUEST_BURST * 60 / USER_REQUESTS_PER_MINUTE)
+MAX_MEMORY_BUCKETS = int(os.getenv('LABRAT_ADMISSION_MAX_BUCKETS', '100000'))
+MAX_IN_FLIGHT = int(os.getenv('LABRAT_MAX_IN_FLIGHT', '8'))
+QUEUE_TIMEOUT_SECONDS = float(os.getenv('LABRAT_ADMISSION_QUEUE_TIMEOUT', '15'))
+ADMISSION_DB = os.getenv('LABRAT_ADMISSION_DB')
+
+# Claude bills roughly width * height / 750 tokens per image, after downscaling to 1568px on the long edge
+IMAGE_TOKEN_DIVISOR = 750
+MAX_IMAGE_TOKENS = 1600
+DEFAULT_OUTPUT_TOKENS = 1500
+
+class RateLimited(Exception):
+    """A request was not admitted; retry_after is in seconds"""
+
+    def __init__(self, message, retry_after, limit):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.limit = limit
+
+
+def image_tokens(image_base64):
+    """Estimated input tokens for an image, from its header (the pixels are not decoded)"""
+    if not image_base64:
+        return 0
+    if image_base64.startswith('data:'):
+        image_base64 = image_base64.split(',', 1)[1]
+    try:
+        with Image.open(io.BytesIO(base64.b64decode(image_base64))) as image:
+            width, height = image.size
+    except Exception:
+        # Unreadable images are rejected later; charge by size so they are not free
+        return min(MAX_IMAGE_TOKENS, len(image_base64) // 1000)
+    scale = min(1.0, 1568 / max(width, height, 1))
+    return min(MAX_IMAGE_TOKENS, int(width * scale * height * scale / IMAGE_TOKEN_DIVISOR))
+
+def estimate_tokens(prompt='', image_base64=None, file_bytes=0, output_tokens=DEFAULT_OUTPUT_TOKENS):
+    """Rough token cost of a model request: ~4 characters per prompt token, image area, file size, answer"""
+    return len(prompt or '') // 4 + image_tokens(image_base64) + file_bytes // 4 + output_tokens
+
+
+class MemoryBucketStore:
+    """Token buckets in process memory, least recently updated first"""
+
+    def __init__(self, max_buckets=MAX_MEMORY_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()  # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def take_all(self, charges):
+        """charges: [(key, rate_per_second, capacity, amount)]; all-or-nothing, returns (ok, retry_after, key)"""
+        with self._lock:
+            now = time.time()
+            self._evict(now)
+            levels = {}
+            for key, rate, capacity, amount in charges:
+                tokens, updated = self._buckets.get(key, (capacity, now))
+                levels[key] = min(capacity, tokens + (now - updated) * rate)
+            return _settle(charges, levels, now, self._save)
+
+    def _save(self, key, state):
+        self._buckets[key] = state
+        self._buckets.move_to_end(key)
+
+    def _evict(self, now):
+        """Drop buckets idle long enough to have refilled, then the oldest beyond max_buckets"""
+        cutoff = now - IDLE_BUCKET_SECONDS
+        while self._buckets:
+            key, (_, updated) = next(iter(self._buckets.items()))
+            if updated >= cutoff and len(self._buckets) <= self.max_buckets:
+                break
+            del self._buckets[key]
+
+    def levels(self, keys):
+        with self._lock:
+            return {key: self._buckets[key][0] for key in keys if key in self._buckets}
+
+
+class SqliteBucketStore:
+    """Token buckets in a SQLite file shared by several server processes"""
+
+    def __init__(self, path):
+        self.path = path
+        self._pruned_at = 0.0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return _Transaction(conn)
+
+    def take_all(self, charges):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            if now - self._pruned_at > IDLE_BUCKET_SECONDS:
+                conn.execute("DELETE FROM buckets WHERE updated < ?", (now - IDLE_BUCKET_SECONDS,))
+                self._pruned_at = now
+            levels = {}
+            for key, rate, capacity, amount in charges:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens, updated = row if row else (capacity, now)
+                levels[key] = min(capacity, tokens + (now - updated) * rate)
+
+            def save(key, state):
+                conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, state[0], state[1]))
+            return _settle(charges, levels, now, save)
+
+    def levels(self, keys):
+        with self._connect() as conn:
+            return {key: row[0] for key in keys
+                    for row in [conn.execute("SELECT tokens FROM buckets WHERE key = ?", (key,)).fetchone()] if row}
+
+
+def _settle(charges, levels, now, save):
+    """Debit every bucket if all can pay, otherwise debit none and report the longest wait"""
+    worst_wait, worst_key = 0.0, None
+    for key, rate, capacity, amount in charges:
+        if amount > capacity:
+            # Bigger than the bucket can ever hold: never admissible, tell the client plainly
+            return False, None, key
+        if levels[key] < amount:
+            wait = (amount - levels[key]) / rate
+            if wait > worst_wait:
+                worst_wait, worst_key = wait, key
+    if worst_key is not None:
+        for key, _, _, _ in charges:
+            save(key, (levels[key], now))
+        return False, worst_wait, worst_key
+    for key, _, _, amount in charges:
+        save(key, (levels[key] - amount, now))
+    return True, 0.0, None
+
+
+class FairScheduler:
+    """At most max_in_flight requests run at once; waiters are served round-robin across classes"""
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._queues = OrderedDict()  # class id -> deque of waiting events, in round-robin order
+        self._lock = threading.Lock()
+
+    def acquire(self, class_id, timeout=QUEUE_TIMEOUT_SECONDS):
+        with self._lock:
+            if self.in_flight < self.max_in_flight and not self._queues:
+                self.in_flight += 1
+                return 0.0
+            ready = threading.Event()
+            self._queues.setdefault(class_id, deque()).append(ready)
+
+        started = time.perf_counter()
+        token = current_token()
+        deadline = started + timeout
+        # Wait in short slices so a request cancelled while queued gives up its place
+        while not ready.wait(min(0.25, max(0.0, deadline - time.perf_counter()))):
+            if time.perf_counter() >= deadline or (token is not None and token.cancelled):
+                break
+        with self._lock:
+            # May have been granted just as we gave up
+            granted = ready.is_set()
+            if not granted:
+                queue = self._queues.get(class_id)
+                if queue is not None:
+                    queue.remove(ready)
+                    if not queue:
+                        del self._queues[class_id]
+        cancelled = token is not None and token.cancelled
+        if granted and not cancelled:
+            return time.perf_counter() - started
+        if granted:
+            self.release()
+        if cancelled:
+            token.stop('admission_queue')
+        raise RateLimited("The server is at capacity; please retry shortly", 2.0, "capacity")
+
+    def release(self):
+        with self._lock:
+            if not self._queues:
+                self.in_flight -= 1
+                return
+            # Hand the slot straight to the next class in rotation, which then goes to the back
+            class_id, queue = next(iter(self._queues.items()))
+            ready = queue.popleft()
+            del self._queues[class_id]
+            if queue:
+                self._queues[class_id] = queue
+            ready.set()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "waiting": {class_id: len(queue) for class_id, queue in self._queues.items()},
+            }
+
+
+class AdmissionController:
+    def __init__(self, store=None, scheduler=None):
+        self.store = store or (SqliteBucketStore(ADMISSION_DB) if ADMISSION_DB else MemoryBucketStore())
+        self.scheduler = scheduler or FairScheduler()
+        self.rejected = {}
+        self._lock = threading.Lock()
+
+    def _charges(self, user_id, class_id, tokens, requests=1, address=None):
+        charges = [
+            (f"user:{user_id}:requests", USER_REQUESTS_PER_MINUTE / 60, USER_REQUEST_BURST, requests),
+            (f"user:{user_id}:tokens", USER_TOKENS_PER_MINUTE / 60, USER_TOKENS_PER_MINUTE, tokens),
+            (f"class:{class_id}:requests", CLASS_REQUESTS_PER_MINUTE / 60, CLASS_REQUESTS_PER_MINUTE, requests),
+            (f"class:{class_id}:tokens", CLASS_TOKENS_PER_MINUTE / 60, CLASS_TOKENS_PER_MINUTE, tokens),
+        ]
+        if address:
+            charges += [
+                (f"addr:{address}:requests", ADDRESS_REQUESTS_PER_MINUTE / 60, ADDRESS_REQUESTS_PER_MINUTE, requests),
+                (f"addr:{address}:tokens", ADDRESS_TOKENS_PER_MINUTE / 60, ADDRESS_TOKENS_PER_MINUTE, tokens),
+            ]
+        return charges
+
+    def _reject(self, limit, message, retry_after):
+        with self._lock:
+            self.rejected[limit] = self.rejected.get(limit, 0) + 1
+        raise RateLimited(message, retry_after, limit)
+
+    def charge(self, user_id, class_id, tokens, requests=1, address=None):
+        """Debit the user's, class's and address's buckets or raise RateLimited"""
+        ok, retry_after, key = self.store.take_all(self._charges(user_id, class_id, tokens, requests, address))
+        if ok:
+            return
+        scope, _, kind = key.rpartition(':')
+        limit = f"{scope.split(':')[0]}_{kind}"
+        if retry_after is None:
+            self._reject(limit, f"Request too large: about {tokens} tokens exceeds the {limit.replace('_', ' ')} budget", None)
+        who = {"user": "your", "class": "your class's", "addr": "your network's"}[key.split(':', 1)[0]]
+        self._reject(limit, f"Rate limit reached for {who} {kind}; retry in {retry_after:.0f}s", retry_after)
+
+    def charge_job(self, user_id, class_id, tokens, address=None):
+        """Debit a queued job's tokens as it starts, waiting while the buckets refill. Its request was counted
+        when the batch was submitted. Raises RateLimited only when the job can never fit"""
+        token = current_token()
+        while True:
+            try:
+                return self.charge(user_id, class_id, tokens, requests=0, address=address)
+            except RateLimited as e:
+                if e.retry_after is None:
+                    raise
+                deadline = time.monotonic() + e.retry_after
+            # Wait in short slices so a cancelled job stops waiting
+            while time.monotonic() < deadline:
+                if token is not None and token.cancelled:
+                    token.stop('admission_budget')
+                time.sleep(min(0.25, max(0.0, deadline - time.monotonic())))
+
+    def remaining(self, user_id, class_id, address=None):
+        keys = [key for key, _, _, _ in self._charges(user_id, class_id, 0, address=address)]
+        levels = self.store.levels(keys)
+        return {key.split(':', 2)[0] + '_' + key.rsplit(':', 1)[1]: int(levels[key]) for key in keys if key in levels}
+
+    def admit(self, user_id, class_id, tokens, schedule=True, address=None):
+        """Charge the buckets, then (with schedule) wait for a model slot; returns a release callable"""
+        self.charge(user_id, class_id, tokens, address=address)
+        if not schedule:
+            return lambda: None
+        try:
+            self.scheduler.acquire(class_id)
+        except RateLimited as e:
+            self._reject(e.limit, str(e), e.retry_after)
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                self.scheduler.release()
+        return release
+
+    def snapshot(self):
+        with self._lock:
+            rejected = dict(self.rejected)
+        return {"scheduler": self.scheduler.snapshot(), "rejected": rejected, "shared_store": ADMISSION_DB}
+
+
+admission = AdmissionController()
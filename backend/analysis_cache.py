@@ -0,0 +1,57 @@
+import base64
+import hashlib
+import json
+import os
+import re
+
+from cache_backends import DiskBackend, open_cache, CACHE_TTL_SECONDS
+
+DATA_DIR = os.getenv('LABRAT_DATA_DIR', os.path.join(os.path.dirname(__file__), 'data'))
+CACHE_DIR = os.path.join(DATA_DIR, 'analysis_cache')
+NOTEBOOK_DIR = os.path.join(DATA_DIR, 'notebooks')
+
+# Analysis ids are SHA-256 hex digests (analysis_key); anything else must never reach a file path
+ANALYSIS_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# Local files unless LABRAT_CACHE_URL points every node at a shared backend (cache_backends.py).
+# Notebooks are not a pure cache: they are patched in place and must not silently fail to save.
+analyses = open_cache('analysis', DiskBackend(CACHE_DIR), ttl=CACHE_TTL_SECONDS)
+notebooks = open_cache('notebooks', DiskBackend(NOTEBOOK_DIR), required=True)
+
+def image_bytes_from_base64(image_base64):
+    """Decode a base64 image (with or without a data URL prefix) to raw bytes"""
+    if image_base64.startswith('data:'):
+        image_base64 = image_base64.split(',', 1)[1]
+    return base64.b64decode(image_base64)
+
+def analysis_key(image_base64, request_type="drawing_analysis", **options):
+    """Stable cache key for an image analysis: SHA-256 of the image bytes plus the options that change the answer"""
+    digest = hashlib.sha256()
+    digest.update(image_bytes_from_base64(image_base64))
+    digest.update(request_type.encode('utf-8'))
+    digest.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+def is_analysis_id(value):
+    return isinstance(value, str) and bool(ANALYSIS_ID_PATTERN.match(value))
+
+def get_cached_analysis(key):
+    """Return a previously stored analysis result, or None"""
+    return analyses.get(key)
+
+def store_analysis(key, result):
+    """Store a successful analysis result under its cache key"""
+    if result.get('success'):
+        analyses.set(key, result)
+
+def save_notebook(analysis_id, notebook):
+    """Persist a generated notebook so it can be fetched again without re-running the analysis"""
+    notebooks.set(analysis_id, notebook)
+
+def notebook_stamp(analysis_id):
+    """Changes whenever the notebook of an analysis is rewritten (exports key their cache on it); None if there is none"""
+    return notebooks.stamp(analysis_id)
+
+def load_notebook(analysis_id):
+    """Return the notebook stored for an analysis, or None"""
+    return notebooks.get(analysis_id)
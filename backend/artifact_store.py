@@ -0,0 +1,271 @@
+"""Content-addressed blob store for uploads, rendered drawings and notebooks.
+
+Blobs live under data/blobs/objects/<first two hex chars>/<sha256>, are written once and read through mmap.
+A small SQLite index tracks size, media type, last access and references: each owner (an analysis, a dataset,
+a client session) holds at most one reference per blob. A reference can expire (analyses hold theirs for as
+long as the analysis cache keeps them); expired references are released by gc(). Blobs without references stay
+around as a cache until they expire or the store goes over its quota, at which point the least recently used
+ones are deleted first.
+Derived results (text extracted from a document, ...) are stored as ordinary blobs and looked up by the hash
+of the blob they were computed from.
+"""
+import hashlib
+import logging
+import mmap
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+from analysis_cache import DATA_DIR
+from job_queue import _Transaction
+
+logger = logging.getLogger(__name__)
+
+BLOB_DIR = os.getenv('LABRAT_BLOB_DIR', os.path.join(DATA_DIR, 'blobs'))
+QUOTA_BYTES = int(float(os.getenv('LABRAT_BLOB_QUOTA_MB', '2048')) * 1024 * 1024)
+MAX_BLOB_BYTES = int(float(os.getenv('LABRAT_BLOB_MAX_MB', '50')) * 1024 * 1024)
+# Unreferenced blobs not read for this long are removed by gc()
+UNREFERENCED_TTL_SECONDS = float(os.getenv('LABRAT_BLOB_TTL_HOURS', '168')) * 3600
+# How long an analysis holds its uploaded blob; matches the analysis cache's default TTL
+ANALYSIS_REF_TTL_SECONDS = float(os.getenv('LABRAT_BLOB_REF_TTL_HOURS', '168')) * 3600
+
+HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    media_type TEXT,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS refs (
+    hash TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    expires_at REAL,
+    PRIMARY KEY (hash, owner)
+);
+CREATE TABLE IF NOT EXISTS derived (
+    source TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (source, kind)
+);
+CREATE INDEX IF NOT EXISTS idx_blobs_access ON blobs (last_access);
+CREATE INDEX IF NOT EXISTS idx_refs_owner ON refs (owner);
+"""
+
+
+class ArtifactQuotaError(Exception):
+    """The store cannot make room for a blob without deleting referenced data"""
+
+
+class ArtifactStore:
+    """SHA-256 addressed blobs with mmap reads, reference counting and a size quota"""
+
+    def __init__(self, root=BLOB_DIR, quota_bytes=QUOTA_BYTES, max_blob_bytes=MAX_BLOB_BYTES):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.quota_bytes = quota_bytes
+        self.max_blob_bytes = max_blob_bytes
+        self._gc_lock = threading.Lock()
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.db_path = os.path.join(root, 'index.db')
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(refs)")}
+            if "expires_at" not in columns:
+                conn.execute("ALTER TABLE refs ADD COLUMN expires_at REAL")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        return _Transaction(conn)
+
+    def path_for(self, blob_hash):
+        if not HASH_PATTERN.match(blob_hash or ''):
+            raise ValueError(f"Not a blob hash: {blob_hash}")
+        return os.path.join(self.objects_dir, blob_hash[:2], blob_hash)
+
+    def put(self, data, media_type=None, owner=None):
+        """Store bytes (a no-op if already present) and return their hash; optionally reference them for owner"""
+        if len(data) > self.max_blob_bytes:
+            raise ValueError(f"Blob of {len(data)} bytes exceeds the {self.max_blob_bytes} byte limit")
+        blob_hash = hashlib.sha256(data).hexdigest()
+        path = self.path_for(blob_hash)
+
+        if not os.path.exists(path):
+            self._make_room(len(data))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN")
+            conn.execute(
+                "INSERT INTO blobs (hash, size, media_type, created_at, last_access) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(hash) DO UPDATE SET last_access = excluded.last_access, "
+                "media_type = COALESCE(blobs.media_type, excluded.media_type)",
+                (blob_hash, len(data), media_type, now, now)
+            )
+            if owner:
+                conn.execute("INSERT OR IGNORE INTO refs (hash, owner, created_at) VALUES (?, ?, ?)", (blob_hash, owner, now))
+        return blob_hash
+
+    def info(self, blob_hash):
+        """Size, media type and reference count, or None if the blob is unknown"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT b.*, (SELECT COUNT(*) FROM refs r WHERE r.hash = b.hash) AS refcount FROM blobs b WHERE b.hash = ?",
+                (blob_hash,)
+            ).fetchone()
+        if row is None or not os.path.exists(self.path_for(blob_hash)):
+            return None
+        return {"hash": row["hash"], "size": row["size"], "media_type": row["media_type"], "refcount": row["refcount"]}
+
+    def missing(self, hashes):
+        """Which of the given hashes the store does not have - lets clients upload only new content"""
+        valid = [h for h in hashes if HASH_PATTERN.match(h or '')]
+        return [h for h in hashes if h not in valid or not os.path.exists(self.path_for(h))]
+
+    def open(self, blob_hash):
+        """Read-only mmap of a blob (close it, or use it as a context manager); KeyError if missing"""
+        try:
+            with open(self.path_for(blob_hash), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    view = b''
+                else:
+                    view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            raise KeyError(blob_hash)
+        self._touch(blob_hash)
+        return view if view else _EmptyView()
+
+    def read(self, blob_hash):
+        with self.open(blob_hash) as view:
+            return bytes(view)
+
+    def _touch(self, blob_hash):
+        with self._connect() as conn:
+            conn.execute("UPDATE blobs SET last_access = ? WHERE hash = ?", (time.time(), blob_hash))
+
+    def add_ref(self, blob_hash, owner, ttl=None):
+        """Reference a blob for owner; with ttl the reference lapses after that many seconds unless renewed"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO refs (hash, owner, created_at, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(hash, owner) DO UPDATE SET expires_at = CASE "
+                "WHEN refs.expires_at IS NULL OR excluded.expires_at IS NULL THEN NULL "
+                "ELSE MAX(refs.expires_at, excluded.expires_at) END",
+                (blob_hash, owner, now, now + ttl if ttl else None)
+            )
+
+    def drop_ref(self, blob_hash, owner):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM refs WHERE hash = ? AND owner = ?", (blob_hash, owner))
+
+    def drop_owner(self, owner):
+        """Release every reference an owner holds"""
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM refs WHERE owner = ?", (owner,)).rowcount
+
+    def put_derived(self, source_hash, kind, data, media_type=None):
+        """Store bytes computed from another blob (e.g. extracted text) so they can be looked up by the source hash"""
+        blob_hash = self.put(data, media_type)
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO derived (source, kind, hash) VALUES (?, ?, ?)", (source_hash, kind, blob_hash))
+        return blob_hash
+
+    def get_derived(self, source_hash, kind):
+        """Bytes previously stored with put_derived, or None (derived blobs are unreferenced and may be collected)"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT hash FROM derived WHERE source = ? AND kind = ?", (source_hash, kind)).fetchone()
+        if row is None:
+            return None
+        try:
+            return self.read(row["hash"])
+        except KeyError:
+            return None
+
+    def stats(self):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT COUNT(*) AS blobs, COALESCE(SUM(size), 0) AS bytes, "
+                "SUM(CASE WHEN hash IN (SELECT hash FROM refs) THEN 1 ELSE 0 END) AS referenced FROM blobs"
+            ).fetchone()
+        return {
+            "blobs": row["blobs"],
+            "bytes": row["bytes"],
+            "referenced": row["referenced"] or 0,
+            "quota_bytes": self.quota_bytes,
+        }
+
+    def gc(self, target_bytes=None, max_age=UNREFERENCED_TTL_SECONDS):
+        """Delete unreferenced blobs that expired, then least recently used ones until under target_bytes"""
+        with self._gc_lock:
+            now = time.time()
+            cutoff = now - max_age
+            with self._connect() as conn:
+                expired = conn.execute("DELETE FROM refs WHERE expires_at < ?", (now,)).rowcount
+                candidates = conn.execute(
+                    "SELECT hash, size, last_access FROM blobs WHERE hash NOT IN (SELECT hash FROM refs) ORDER BY last_access"
+                ).fetchall()
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+            doomed = []
+            for row in candidates:
+                if row["last_access"] < cutoff or (target_bytes is not None and total > target_bytes):
+                    doomed.append(row["hash"])
+                    total -= row["size"]
+
+            for blob_hash in doomed:
+                with self._connect() as conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    # A reference may have been taken since the candidates were listed
+                    if conn.execute("SELECT 1 FROM refs WHERE hash = ?", (blob_hash,)).fetchone():
+                        continue
+                    conn.execute("DELETE FROM blobs WHERE hash = ?", (blob_hash,))
+                    conn.execute("DELETE FROM derived WHERE hash = ?", (blob_hash,))
+                    try:
+                        os.remove(self.path_for(blob_hash))
+                    except FileNotFoundError:
+                        pass
+            if doomed:
+                logger.info(f"Artifact store removed {len(doomed)} unreferenced blobs")
+            return {"removed": len(doomed), "expired_refs": expired, "bytes": total}
+
+    def _make_room(self, incoming):
+        if self.stats()["bytes"] + incoming <= self.quota_bytes:
+            return
+        remaining = self.gc(target_bytes=self.quota_bytes - incoming)["bytes"]
+        if remaining + incoming > self.quota_bytes:
+            raise ArtifactQuotaError(f"Blob store is full ({remaining} of {self.quota_bytes} bytes are referenced)")
+
+
+class _EmptyView(bytes):
+    """Stand-in for mmap on empty files, which cannot be mapped"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def close(self):
+        pass
+
+
+artifact_store = ArtifactStore()
@@ -0,0 +1,111 @@
+"""Throughput of document extraction per format on large generated documents.
+
+Builds a long DOCX (headings, paragraphs, tables and OMML equations), a multi-page PDF and a text file, then
+reports MB/s and blocks/s for each extractor, the old python-docx paragraph loop for comparison, and the
+cost of a cache hit in the artifact store.
+
+    python benchmarks/bench_document_extract.py --sections 500 --pages 100
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docx import Document
+from docx.oxml import parse_xml
+
+from artifact_store import ArtifactStore
+from cache_backends import Cache
+from document_extract import extract_document, extract_document_cached, DerivedBlobBackend, CACHE_KIND
+
+EQUATION = (
+    '<m:oMathPara xmlns:m="http://schemas.openxmlformats.org/officeDocument/2006/math"><m:oMath>'
+    '<m:r><m:t>T=2π</m:t></m:r><m:rad><m:radPr><m:degHide m:val="1"/></m:radPr><m:deg/><m:e>'
+    '<m:f><m:num><m:r><m:t>L</m:t></m:r></m:num><m:den><m:r><m:t>g</m:t></m:r></m:den></m:f>'
+    '</m:e></m:rad></m:oMath></m:oMathPara>'
+)
+SENTENCE = "Release the pendulum from a small angle and time ten full oscillations before averaging. "
+
+def make_docx(sections):
+    doc = Document()
+    for section in range(sections):
+        doc.add_heading(f"Experiment {section + 1}", level=1)
+        for _ in range(4):
+            doc.add_paragraph(SENTENCE * 4)
+        doc.add_paragraph()._p.append(parse_xml(EQUATION))
+        table = doc.add_table(rows=6, cols=3)
+        for row in range(6):
+            for col in range(3):
+                table.cell(row, col).text = f"{row * 0.1 + col:.2f}"
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+def make_pdf(pages):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    buffer = io.BytesIO()
+    with PdfPages(buffer) as pdf:
+        for page in range(pages):
+            figure = plt.figure(figsize=(8.5, 11))
+            for line in range(45):
+                figure.text(0.05, 0.96 - line * 0.021, f"{page}.{line} {SENTENCE}", fontsize=8)
+            pdf.savefig(figure)
+            plt.close(figure)
+    return buffer.getvalue()
+
+def make_text(sections):
+    return "\n\n".join(f"# Experiment {i + 1}\n\n" + (SENTENCE * 4 + "\n\n") * 4 + "$$ T = 2\\pi\\sqrt{L/g} $$"
+                       for i in range(sections)).encode("utf-8")
+
+def legacy_docx(data):
+    text_content = ""
+    for paragraph in Document(io.BytesIO(data)).paragraphs:
+        text_content += paragraph.text + "\n"
+    return text_content
+
+def timed(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def report(label, size, seconds, blocks=None):
+    line = f"{label:<24} {size / 1e6:>7.2f} MB  {seconds * 1000:>9.1f} ms  {size / 1e6 / seconds:>8.2f} MB/s"
+    if blocks is not None:
+        line += f"  {blocks / seconds:>10.0f} blocks/s"
+    print(line)
+
+def run(sections, pages, repeat):
+    documents = {"docx": make_docx(sections), "pdf": make_pdf(pages), "txt": make_text(sections)}
+
+    for fmt, data in documents.items():
+        seconds, extraction = timed(lambda: extract_document(data, fmt), repeat)
+        report(fmt, len(data), seconds, extraction["stats"]["blocks"])
+
+    seconds, _ = timed(lambda: legacy_docx(documents["docx"]), repeat)
+    report("docx (python-docx loop)", len(documents["docx"]), seconds)
+
+    store = ArtifactStore(tempfile.mkdtemp(prefix="labrat-bench-"))
+    cache = Cache("documents", DerivedBlobBackend(store, CACHE_KIND))
+    extract_document_cached(documents["docx"], "docx", cache)
+    seconds, extraction = timed(lambda: extract_document_cached(documents["docx"], "docx", cache), repeat)
+    assert extraction["cached"]
+    report("docx (cache hit)", len(documents["docx"]), seconds, extraction["stats"]["blocks"])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark document extraction throughput")
+    parser.add_argument("--sections", type=int, default=300, help="Sections in the generated DOCX and text files")
+    parser.add_argument("--pages", type=int, default=60, help="Pages in the generated PDF")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run(args.sections, args.pages, args.repeat)
@@ -0,0 +1,89 @@
+"""Benchmark the local math recognizer against a labeled set of handwritten equations.
+
+The dataset is a directory with images plus a labels.jsonl of {"image": "eq_001.png", "latex": "y = m x + b"}.
+Reports latency percentiles, exact-match and token edit-distance accuracy, and how many drawings would take
+the fast path (and how accurate those are) at each confidence threshold.
+
+    LABRAT_MATH_OCR=onnx LABRAT_MATH_OCR_MODEL=model.onnx LABRAT_MATH_OCR_VOCAB=vocab.txt \
+        python benchmarks/bench_math_ocr.py data/math_ocr_eval
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from math_ocr import get_recognizer, recognize_equation
+
+THRESHOLDS = (0.5, 0.7, 0.8, 0.9, 0.95, 0.99)
+
+def normalize_latex(latex):
+    return " ".join(latex.replace("{", " { ").replace("}", " } ").split())
+
+def token_edit_distance(a, b):
+    """Levenshtein distance over whitespace-separated LaTeX tokens"""
+    a, b = a.split(), b.split()
+    previous = list(range(len(b) + 1))
+    for i, token_a in enumerate(a, 1):
+        current = [i]
+        for j, token_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (token_a != token_b)))
+        previous = current
+    return previous[-1]
+
+def load_labels(dataset_dir):
+    with open(os.path.join(dataset_dir, "labels.jsonl"), "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def run(dataset_dir, warmup=3):
+    recognizer = get_recognizer()
+    if recognizer is None:
+        sys.exit("No recognizer configured - set LABRAT_MATH_OCR, LABRAT_MATH_OCR_MODEL and LABRAT_MATH_OCR_VOCAB")
+
+    samples = []
+    for label in load_labels(dataset_dir):
+        with open(os.path.join(dataset_dir, label["image"]), "rb") as f:
+            samples.append((base64.b64encode(f.read()).decode("utf-8"), normalize_latex(label["latex"])))
+    if not samples:
+        sys.exit("Dataset is empty")
+
+    for image_base64, _ in samples[:warmup]:
+        recognize_equation(image_base64, recognizer)
+
+    latencies, confidences, exact, error_rates = [], [], [], []
+    for image_base64, expected in samples:
+        start = time.perf_counter()
+        recognition = recognize_equation(image_base64, recognizer)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        predicted = normalize_latex(recognition["latex"])
+        confidences.append(recognition["confidence"])
+        exact.append(predicted == expected)
+        error_rates.append(token_edit_distance(predicted, expected) / max(1, len(expected.split())))
+
+    latencies, confidences = np.array(latencies), np.array(confidences)
+    exact, error_rates = np.array(exact), np.array(error_rates)
+
+    print(f"Recognizer: {recognizer.name}  samples: {len(samples)}")
+    print(f"Latency ms: p50={np.percentile(latencies, 50):.1f}  p95={np.percentile(latencies, 95):.1f}  max={latencies.max():.1f}")
+    print(f"Exact match: {exact.mean():.1%}  mean token error rate: {error_rates.mean():.3f}")
+    print()
+    print(f"{'threshold':>9}  {'coverage':>8}  {'exact':>7}  {'token err':>9}")
+    for threshold in THRESHOLDS:
+        taken = confidences >= threshold
+        if taken.any():
+            print(f"{threshold:>9.2f}  {taken.mean():>8.1%}  {exact[taken].mean():>7.1%}  {error_rates[taken].mean():>9.3f}")
+        else:
+            print(f"{threshold:>9.2f}  {0:>8.1%}  {'-':>7}  {'-':>9}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the local math OCR fast path")
+    parser.add_argument("dataset", help="Directory with images and labels.jsonl")
+    parser.add_argument("--warmup", type=int, default=3)
+    args = parser.parse_args()
+    run(args.dataset, args.warmup)
@@ -0,0 +1,108 @@
+"""Serialization time and bytes on the wire per endpoint, before and after serialization.py.
+
+Builds representative response bodies (a drawing analysis with its notebook, a page of finished upload jobs,
+a stored notebook, a simulation sweep and a usage report) and reports, per endpoint:
+encode time with the standard library (what jsonify used) and with serialization.dumps, and the body size
+as plain JSON, with cell references, and gzip / brotli compressed.
+
+    python benchmarks/bench_serialization.py --cells 8 --jobs 20 --repeat 200
+"""
+import argparse
+import gzip
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model import create_snowflake_notebook
+from serialization import dumps, dedupe_cells, compress, brotli, orjson, GZIP_LEVEL
+from simulation_runner import simulate, encode_json
+
+REASONING = ("The drawing shows a damped harmonic oscillator: x'' + 2ζω x' + ω² x = 0. The sketch of the "
+             "envelope suggests underdamping, so the notebook fits ζ and ω to the measured amplitudes. ")
+CODE = ("import numpy as np\nimport matplotlib.pyplot as plt\n\n"
+        "def oscillator(t, zeta, omega, x0=1.0):\n"
+        "    return x0 * np.exp(-zeta * omega * t) * np.cos(omega * np.sqrt(1 - zeta ** 2) * t)\n\n"
+        "t = np.linspace(0, 10, 500)\nplt.plot(t, oscillator(t, 0.1, 2 * np.pi))\nplt.show()\n")
+
+def drawing_analysis(cells):
+    notebook_cells = [{"cell_type": "code", "language": "python", "description": f"Step {i + 1}: model the oscillator",
+                       "code": f"# Cell {i + 1}\n{CODE}", "cell_number": i + 1} for i in range(cells)]
+    return {
+        "success": True,
+        "text": REASONING * 30,
+        "analysis_type": "drawing_analysis",
+        "notebook_cells": notebook_cells,
+        "notebook": create_snowflake_notebook(notebook_cells, "Drawing_Analysis_bench"),
+        "reasoning_steps": [{"step": i, "title": "Identify terms", "detail": REASONING * 2} for i in range(6)],
+        "analysis_id": "f" * 64,
+        "model": "us.anthropic.claude-opus-4-20250514-v1:0",
+    }
+
+def job_page(jobs, cells):
+    return {"success": True, "total": jobs, "page": 1, "pages": 1, "jobs": [
+        {"job_id": f"{i:032x}", "status": "done", "lane": "bulk", "filename": f"lab_{i}.png",
+         "result": drawing_analysis(cells)} for i in range(jobs)]}
+
+def simulation():
+    return encode_json(simulate("pendulum", parameters={"L": [0.5, 1.0, 1.5, 2.0]}, t_max=10, output_points=500))
+
+def usage_report():
+    return {"success": True, "days": 7, "group_by": ["request_type"], "total_cost_usd": 12.5, "total_calls": 4000,
+            "rows": [{"request_type": f"type_{i}", "calls": 400, "errors": 2, "input_tokens": 812345,
+                      "output_tokens": 91234, "cache_read_tokens": 5000, "cache_write_tokens": 0, "cost_usd": 1.25,
+                      "avg_cost_usd": 0.003, "avg_input_tokens": 2030, "avg_output_tokens": 228,
+                      "avg_model_latency_ms": 5400, "avg_wall_ms": 5600} for i in range(10)]}
+
+def stdlib_dumps(value):
+    # Flask's DefaultJSONProvider: sort_keys, compact separators
+    return json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+def median_ms(function, value, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(value)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--cells", type=int, default=8, help="Code cells per drawing analysis")
+    parser.add_argument("--jobs", type=int, default=20, help="Jobs in the job listing page")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    endpoints = {
+        "POST /api/labrat (drawing)": drawing_analysis(args.cells),
+        "GET /api/jobs?include_results": job_page(args.jobs, args.cells),
+        "GET /api/notebooks/<id>": {"success": True, "notebook": drawing_analysis(args.cells)["notebook"]},
+        "POST /api/simulate": simulation(),
+        "GET /api/usage/report": usage_report(),
+    }
+
+    print(f"encoder: {'orjson' if orjson else 'json (orjson not installed)'}, "
+          f"brotli: {'yes' if brotli else 'not installed'}, gzip level {GZIP_LEVEL}")
+    header = ["endpoint", "json ms", "fast ms", "speedup", "json B", "refs B", "gzip B", "br B", "encode+gz ms"]
+    print(f"{header[0]:<32}" + "".join(f"{column:>14}" for column in header[1:]))
+    for name, payload in endpoints.items():
+        slow = median_ms(stdlib_dumps, payload, args.repeat)
+        fast = median_ms(dumps, payload, args.repeat)
+        plain = dumps(payload)
+        referenced = dumps(dedupe_cells(payload))
+        gzipped = compress(referenced, 'gzip')
+        brotlied = compress(referenced, 'br') if brotli else None
+        wire = median_ms(lambda value: compress(dumps(dedupe_cells(value)), 'gzip'), payload, max(1, args.repeat // 4))
+        row = [f"{slow:.3f}", f"{fast:.3f}", f"{slow / fast:.1f}x", len(plain), len(referenced),
+               len(gzipped), len(brotlied) if brotlied else '-', f"{wire:.3f}"]
+        print(f"{name:<32}" + "".join(f"{str(value):>14}" for value in row))
+
+    # Sanity check: the gzip body decodes to the same document
+    sample = endpoints["POST /api/labrat (drawing)"]
+    assert json.loads(gzip.decompress(compress(dumps(sample), 'gzip'))) == json.loads(stdlib_dumps(sample))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""A classroom burst against the local model stub: many students press "Analyze" within a few seconds.
+
+Starts the server in process on a free port, with the model stub answering after --latency seconds.
+Then --students clients, each with its own X-LabRat-User in one class, post a freshly drawn canvas
+(a large PNG of random strokes, so every request really decodes and resizes) at random moments within
+--window seconds. Optional --speculative clients keep posting /api/speculate during the burst.
+
+The burst is run with burst mode off (preprocessing inline, a model slot held for the whole request) and
+on (burst_pool.py), reporting end-to-end latency percentiles, status codes, and the CPU pool's and model
+slots' own numbers.
+
+    python benchmarks/classroom_burst.py --students 32 --window 5 --latency 1.5
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def configure_environment(args):
+    # Read at import time by model.py, admission.py and analysis_cache.py
+    os.environ['LABRAT_MODEL_STUB'] = f"latency={args.latency}"
+    os.environ.setdefault('LABRAT_DATA_DIR', tempfile.mkdtemp(prefix='labrat-burst-'))
+    os.environ.setdefault('LABRAT_CLASS_RPM', '100000')
+    os.environ.setdefault('LABRAT_CLASS_TPM', '100000000')
+    os.environ.setdefault('LABRAT_VALIDATE_CELLS', 'off')
+
+def drawing(rng, width=2400, height=1600, strokes=60):
+    """A whiteboard-sized PNG of random pen strokes, as a data URL"""
+    from PIL import Image, ImageDraw
+    image = Image.new('RGBA', (width, height), (255, 255, 255, 0))
+    pen = ImageDraw.Draw(image)
+    for _ in range(strokes):
+        x, y = rng.uniform(0, width), rng.uniform(0, height)
+        points = []
+        for _ in range(rng.randint(5, 30)):
+            x = min(width, max(0, x + rng.gauss(0, 25)))
+            y = min(height, max(0, y + rng.gauss(0, 25)))
+            points.append((x, y))
+        pen.line(points, fill=(20, 20, 20, 255), width=rng.randint(3, 8))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def stroke_payload(rng, strokes=30, points=20, width=800, height=600):
+    """Random strokes in the extension's binary stroke format (see stroke_renderer.decode_strokes)"""
+    from stroke_renderer import STROKE_MAGIC, STROKE_FORMAT_VERSION
+    data = bytearray(STROKE_MAGIC) + bytes([STROKE_FORMAT_VERSION])
+    data += _varint(width) + _varint(height) + _varint(strokes)
+    last = (0, 0)
+    for _ in range(strokes):
+        data += _varint(30) + _varint(points)
+        for _ in range(points):
+            # Half-pixel units, zigzag-encoded deltas; time deltas of 16 ms
+            point = (int(rng.uniform(0, width) * 2), int(rng.uniform(0, height) * 2))
+            for delta in (point[0] - last[0], point[1] - last[1], 16):
+                data += _varint((delta << 1) ^ (delta >> 63))
+            last = point
+    return base64.b64encode(bytes(data)).decode('ascii')
+
+def post(url, body, user, class_id='burst-class'):
+    request = urllib.request.Request(url, data=json.dumps(body).encode('utf-8'), method='POST', headers={
+        'Content-Type': 'application/json', 'X-LabRat-User': user, 'X-LabRat-Class': class_id})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=300) as response:
+            response.read()
+            status, timing = response.status, response.headers.get('Server-Timing')
+    except urllib.error.HTTPError as e:
+        e.read()
+        status, timing = e.code, e.headers.get('Server-Timing')
+    return status, time.perf_counter() - started, timing
+
+def run_burst(base_url, args, seed):
+    rng = random.Random(seed)
+    images = [drawing(rng) for _ in range(args.students)]
+    offsets = sorted(rng.uniform(0, args.window) for _ in range(args.students))
+    results = []
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def student(index):
+        time.sleep(offsets[index])
+        outcome = post(f"{base_url}/api/labrat", {
+            "type": "drawing_analysis", "image": images[index], "vision_model": "claude",
+            "use_cache": False, "verbose": False, "include_reasoning": False,
+        }, f"student-{seed}-{index}")
+        with lock:
+            results.append(outcome)
+
+    def speculator(index):
+        while not stop.is_set():
+            post(f"{base_url}/api/speculate", {"strokes": stroke_payload(rng), "session_id": f"s{index}"},
+                 f"speculator-{seed}-{index}")
+            time.sleep(0.05)
+
+    threads = [threading.Thread(target=student, args=(index,)) for index in range(args.students)]
+    background = [threading.Thread(target=speculator, args=(index,), daemon=True) for index in range(args.speculative)]
+    started = time.perf_counter()
+    for thread in threads + background:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop.set()
+    return results, time.perf_counter() - started
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else float('nan')
+
+def report(label, results, elapsed):
+    latencies = [seconds for status, seconds, _ in results if status == 200]
+    statuses = {}
+    for status, _, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    print(f"\n{label}: {len(results)} requests in {elapsed:.1f}s, status {statuses}")
+    if latencies:
+        print(f"  latency s  p50 {percentile(latencies, 0.5):.2f}  p95 {percentile(latencies, 0.95):.2f}  "
+              f"p99 {percentile(latencies, 0.99):.2f}  max {max(latencies):.2f}  mean {statistics.mean(latencies):.2f}")
+    timings = [timing for _, _, timing in results if timing]
+    if timings:
+        print(f"  Server-Timing (first 3): {timings[:3]}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--students", type=int, default=32)
+    parser.add_argument("--window", type=float, default=5.0, help="Seconds over which the students press Analyze")
+    parser.add_argument("--latency", type=float, default=1.5, help="Model stub latency per call, in seconds")
+    parser.add_argument("--speculative", type=int, default=2, help="Clients posting /api/speculate during the burst")
+    parser.add_argument("--modes", default="off,on", help="Burst modes to run, in order")
+    args = parser.parse_args()
+    configure_environment(args)
+
+    from werkzeug.serving import make_server
+    import server
+    from burst_pool import burst_pool
+
+    http = make_server('127.0.0.1', 0, server.app, threaded=True)
+    threading.Thread(target=http.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{http.server_port}"
+    print(f"server on {base_url}, model stub latency {args.latency}s, {burst_pool.workers} CPU workers, "
+          f"{server.admission.scheduler.max_in_flight} model slots")
+
+    for seed, mode in enumerate(args.modes.split(',')):
+        burst_pool.enabled = mode == 'on'
+        results, elapsed = run_burst(base_url, args, seed)
+        report(f"burst mode {mode}", results, elapsed)
+        if burst_pool.enabled:
+            snapshot = burst_pool.snapshot()
+            for priority, stats in snapshot["priorities"].items():
+                if stats["submitted"] or stats["shed"]:
+                    print(f"  {priority:<12} {json.dumps(stats)}")
+    http.shutdown()
+
+if __name__ == "__main__":
+    main()
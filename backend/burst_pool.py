@@ -0,0 +1,249 @@
+"""Burst handling: a fixed CPU pool for request preprocessing, kept apart from the model slots.
+
+At the start of a lab, 30+ students press "Analyze" within a minute. Without burst mode every request
+thread rasterizes its strokes, decodes and re-encodes its image and then waits on the model, all while
+holding one of the admission scheduler's model slots. Slow CPU work then delays model calls, and
+model waits delay CPU work. With LABRAT_BURST_MODE=1:
+
+- CPU work (stroke rendering, canvas placement, preparing the model image) goes through a bounded
+  priority queue to CPU_WORKERS threads. Interactive requests are served before bulk and speculative ones.
+- Model slots become the I/O pool. A request takes a slot only for the duration of each model call
+  (SlottedClient), not for its whole lifetime.
+- Load is shed by queue depth. Speculative work is refused once the queue is half full, bulk at three
+  quarters, and interactive work only when it is full. The refusal is a ServerOverloaded, which the
+  client sees as a 503 with Retry-After.
+- The workers warm up when they start. PIL's format plugins are loaded and the codecs exercised once, so
+  the first burst does not pay for them. Prepared model images are kept in model.py's prepared-image
+  cache, so the request thread finds the image ready.
+
+Queue and run times per priority are reported by GET /api/burst/stats and in each drawing response's
+Server-Timing header.
+
+    LABRAT_BURST_MODE=1 LABRAT_CPU_WORKERS=4 python server.py
+    python benchmarks/classroom_burst.py --students 32 --window 20
+"""
+import contextlib
+import contextvars
+import heapq
+import io
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+from PIL import Image
+
+from admission import RateLimited
+from cancellation import current_token
+from circuit_breaker import ServerOverloaded
+from job_queue import LANES
+
+logger = logging.getLogger(__name__)
+
+BURST_MODE = os.getenv('LABRAT_BURST_MODE', '0').lower() not in ('0', 'false', 'off')
+CPU_WORKERS = int(os.getenv('LABRAT_CPU_WORKERS', str(min(8, os.cpu_count() or 2))))
+MAX_QUEUE = int(os.getenv('LABRAT_BURST_MAX_QUEUE', '64'))
+# Share of MAX_QUEUE at which each priority is refused; lower priorities give way first
+SHED_AT = {"interactive": 1.0, "bulk": 0.75, "speculative": 0.5}
+TIMING_WINDOW = 500
+
+class _Task:
+    __slots__ = ('priority', 'fn', 'args', 'future', 'context', 'enqueued', 'started')
+
+    def __init__(self, priority, fn, args):
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.future = Future()
+        self.context = contextvars.copy_context()
+        self.enqueued = time.perf_counter()
+        self.started = None
+
+
+class BurstPool:
+    def __init__(self, workers=CPU_WORKERS, max_queue=MAX_QUEUE, enabled=BURST_MODE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.enabled = enabled
+        self._heap = []
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._threads = []
+        self.counters = {priority: dict.fromkeys(("submitted", "shed", "completed", "failed", "cancelled"), 0)
+                         for priority in LANES}
+        self._queue_ms = {priority: deque(maxlen=TIMING_WINDOW) for priority in LANES}
+        self._run_ms = {priority: deque(maxlen=TIMING_WINDOW) for priority in LANES}
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._work, daemon=True, name=f'burst-cpu-{index}')
+                thread.start()
+                self._threads.append(thread)
+
+    @staticmethod
+    def _warm():
+        """Load PIL's plugins and run each codec once, so the first real request decodes at full speed"""
+        Image.init()
+        sample = Image.fromarray(np.full((64, 64, 3), 255, dtype=np.uint8))
+        for image_format in ('PNG', 'JPEG', 'WEBP'):
+            buffer = io.BytesIO()
+            try:
+                sample.save(buffer, format=image_format)
+                with Image.open(io.BytesIO(buffer.getvalue())) as image:
+                    image.load()
+            except (OSError, KeyError):
+                continue  # Codec not built into this Pillow
+
+    def _work(self):
+        try:
+            self._warm()
+        except Exception as e:
+            logger.warning(f"Burst pool warm-up failed: {e}")
+        while True:
+            with self._ready:
+                while not self._heap:
+                    self._ready.wait()
+                _, _, task = heapq.heappop(self._heap)
+            if not task.future.set_running_or_notify_cancel():
+                continue
+            task.started = time.perf_counter()
+            try:
+                result = task.context.run(task.fn, *task.args)
+            except BaseException as e:
+                self._finish(task, "failed")
+                task.future.set_exception(e)
+            else:
+                self._finish(task, "completed")
+                task.future.set_result(result)
+
+    def _finish(self, task, outcome):
+        finished = time.perf_counter()
+        with self._lock:
+            self.counters[task.priority][outcome] += 1
+            self._queue_ms[task.priority].append((task.started - task.enqueued) * 1000)
+            self._run_ms[task.priority].append((finished - task.started) * 1000)
+
+    def retry_after(self):
+        """Seconds until the current queue should have drained, from recent run times"""
+        with self._lock:
+            recent = [ms for window in self._run_ms.values() for ms in window]
+            depth = len(self._heap)
+        per_task = (sum(recent) / len(recent) / 1000) if recent else 0.5
+        return max(1, round(depth * per_task / max(1, self.workers)))
+
+    def submit(self, fn, *args, priority='interactive'):
+        """Queue CPU work and return its Future; raises ServerOverloaded when the queue is too deep for this priority"""
+        return self._enqueue(fn, args, priority).future
+
+    def _enqueue(self, fn, args, priority):
+        self.start()
+        task = _Task(priority, fn, args)
+        with self._ready:
+            if len(self._heap) >= self.max_queue * SHED_AT[priority]:
+                self.counters[priority]["shed"] += 1
+                shed = True
+            else:
+                self.counters[priority]["submitted"] += 1
+                heapq.heappush(self._heap, (LANES[priority], next(self._order), task))
+                self._ready.notify()
+                shed = False
+        if shed:
+            raise ServerOverloaded(f"The server is busy ({priority} work queue is full); please retry shortly",
+                                   self.retry_after())
+        return task
+
+    def run(self, fn, *args, priority='interactive', timing=None):
+        """Run fn(*args) on the CPU pool and wait for it (inline when burst mode is off).
+
+        A cancelled request gives up its place in the queue. With a timing dict, queue_ms and cpu_ms are added to it.
+        """
+        if not self.enabled:
+            started = time.perf_counter()
+            result = fn(*args)
+            if timing is not None:
+                timing["cpu_ms"] = timing.get("cpu_ms", 0) + (time.perf_counter() - started) * 1000
+            return result
+
+        task = self._enqueue(fn, args, priority)
+        token = current_token()
+        try:
+            while True:
+                try:
+                    return task.future.result(timeout=0.25)
+                except TimeoutError:
+                    if token is not None and token.cancelled and task.future.cancel():
+                        with self._lock:
+                            self.counters[priority]["cancelled"] += 1
+                        token.stop('cpu_queue')
+        finally:
+            if timing is not None and task.started is not None:
+                timing["queue_ms"] = timing.get("queue_ms", 0) + (task.started - task.enqueued) * 1000
+                timing["cpu_ms"] = timing.get("cpu_ms", 0) + (time.perf_counter() - task.started) * 1000
+
+    def snapshot(self):
+        with self._lock:
+            depth = {priority: 0 for priority in LANES}
+            for _, _, task in self._heap:
+                depth[task.priority] += 1
+            priorities = {}
+            for priority in LANES:
+                queue_ms = np.array(self._queue_ms[priority]) if self._queue_ms[priority] else None
+                run_ms = np.array(self._run_ms[priority]) if self._run_ms[priority] else None
+                priorities[priority] = {
+                    **self.counters[priority],
+                    "queued": depth[priority],
+                    "queue_ms_p50": round(float(np.percentile(queue_ms, 50)), 1) if queue_ms is not None else None,
+                    "queue_ms_p95": round(float(np.percentile(queue_ms, 95)), 1) if queue_ms is not None else None,
+                    "cpu_ms_p50": round(float(np.percentile(run_ms, 50)), 1) if run_ms is not None else None,
+                    "cpu_ms_p95": round(float(np.percentile(run_ms, 95)), 1) if run_ms is not None else None,
+                }
+        return {"enabled": self.enabled, "workers": self.workers, "max_queue": self.max_queue,
+                "queued": sum(depth.values()), "priorities": priorities}
+
+
+_slot_class = contextvars.ContextVar('labrat_model_slot_class', default=None)
+
+@contextlib.contextmanager
+def model_slots(class_id):
+    """Inside the block, each model call takes one of the scheduler's slots (queued round-robin by class)"""
+    token = _slot_class.set(class_id)
+    try:
+        yield
+    finally:
+        _slot_class.reset(token)
+
+
+class SlottedClient:
+    """Wraps a bedrock-runtime client: converse holds a model slot for the duration of the call, in burst mode"""
+
+    def __init__(self, client, scheduler):
+        self._client = client
+        self._scheduler = scheduler
+
+    def converse(self, **kwargs):
+        class_id = _slot_class.get()
+        if class_id is None:
+            return self._client.converse(**kwargs)
+        try:
+            self._scheduler.acquire(class_id)
+        except RateLimited as e:
+            # No slot within the admission timeout: an overload here, not an upstream failure
+            raise ServerOverloaded(str(e), e.retry_after) from e
+        try:
+            return self._client.converse(**kwargs)
+        finally:
+            self._scheduler.release()
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+burst_pool = BurstPool()
@@ -0,0 +1,353 @@
+"""Cache backends shared by every node: analyses, notebooks and extracted document text.
+
+Each cache is a named namespace (Cache) on a backend chosen by LABRAT_CACHE_URL:
+
+    (unset)                          each namespace's local default: files under data/, as before
+    memory                           in-process LRU (single node, tests)
+    disk:/mnt/shared/labrat-cache    files under a directory, e.g. a volume every node mounts
+    redis://cache:6379/0             a Redis (or Redis-protocol) server shared by every node
+    redis://a:6379/0,redis://b:6379/0  several servers, keys spread over them by consistent hashing
+
+Values are JSON documents. A backend that cannot be reached counts as a miss. Writes are dropped, except
+for namespaces created with required=True (notebooks), where the caller gets the error. Redis needs the
+optional `redis` package; run the server with maxmemory-policy allkeys-lru so old entries are evicted.
+
+With several nodes behind a load balancer, requests can also be routed to the node that already has
+the content warm in its memory. The extension sends X-LabRat-Route (the SHA-256 of the image, or the
+stroke session id). A consistent-hash ring over LABRAT_CACHE_NODES names the node that owns it, and
+that node is returned as X-LabRat-Cache-Node. The load balancer can hash on the same header, e.g. nginx
+`hash $http_x_labrat_route consistent;`.
+GET /api/cache/stats shows hits and misses per namespace and how many requests reached their owner.
+
+    LABRAT_CACHE_URL=redis://cache:6379/0 LABRAT_CACHE_NODES=node-a,node-b,node-c LABRAT_NODE_ID=node-b python server.py
+"""
+import bisect
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from serialization import dumps, loads
+
+try:
+    import redis
+except ImportError:  # redis is optional - only needed for redis:// cache URLs
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+CACHE_URL = os.getenv('LABRAT_CACHE_URL', '')
+# Entries of expiring namespaces are dropped after this long by the memory and Redis backends
+CACHE_TTL_SECONDS = float(os.getenv('LABRAT_CACHE_TTL_HOURS', '168')) * 3600
+MEMORY_MAX_ITEMS = int(os.getenv('LABRAT_CACHE_MEMORY_ITEMS', '1024'))
+REDIS_TIMEOUT_SECONDS = float(os.getenv('LABRAT_CACHE_TIMEOUT', '0.5'))
+RING_REPLICAS = 160
+CACHE_NODES = [node.strip() for node in os.getenv('LABRAT_CACHE_NODES', '').split(',') if node.strip()]
+NODE_ID = os.getenv('LABRAT_NODE_ID', '')
+
+KEY_PATTERN = re.compile(r"^[0-9A-Za-z_-]{1,128}$")
+
+def _check_key(key):
+    if not KEY_PATTERN.match(key):
+        raise ValueError(f"Invalid cache key: {key[:80]!r}")
+
+
+class MemoryBackend:
+    """Least recently used entries in this process"""
+
+    def __init__(self, max_items=MEMORY_MAX_ITEMS):
+        self.max_items = max_items
+        self._entries = OrderedDict()  # key -> (data, expires_at or None)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, data, ttl=None):
+        with self._lock:
+            self._entries[key] = (data, time.time() + ttl if ttl else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stamp(self, key):
+        data = self.get(key)
+        return hashlib.sha256(data).hexdigest()[:16] if data is not None else None
+
+    def describe(self):
+        return f"memory ({len(self._entries)}/{self.max_items} entries)"
+
+
+class DiskBackend:
+    """One file per key under root/<first two chars>/; written atomically, never expired"""
+
+    def __init__(self, root, suffix='.json'):
+        self.root = root
+        self.suffix = suffix
+
+    def path(self, key):
+        _check_key(key)
+        # Two-character shard keeps directories small once a semester of submissions is cached
+        return os.path.join(self.root, key[:2], f"{key}{self.suffix}")
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def set(self, key, data, ttl=None):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def delete(self, key):
+        try:
+            os.unlink(self.path(key))
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def stamp(self, key):
+        """Changes whenever the file is rewritten; answered from the file's metadata alone"""
+        try:
+            stat = os.stat(self.path(key))
+        except (FileNotFoundError, ValueError):
+            return None
+        return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+    def describe(self):
+        return f"disk ({self.root})"
+
+
+_redis_clients = {}
+_redis_clients_lock = threading.Lock()
+
+def redis_client(url):
+    """One client (and connection pool) per server URL, shared by every namespace"""
+    if redis is None:
+        raise RuntimeError("LABRAT_CACHE_URL points at Redis but the redis package is not installed (pip install redis)")
+    with _redis_clients_lock:
+        if url not in _redis_clients:
+            _redis_clients[url] = redis.Redis.from_url(
+                url, socket_timeout=REDIS_TIMEOUT_SECONDS, socket_connect_timeout=REDIS_TIMEOUT_SECONDS)
+        return _redis_clients[url]
+
+
+class RedisBackend:
+    """Keys under labrat:<namespace>: on a Redis-protocol server"""
+
+    def __init__(self, url, prefix, client=None):
+        self.url = url
+        self.prefix = prefix
+        self.client = client if client is not None else redis_client(url)
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, data, ttl=None):
+        self.client.set(self.prefix + key, data, ex=int(ttl) if ttl else None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def stamp(self, key):
+        data = self.get(key)
+        return hashlib.sha256(data).hexdigest()[:16] if data is not None else None
+
+    def describe(self):
+        return f"redis ({self.url})"
+
+
+class HashRing:
+    """Consistent hashing: each key belongs to one node, and adding or removing a node moves only ~1/n of the keys"""
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        self.nodes = list(nodes)
+        self._points = sorted((self._hash(f"{node}#{replica}"), node) for node in self.nodes for replica in range(replicas))
+        self._hashes = [point for point, _ in self._points]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def node_for(self, key):
+        if not self._points:
+            return None
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._points)
+        return self._points[index][1]
+
+
+class ShardedBackend:
+    """Spreads keys over several backends (one per server) by consistent hashing"""
+
+    def __init__(self, backends):
+        self.backends = backends  # name -> backend
+        self.ring = HashRing(backends)
+
+    def _shard(self, key):
+        return self.backends[self.ring.node_for(key)]
+
+    def get(self, key):
+        return self._shard(key).get(key)
+
+    def set(self, key, data, ttl=None):
+        self._shard(key).set(key, data, ttl)
+
+    def delete(self, key):
+        self._shard(key).delete(key)
+
+    def stamp(self, key):
+        return self._shard(key).stamp(key)
+
+    def describe(self):
+        return f"sharded over {len(self.backends)}: " + ", ".join(backend.describe() for backend in self.backends.values())
+
+
+def open_backend(name, local, url=CACHE_URL):
+    """The backend for a namespace: local (its default) unless LABRAT_CACHE_URL names another one"""
+    if not url:
+        return local
+    if url == 'memory':
+        return MemoryBackend()
+    if url.startswith('disk:'):
+        return DiskBackend(os.path.join(url[len('disk:'):], name))
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        servers = [server.strip() for server in url.split(',') if server.strip()]
+        backends = {server: RedisBackend(server, f"labrat:{name}:") for server in servers}
+        return backends[servers[0]] if len(servers) == 1 else ShardedBackend(backends)
+    raise ValueError(f"Unsupported LABRAT_CACHE_URL: {url} (use memory, disk:<dir> or redis://host:port/db)")
+
+
+class Cache:
+    """A namespace of JSON documents on a backend, with hit/miss counters"""
+
+    def __init__(self, name, backend, ttl=None, required=False):
+        self.name = name
+        self.backend = backend
+        self.ttl = ttl
+        self.required = required
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(("hits", "misses", "writes", "errors"), 0)
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def get(self, key):
+        """The stored document, or None (also when the backend is unreachable or the entry is corrupt)"""
+        try:
+            data = self.backend.get(key)
+            value = loads(data) if data is not None else None
+        except Exception as e:
+            self.count("errors")
+            logger.warning(f"Cache {self.name}: read of {key[:12]} failed: {e}")
+            value = None
+        self.count("hits" if value is not None else "misses")
+        return value
+
+    def set(self, key, value):
+        """Store a document; False when the backend failed (raises instead for required namespaces)"""
+        try:
+            self.backend.set(key, dumps(value), self.ttl)
+        except Exception as e:
+            self.count("errors")
+            if self.required:
+                raise
+            logger.warning(f"Cache {self.name}: write of {key[:12]} failed: {e}")
+            return False
+        self.count("writes")
+        return True
+
+    def delete(self, key):
+        try:
+            self.backend.delete(key)
+        except Exception as e:
+            self.count("errors")
+            logger.warning(f"Cache {self.name}: delete of {key[:12]} failed: {e}")
+
+    def stamp(self, key):
+        """A short string that changes whenever the entry is rewritten; None when there is no entry"""
+        try:
+            return self.backend.stamp(key)
+        except Exception as e:
+            self.count("errors")
+            logger.warning(f"Cache {self.name}: stamp of {key[:12]} failed: {e}")
+            return None
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self.counters)
+        lookups = counters["hits"] + counters["misses"]
+        return {**counters, "hit_rate": round(counters["hits"] / lookups, 3) if lookups else None,
+                "backend": self.backend.describe()}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def open_cache(name, local, ttl=None, required=False, url=CACHE_URL):
+    """Create (once) the named cache; local is the backend used when LABRAT_CACHE_URL is not set"""
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = Cache(name, open_backend(name, local, url), ttl, required)
+        return _caches[name]
+
+def cache_stats():
+    with _caches_lock:
+        caches = list(_caches.values())
+    return {cache.name: cache.snapshot() for cache in caches}
+
+
+class CacheRouter:
+    """Routing hints: which node owns a route key, and how often requests arrived at their owner"""
+
+    def __init__(self, nodes=CACHE_NODES, node_id=NODE_ID):
+        self.node_id = node_id
+        self.ring = HashRing(nodes)
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(("owner", "elsewhere"), 0)
+
+    @property
+    def enabled(self):
+        return bool(self.ring.nodes)
+
+    def owner(self, route_key):
+        """The node that should serve this key (None without LABRAT_CACHE_NODES); counts where it landed"""
+        if not self.enabled or not route_key:
+            return None
+        node = self.ring.node_for(route_key)
+        with self._lock:
+            self.counters["owner" if node == self.node_id else "elsewhere"] += 1
+        return node
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return {"nodes": self.ring.nodes, "node_id": self.node_id or None, **counters}
+
+
+cache_router = CacheRouter()
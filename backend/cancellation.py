@@ -0,0 +1,215 @@
+"""Request cancellation, from the extension down to the upstream model call.
+
+Every model request runs inside a cancellation scope with a token. The token is cancelled when
+- the extension aborts its fetch or closes the side panel (POST /api/cancel, also sent by sendBeacon),
+- the client's connection goes away (DisconnectMonitor watches the request sockets), or
+- a queued or running job is cancelled or superseded.
+
+Work checks the token at its checkpoints: waiting for an admission slot, between the stages of a drawing
+analysis, and between the chunks of a streamed model answer. StreamingBedrockClient uses converse_stream
+inside a scope so a cancelled generation is closed mid-stream instead of running to maxTokens.
+"""
+import contextlib
+import contextvars
+import logging
+import select
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MONITOR_INTERVAL_SECONDS = 0.5
+
+class RequestCancelled(Exception):
+    """The request's token was cancelled; reason says by whom"""
+
+    def __init__(self, reason='cancelled'):
+        super().__init__(f"Request cancelled ({reason})")
+        self.reason = reason
+
+
+class CancellationToken:
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.reason = None
+        self.stopped_at = None
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason='client'):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+            return True
+        return False
+
+    def stop(self, stage):
+        """Raise RequestCancelled from a checkpoint; only the first stage the work stopped at is counted"""
+        if self.stopped_at is None:
+            self.stopped_at = stage
+            cancellations.count_stopped(stage)
+        raise RequestCancelled(self.reason)
+
+
+_current = contextvars.ContextVar('labrat_cancellation_token', default=None)
+
+def current_token():
+    return _current.get()
+
+def checkpoint(stage=None):
+    """Raise RequestCancelled if the current request was cancelled (no-op outside a scope)"""
+    token = _current.get()
+    if token is not None and token.cancelled:
+        token.stop(stage or 'checkpoint')
+
+
+class CancellationRegistry:
+    """Live tokens by request id, plus counters of what was cancelled and where work actually stopped"""
+
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self.requested = {}
+        self.stopped = {}
+
+    @contextlib.contextmanager
+    def scope(self, request_id):
+        token = CancellationToken(request_id)
+        with self._lock:
+            self._tokens[request_id] = token
+        reset = _current.set(token)
+        try:
+            yield token
+        finally:
+            _current.reset(reset)
+            with self._lock:
+                if self._tokens.get(request_id) is token:
+                    del self._tokens[request_id]
+
+    def cancel(self, request_id, reason='client'):
+        """Cancel a live request; False if it already finished (or never existed)"""
+        with self._lock:
+            token = self._tokens.get(request_id)
+        if token is None or not token.cancel(reason):
+            return False
+        with self._lock:
+            self.requested[reason] = self.requested.get(reason, 0) + 1
+        logger.info(f"Request {request_id} cancelled ({reason})")
+        return True
+
+    def count_stopped(self, stage):
+        with self._lock:
+            self.stopped[stage] = self.stopped.get(stage, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return {"live": len(self._tokens), "requested": dict(self.requested), "stopped": dict(self.stopped)}
+
+
+class DisconnectMonitor:
+    """Cancels requests whose client closed the connection (a peek at a readable socket returns EOF)"""
+
+    def __init__(self, registry, interval=MONITOR_INTERVAL_SECONDS):
+        self.registry = registry
+        self.interval = interval
+        self._watched = {}  # request id -> socket
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @contextlib.contextmanager
+    def watch(self, request_id, sock):
+        if sock is None:
+            yield
+            return
+        with self._lock:
+            self._watched[request_id] = sock
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, daemon=True, name='disconnect-monitor')
+                self._thread.start()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._watched.pop(request_id, None)
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                watched = dict(self._watched)
+            if not watched:
+                continue
+            try:
+                readable, _, _ = select.select(list(watched.values()), [], [], 0)
+            except (OSError, ValueError):
+                readable = list(watched.values())
+            for request_id, sock in watched.items():
+                if sock in readable and _closed(sock):
+                    self.registry.cancel(request_id, 'disconnect')
+
+
+def _closed(sock):
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True
+
+def request_socket(environ):
+    """The client socket behind a WSGI request, where the server exposes it (werkzeug, gunicorn)"""
+    sock = environ.get('werkzeug.socket') or environ.get('gunicorn.socket')
+    return sock if isinstance(sock, socket.socket) else None
+
+
+class StreamingBedrockClient:
+    """Wraps a bedrock-runtime client: inside a cancellation scope, converse() streams and stops on cancel.
+
+    Returns the same shape as converse() (output.message.content[0].text, stopReason, usage, metrics) so
+    callers do not change. Outside a scope, or for clients without converse_stream, it is a plain converse().
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def converse(self, **kwargs):
+        token = _current.get()
+        if token is None or not hasattr(self._client, 'converse_stream'):
+            return self._client.converse(**kwargs)
+        checkpoint('before_model_call')
+        response = self._client.converse_stream(**kwargs)
+        stream = response['stream']
+        text, stop_reason, usage, metrics = [], None, {}, {}
+        try:
+            for event in stream:
+                if token.cancelled:
+                    token.stop('model_stream')
+                if 'contentBlockDelta' in event:
+                    text.append(event['contentBlockDelta']['delta'].get('text', ''))
+                elif 'messageStop' in event:
+                    stop_reason = event['messageStop'].get('stopReason')
+                elif 'metadata' in event:
+                    usage = event['metadata'].get('usage', {})
+                    metrics = event['metadata'].get('metrics', {})
+        finally:
+            # Closing the stream early is what stops the generation
+            close = getattr(stream, 'close', None)
+            if close:
+                close()
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": "".join(text)}]}},
+            "stopReason": stop_reason,
+            "usage": usage,
+            "metrics": metrics,
+        }
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+cancellations = CancellationRegistry()
+disconnect_monitor = DisconnectMonitor(cancellations)
@@ -0,0 +1,548 @@
+"""Compile and run generated notebook cells in pre-warmed, resource-limited subprocesses.
+
+Each validation takes an idle worker from the pool, runs the cells in order in one namespace (like a notebook),
+then throws the worker away; a replacement is warmed in the background. Workers run with CPU, memory and file
+size limits and with the Snowflake connector and Snowpark replaced by stubs. Before reading any cell a worker
+isolates itself, and every step is checked:
+
+- private mount and network namespaces (plus a user namespace when the server is not root), so there is no
+  network at all;
+- a chroot into a tmpfs holding read-only binds of /usr, /lib and Python's own sys.path, plus a small
+  writable /tmp. The server's source, its .env and the rest of the host filesystem are not visible;
+- LABRAT_SANDBOX_USER (default nobody) when started as root, otherwise all capabilities dropped;
+- a seccomp filter that refuses execve, fork and other process creation, ptrace, signals to other
+  processes and further namespace or mount changes. subprocess, os.system and os.exec* fail.
+
+If the kernel refuses any of it the worker exits without running anything, and mode='run' fails with
+SandboxUnavailable (fail closed). Compile mode never executes cells.
+
+    python cell_sandbox.py --worker    # started by SandboxPool, speaks line-delimited JSON on stdin/stdout
+"""
+import json
+import logging
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CELL_TIMEOUT_SECONDS = float(os.getenv('LABRAT_SANDBOX_CELL_TIMEOUT', '10'))
+MEMORY_LIMIT_MB = int(os.getenv('LABRAT_SANDBOX_MEMORY_MB', '1024'))
+CPU_LIMIT_SECONDS = int(os.getenv('LABRAT_SANDBOX_CPU_SECONDS', '60'))
+FILE_SIZE_LIMIT_MB = 16
+POOL_SIZE = int(os.getenv('LABRAT_SANDBOX_WORKERS', '2'))
+MAX_OUTPUT_CHARS = 4000
+WARMUP_TIMEOUT_SECONDS = 30
+SANDBOX_USER = os.getenv('LABRAT_SANDBOX_USER', 'nobody')
+TMP_SIZE_MB = 64
+# Host paths visible (read-only) inside the sandbox, besides the directories on Python's sys.path
+SYSTEM_PATHS = ("/usr", "/lib", "/lib64", "/bin", "/etc/ld.so.cache", "/etc/localtime")
+DEVICES = ("/dev/null", "/dev/zero", "/dev/random", "/dev/urandom")
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class SandboxUnavailable(RuntimeError):
+    """The kernel refused part of the worker isolation, so no cells are run"""
+
+
+def compile_cells(cells):
+    """Syntax-check every cell in-process; returns per-cell reports (no code is executed)"""
+    reports = []
+    for cell in cells:
+        report = {"cell_number": cell.get("cell_number"), "status": "ok", "error": None}
+        try:
+            compile(cell.get("code", ""), f"<cell {cell.get('cell_number')}>", "exec")
+        except SyntaxError as e:
+            report.update(status="syntax_error", error=f"{e.msg} (line {e.lineno})", line=e.lineno)
+        reports.append(report)
+    return reports
+
+
+class SandboxWorker:
+    """One warmed worker subprocess"""
+
+    def __init__(self):
+        # The worker mounts its chroot over this directory, in its own mount namespace
+        self.workdir = tempfile.mkdtemp(prefix="labrat-sandbox-")
+        self.error = None
+        env = {
+            "PATH": os.environ.get("PATH", ""),
+            "HOME": "/tmp",
+            "MPLBACKEND": "Agg",
+            "MPLCONFIGDIR": "/tmp",
+            "OPENBLAS_NUM_THREADS": "1",
+            "OMP_NUM_THREADS": "1",
+            "PYTHONDONTWRITEBYTECODE": "1",
+            "LABRAT_SANDBOX_MEMORY_MB": str(MEMORY_LIMIT_MB),
+            "LABRAT_SANDBOX_CPU_SECONDS": str(CPU_LIMIT_SECONDS),
+            "LABRAT_SANDBOX_USER": SANDBOX_USER,
+        }
+        self.process = subprocess.Popen(
+            [sys.executable, "-I", os.path.abspath(__file__), "--worker"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            cwd=self.workdir, env=env, text=True, bufsize=1
+        )
+        self._responses = queue.Queue()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        for line in self.process.stdout:
+            try:
+                self._responses.put(json.loads(line))
+            except ValueError:
+                continue
+        self._responses.put(None)
+
+    def wait_ready(self, timeout=WARMUP_TIMEOUT_SECONDS):
+        message = self._next(timeout)
+        if not (message and message.get("ready")):
+            self.error = (message or {}).get("error") or "worker did not start"
+            return False
+        return True
+
+    def _next(self, timeout):
+        try:
+            return self._responses.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def run_cell(self, code, timeout):
+        """Run one cell; None means the worker hung or died"""
+        try:
+            self.process.stdin.write(json.dumps({"code": code}) + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            return None
+        return self._next(timeout)
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        for name in os.listdir(self.workdir):
+            try:
+                os.remove(os.path.join(self.workdir, name))
+            except OSError:
+                pass
+        try:
+            os.rmdir(self.workdir)
+        except OSError:
+            pass
+
+
+class SandboxPool:
+    """Keeps a few warmed workers ready; every validation gets a fresh one"""
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._warming = 0
+        self.unavailable = None  # Why the last worker failed to start, until one starts again
+
+    def _warm_one(self):
+        try:
+            worker = SandboxWorker()
+            if worker.wait_ready():
+                self.unavailable = None
+                self._idle.put(worker)
+            else:
+                self.unavailable = worker.error
+                logger.warning(f"Sandbox worker failed to start: {worker.error}")
+                worker.close()
+        finally:
+            with self._lock:
+                self._warming -= 1
+
+    def _replenish(self):
+        with self._lock:
+            missing = self.size - self._idle.qsize() - self._warming
+            self._warming += max(0, missing)
+        for _ in range(max(0, missing)):
+            threading.Thread(target=self._warm_one, daemon=True).start()
+
+    def acquire(self, timeout=WARMUP_TIMEOUT_SECONDS):
+        self._replenish()
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                worker = self._idle.get(timeout=0.25)
+                break
+            except queue.Empty:
+                if self.unavailable:
+                    raise SandboxUnavailable(f"Sandbox unavailable: {self.unavailable}")
+                if time.monotonic() > deadline:
+                    raise RuntimeError("No sandbox worker available")
+        self._replenish()
+        return worker
+
+    def run_cells(self, cells, cell_timeout=CELL_TIMEOUT_SECONDS):
+        """Execute cells in order in one sandbox; later cells are skipped once the worker hangs or dies"""
+        worker = self.acquire()
+        reports = []
+        try:
+            alive = True
+            for cell in cells:
+                report = {"cell_number": cell.get("cell_number"), "status": "skipped", "error": None, "elapsed_ms": None}
+                if alive:
+                    started = time.perf_counter()
+                    response = worker.run_cell(cell.get("code", ""), cell_timeout)
+                    if response is None:
+                        alive = False
+                        crashed = worker.process.poll() is not None
+                        report.update(
+                            status="crashed" if crashed else "timeout",
+                            error="Sandbox worker exited (memory or CPU limit?)" if crashed else f"Cell exceeded {cell_timeout:g}s",
+                            elapsed_ms=round((time.perf_counter() - started) * 1000, 1)
+                        )
+                    else:
+                        report.update(response)
+                reports.append(report)
+        finally:
+            worker.close()
+        return reports
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SandboxPool()
+        return _pool
+
+def validate_cells(cells, mode="compile"):
+    """Compile (and with mode='run', execute) cells; returns {"valid", "cells": [per-cell reports]}"""
+    reports = compile_cells(cells)
+    if mode == "run" and all(r["status"] == "ok" for r in reports):
+        reports = get_pool().run_cells(cells)
+    return {
+        "valid": all(r["status"] == "ok" for r in reports),
+        "mode": mode,
+        "cells": reports,
+        "total_ms": round(sum(r.get("elapsed_ms") or 0 for r in reports), 1),
+    }
+
+
+# --- Worker process side ---
+
+def _apply_limits():
+    import resource
+
+    resource.setrlimit(resource.RLIMIT_AS, (MEMORY_LIMIT_MB * 1024 * 1024,) * 2)
+    resource.setrlimit(resource.RLIMIT_CPU, (CPU_LIMIT_SECONDS, CPU_LIMIT_SECONDS))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (FILE_SIZE_LIMIT_MB * 1024 * 1024,) * 2)
+
+CLONE_NEWNS, CLONE_NEWUSER, CLONE_NEWNET, CLONE_THREAD = 0x00020000, 0x10000000, 0x40000000, 0x00010000
+MS_RDONLY, MS_NOSUID, MS_NODEV, MS_NOEXEC, MS_REMOUNT = 1, 2, 4, 8, 32
+MS_NOATIME, MS_NODIRATIME, MS_BIND, MS_REC, MS_PRIVATE, MS_RELATIME = 1024, 2048, 4096, 16384, 1 << 18, 1 << 21
+ST_RELATIME = 4096
+PR_SET_NO_NEW_PRIVS, PR_SET_SECCOMP, SECCOMP_MODE_FILTER = 38, 22, 2
+SECCOMP_RET_ALLOW, SECCOMP_RET_ERRNO, SECCOMP_RET_KILL_PROCESS = 0x7fff0000, 0x00050000, 0x80000000
+EPERM, ENOSYS = 1, 38
+
+# Audit architecture and syscall numbers for the seccomp filter; other architectures fail closed
+SYSCALLS = {
+    "x86_64": (0xC000003E, {
+        "execve": 59, "execveat": 322, "fork": 57, "vfork": 58, "clone": 56, "clone3": 435,
+        "ptrace": 101, "process_vm_readv": 310, "process_vm_writev": 311, "kill": 62, "tkill": 200,
+        "tgkill": 234, "pidfd_open": 434, "pidfd_send_signal": 424, "unshare": 272, "setns": 308,
+        "mount": 165, "umount2": 166, "pivot_root": 155, "chroot": 161,
+    }),
+    "aarch64": (0xC00000B7, {
+        "execve": 221, "execveat": 281, "clone": 220, "clone3": 435,
+        "ptrace": 117, "process_vm_readv": 270, "process_vm_writev": 271, "kill": 129, "tkill": 130,
+        "tgkill": 131, "pidfd_open": 434, "pidfd_send_signal": 424, "unshare": 97, "setns": 268,
+        "mount": 40, "umount2": 39, "pivot_root": 41, "chroot": 51,
+    }),
+}
+DENIED_SYSCALLS = ("execve", "execveat", "fork", "vfork", "ptrace", "process_vm_readv", "process_vm_writev",
+                   "tkill", "pidfd_open", "pidfd_send_signal", "unshare", "setns", "mount", "umount2",
+                   "pivot_root", "chroot")
+
+def _checked(result, what):
+    import ctypes
+
+    if result != 0:
+        raise SandboxUnavailable(f"{what} failed: {os.strerror(ctypes.get_errno())}")
+
+def _mount(libc, source, target, fstype=None, flags=0, options=None):
+    import ctypes
+
+    encode = lambda value: value.encode() if value is not None else None
+    _checked(libc.mount(encode(source), encode(target), encode(fstype), ctypes.c_ulong(flags), encode(options)),
+             f"mount {target}")
+
+def _bind(libc, source, new_root, readonly=True):
+    target = new_root + source
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), target)
+        return
+    if os.path.isdir(source):
+        os.makedirs(target, exist_ok=True)
+    else:
+        open(target, "a").close()
+    _mount(libc, source, target, flags=MS_BIND | MS_REC)
+    if readonly:
+        # A remount has to keep the flags the host mount is locked with
+        flag = os.statvfs(target).f_flag
+        locked = flag & (MS_NOSUID | MS_NODEV | MS_NOEXEC | MS_NOATIME | MS_NODIRATIME)
+        locked |= MS_RELATIME if flag & ST_RELATIME else 0
+        _mount(libc, None, target, flags=MS_BIND | MS_REMOUNT | MS_RDONLY | locked)
+
+def _visible_paths():
+    """SYSTEM_PATHS and Python's sys.path, minus anything that would expose the backend directory"""
+    paths = []
+    for path in SYSTEM_PATHS + tuple(sys.path):
+        if not path or not os.path.lexists(path) or path == BACKEND_DIR or BACKEND_DIR.startswith(path.rstrip("/") + "/"):
+            continue
+        if not any(path == seen or path.startswith(seen.rstrip("/") + "/") for seen in paths):
+            paths.append(path)
+    return paths
+
+def _enter_chroot(libc, new_root):
+    """Replace the filesystem with a read-only tmpfs of _visible_paths() and a writable /tmp"""
+    _mount(libc, None, "/", flags=MS_REC | MS_PRIVATE)
+    _mount(libc, "tmpfs", new_root, "tmpfs", MS_NOSUID | MS_NODEV, "size=1m,mode=0755")
+    for path in _visible_paths():
+        _bind(libc, path, new_root)
+    for device in DEVICES:
+        _bind(libc, device, new_root, readonly=False)
+    os.makedirs(new_root + "/tmp")
+    _mount(libc, "tmpfs", new_root + "/tmp", "tmpfs", MS_NOSUID | MS_NODEV, f"size={TMP_SIZE_MB}m,mode=1777")
+    _mount(libc, None, new_root, flags=MS_BIND | MS_REMOUNT | MS_RDONLY | MS_NOSUID | MS_NODEV)
+    os.chdir(new_root)
+    os.chroot(".")
+    os.chdir("/tmp")
+
+def _drop_capabilities(libc):
+    import ctypes
+
+    class CapHeader(ctypes.Structure):
+        _fields_ = [("version", ctypes.c_uint32), ("pid", ctypes.c_int)]
+
+    header = CapHeader(0x20080522, 0)  # _LINUX_CAPABILITY_VERSION_3
+    _checked(libc.capset(ctypes.byref(header), (ctypes.c_uint32 * 6)()), "capset")
+
+def _seccomp_filter(arch, numbers, pid):
+    """BPF program: refuse process creation, exec and namespace changes; signals only to this process"""
+    ld, jeq, jge, jset, ret = 0x20, 0x15, 0x35, 0x45, 0x06
+    program = [(ld, 0, 0, 4), (jeq, 1, 0, arch), (ret, 0, 0, SECCOMP_RET_KILL_PROCESS), (ld, 0, 0, 0)]
+    if arch == SYSCALLS["x86_64"][0]:
+        # x32 syscalls share the x86_64 audit arch
+        program += [(jge, 0, 1, 0x40000000), (ret, 0, 0, SECCOMP_RET_ERRNO | EPERM)]
+    for name in DENIED_SYSCALLS:
+        if name in numbers:
+            program += [(jeq, 0, 1, numbers[name]), (ret, 0, 0, SECCOMP_RET_ERRNO | EPERM)]
+    # glibc falls back from clone3 to clone, whose flags the filter can see: threads only
+    program += [(jeq, 0, 1, numbers["clone3"]), (ret, 0, 0, SECCOMP_RET_ERRNO | ENOSYS)]
+    program += [(jeq, 0, 4, numbers["clone"]), (ld, 0, 0, 16), (jset, 1, 0, CLONE_THREAD),
+                (ret, 0, 0, SECCOMP_RET_ERRNO | EPERM), (ret, 0, 0, SECCOMP_RET_ALLOW)]
+    program += [(jeq, 1, 0, numbers["kill"]), (jeq, 0, 4, numbers["tgkill"]), (ld, 0, 0, 16),
+                (jeq, 1, 0, pid), (ret, 0, 0, SECCOMP_RET_ERRNO | EPERM), (ret, 0, 0, SECCOMP_RET_ALLOW)]
+    return program + [(ret, 0, 0, SECCOMP_RET_ALLOW)]
+
+def _install_seccomp(libc):
+    import ctypes
+    import platform
+    import struct
+
+    if platform.machine() not in SYSCALLS:
+        raise SandboxUnavailable(f"No seccomp filter for {platform.machine()}")
+    arch, numbers = SYSCALLS[platform.machine()]
+    program = _seccomp_filter(arch, numbers, os.getpid())
+    code = b"".join(struct.pack("HBBI", op, jt, jf, k) for op, jt, jf, k in program)
+    buffer = ctypes.create_string_buffer(code, len(code))
+
+    class SockFprog(ctypes.Structure):
+        _fields_ = [("len", ctypes.c_ushort), ("filter", ctypes.c_void_p)]
+
+    fprog = SockFprog(len(program), ctypes.addressof(buffer))
+    _checked(libc.prctl(PR_SET_NO_NEW_PRIVS, ctypes.c_ulong(1), ctypes.c_ulong(0), ctypes.c_ulong(0), ctypes.c_ulong(0)),
+             "prctl(NO_NEW_PRIVS)")
+    _checked(libc.prctl(PR_SET_SECCOMP, ctypes.c_ulong(SECCOMP_MODE_FILTER), ctypes.byref(fprog), ctypes.c_ulong(0),
+                        ctypes.c_ulong(0)), "seccomp")
+
+def _isolate():
+    """Namespaces, chroot, unprivileged user and seccomp, in that order; raises SandboxUnavailable on any failure"""
+    import ctypes
+    import pwd
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    as_root = os.geteuid() == 0
+    if as_root:
+        user = pwd.getpwnam(SANDBOX_USER)  # Looked up before /etc disappears
+        _checked(libc.unshare(CLONE_NEWNS | CLONE_NEWNET), "unshare")
+    else:
+        uid, gid = os.getuid(), os.getgid()
+        _checked(libc.unshare(CLONE_NEWUSER | CLONE_NEWNS | CLONE_NEWNET), "unshare")
+        for name, mapping in (("setgroups", "deny"), ("uid_map", f"{uid} {uid} 1"), ("gid_map", f"{gid} {gid} 1")):
+            with open(f"/proc/self/{name}", "w") as f:
+                f.write(mapping)
+
+    _enter_chroot(libc, os.getcwd())
+    if as_root:
+        os.setgroups([])
+        os.setresgid(user.pw_gid, user.pw_gid, user.pw_gid)
+        os.setresuid(user.pw_uid, user.pw_uid, user.pw_uid)
+        if os.geteuid() == 0 or user.pw_uid == 0:
+            raise SandboxUnavailable(f"Sandbox user {SANDBOX_USER} is root")
+    else:
+        _drop_capabilities(libc)
+    _install_seccomp(libc)
+
+def _disable_network():
+    """The network namespace has no interfaces up; these stubs just give cells a clearer error"""
+    import socket
+
+    def _blocked(*args, **kwargs):
+        raise OSError("Network access is disabled in the LabRat sandbox")
+
+    socket.socket = _blocked
+    socket.create_connection = _blocked
+    socket.getaddrinfo = _blocked
+
+def _install_snowflake_stubs():
+    """Fake snowflake.connector / snowflake.snowpark so generated cells run without a warehouse"""
+    import types
+
+    try:
+        import pandas as pd
+        empty_frame = pd.DataFrame
+    except ImportError:
+        empty_frame = list
+
+    class StubCursor:
+        description = []
+
+        def execute(self, *args, **kwargs):
+            return self
+
+        def fetchall(self):
+            return []
+
+        def fetchone(self):
+            return None
+
+        def fetch_pandas_all(self):
+            return empty_frame()
+
+        def close(self):
+            pass
+
+    class StubConnection:
+        def cursor(self):
+            return StubCursor()
+
+        def close(self):
+            pass
+
+    class StubDataFrame:
+        def collect(self):
+            return []
+
+        def to_pandas(self):
+            return empty_frame()
+
+        def __getattr__(self, name):
+            # Any other Snowpark call chains (filter, select, show, ...) and returns another stub
+            return lambda *args, **kwargs: self
+
+    class StubSession:
+        def sql(self, *args, **kwargs):
+            return StubDataFrame()
+
+        def table(self, *args, **kwargs):
+            return StubDataFrame()
+
+        def create_dataframe(self, *args, **kwargs):
+            return StubDataFrame()
+
+        def __getattr__(self, name):
+            return lambda *args, **kwargs: StubDataFrame()
+
+    snowflake = types.ModuleType("snowflake")
+    connector = types.ModuleType("snowflake.connector")
+    connector.connect = lambda *args, **kwargs: StubConnection()
+    snowpark = types.ModuleType("snowflake.snowpark")
+    snowpark.Session = StubSession
+    context = types.ModuleType("snowflake.snowpark.context")
+    context.get_active_session = StubSession
+    snowpark.context = context
+    snowflake.connector = connector
+    snowflake.snowpark = snowpark
+    sys.modules.update({
+        "snowflake": snowflake,
+        "snowflake.connector": connector,
+        "snowflake.snowpark": snowpark,
+        "snowflake.snowpark.context": context,
+    })
+
+def _warm_imports():
+    """Import the heavy libraries generated cells use before the worker reports ready"""
+    for name in ("numpy", "pandas", "matplotlib.pyplot", "sympy"):
+        try:
+            __import__(name)
+        except Exception:
+            pass
+    try:
+        import matplotlib.pyplot as plt
+        plt.show = lambda *args, **kwargs: None
+    except Exception:
+        pass
+
+def worker_main():
+    import contextlib
+    import io
+    import traceback
+
+    # Keep the protocol on a private copy of stdout so cells writing to fd 1 cannot corrupt it
+    protocol = os.fdopen(os.dup(1), "w", buffering=1)
+    os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+    _apply_limits()
+    try:
+        _isolate()
+    except Exception as e:
+        protocol.write(json.dumps({"ready": False, "error": str(e)}) + "\n")
+        protocol.flush()
+        return
+    _disable_network()
+    _install_snowflake_stubs()
+    _warm_imports()
+
+    namespace = {"__name__": "__main__"}
+    protocol.write(json.dumps({"ready": True}) + "\n")
+    protocol.flush()
+
+    for line in sys.stdin:
+        code = json.loads(line)["code"]
+        stdout, stderr = io.StringIO(), io.StringIO()
+        report = {"status": "ok", "error": None}
+        started = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                exec(compile(code, "<cell>", "exec"), namespace)
+        except MemoryError:
+            report.update(status="runtime_error", error="MemoryError: cell exceeded the sandbox memory limit")
+        except BaseException as e:
+            frames = [f for f in traceback.extract_tb(e.__traceback__) if f.filename == "<cell>"]
+            report.update(
+                status="runtime_error",
+                error=f"{type(e).__name__}: {e}",
+                line=frames[-1].lineno if frames else None
+            )
+        report["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        report["stdout"] = stdout.getvalue()[:MAX_OUTPUT_CHARS]
+        report["stderr"] = stderr.getvalue()[:MAX_OUTPUT_CHARS]
+        protocol.write(json.dumps(report) + "\n")
+        protocol.flush()
+
+if __name__ == "__main__" and "--worker" in sys.argv:
+    worker_main()
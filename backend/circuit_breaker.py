@@ -0,0 +1,218 @@
+"""Circuit breakers around upstream model calls (Bedrock converse, the Writer API).
+
+A breaker watches a rolling window of call outcomes. Once enough calls failed (throttling, 5xx, timeouts -
+not our own validation errors), it opens and further calls fail immediately with CircuitOpenError instead of
+tying up a worker thread for the full timeout. After a cool-down one probe call is let through (half-open):
+success closes the breaker, failure opens it again for twice as long.
+
+Callers turn failures into {"error", "unavailable": True, "retry_after"} results with upstream_error(), which
+the server answers with 503 + Retry-After after trying its fallbacks.
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from botocore.exceptions import ClientError, BotoCoreError
+import requests
+
+from cancellation import RequestCancelled
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SECONDS = float(os.getenv('LABRAT_BREAKER_WINDOW_SECONDS', '60'))
+MIN_CALLS = int(os.getenv('LABRAT_BREAKER_MIN_CALLS', '5'))
+FAILURE_RATIO = float(os.getenv('LABRAT_BREAKER_FAILURE_RATIO', '0.5'))
+OPEN_SECONDS = float(os.getenv('LABRAT_BREAKER_OPEN_SECONDS', '30'))
+MAX_OPEN_SECONDS = 300
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+# Bedrock error codes that mean "the service is struggling", as opposed to a bad request
+# Compared case-insensitively: errors raised mid-stream (EventStreamError) use lower-camel codes such as
+# 'throttlingException'
+UPSTREAM_ERROR_CODES = {
+    'throttlingexception', 'serviceunavailableexception', 'internalserverexception',
+    'modeltimeoutexception', 'modelnotreadyexception', 'servicequotaexceededexception',
+    'modelstreamerrorexception',
+}
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose breaker is open"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is temporarily unavailable (circuit open, retry in {retry_after:.0f}s)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class ServerOverloaded(Exception):
+    """This server has more work queued than it can start soon; the upstream itself is fine"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_upstream_failure(exc):
+    """Whether an exception says the upstream is unhealthy (and should count against its breaker)"""
+    if isinstance(exc, CircuitOpenError):
+        return True
+    if isinstance(exc, ClientError):
+        error = exc.response.get('Error', {})
+        status = exc.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return (error.get('Code') or '').lower() in UPSTREAM_ERROR_CODES or status >= 500 or status == 429
+    return isinstance(exc, (BotoCoreError, requests.exceptions.RequestException, TimeoutError, ConnectionError))
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker over a rolling window of outcomes"""
+
+    def __init__(self, name, window_seconds=WINDOW_SECONDS, min_calls=MIN_CALLS, failure_ratio=FAILURE_RATIO,
+                 open_seconds=OPEN_SECONDS, is_failure=is_upstream_failure, is_failed_result=None):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.base_open_seconds = open_seconds
+        self.open_seconds = open_seconds
+        self.is_failure = is_failure
+        self.is_failed_result = is_failed_result
+        self.state = CLOSED
+        self.opened_at = None
+        self.rejected = 0
+        self.trips = 0
+        self._outcomes = deque()
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        while self._outcomes and self._outcomes[0][0] < now - self.window_seconds:
+            self._outcomes.popleft()
+
+    def allow(self):
+        """Raise CircuitOpenError unless a call may go through now"""
+        with self._lock:
+            now = time.time()
+            if self.state == OPEN:
+                remaining = self.opened_at + self.open_seconds - now
+                if remaining > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, remaining)
+                self.state = HALF_OPEN
+                logger.info(f"Circuit {self.name} half-open, sending a probe")
+            if self.state == HALF_OPEN:
+                if self._probe_in_flight:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, 1.0)
+                self._probe_in_flight = True
+
+    def record(self, ok):
+        with self._lock:
+            now = time.time()
+            if self.state == HALF_OPEN:
+                self._probe_in_flight = False
+                if ok:
+                    self.state = CLOSED
+                    self.open_seconds = self.base_open_seconds
+                    self._outcomes.clear()
+                    logger.info(f"Circuit {self.name} closed")
+                else:
+                    self._trip(now, min(self.open_seconds * 2, MAX_OPEN_SECONDS))
+                return
+
+            self._outcomes.append((now, ok))
+            self._prune(now)
+            failures = sum(1 for _, outcome in self._outcomes if not outcome)
+            if (self.state == CLOSED and len(self._outcomes) >= self.min_calls
+                    and failures / len(self._outcomes) >= self.failure_ratio):
+                self._trip(now, self.base_open_seconds)
+
+    def release_probe(self):
+        """Give up a half-open probe without recording an outcome, so the next call can probe instead"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def _trip(self, now, open_seconds):
+        self.state = OPEN
+        self.opened_at = now
+        self.open_seconds = open_seconds
+        self.trips += 1
+        logger.warning(f"Circuit {self.name} opened for {open_seconds:.0f}s")
+
+    def call(self, function, *args, **kwargs):
+        """Run function through the breaker; upstream failures are recorded and re-raised"""
+        self.allow()
+        try:
+            result = function(*args, **kwargs)
+        except RequestCancelled:
+            # The caller gave up - no verdict on the upstream, but a half-open probe must not stay claimed
+            self.release_probe()
+            raise
+        except Exception as e:
+            # Our own mistakes (bad request, bad image) say nothing about the upstream's health
+            self.record(not self.is_failure(e))
+            raise
+        self.record(not (self.is_failed_result and self.is_failed_result(result)))
+        return result
+
+    def available(self):
+        """False while open and cooling down (no exception, no counters touched)"""
+        with self._lock:
+            return self.state != OPEN or time.time() >= self.opened_at + self.open_seconds
+
+    def snapshot(self):
+        with self._lock:
+            self._prune(time.time())
+            failures = sum(1 for _, outcome in self._outcomes if not outcome)
+            return {
+                "state": self.state,
+                "window_calls": len(self._outcomes),
+                "window_failures": failures,
+                "trips": self.trips,
+                "rejected": self.rejected,
+                "retry_after": round(max(0.0, self.opened_at + self.open_seconds - time.time()), 1) if self.state == OPEN else 0,
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(name, **options):
+    """The shared breaker for an upstream (created on first use)"""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, **options)
+        return _breakers[name]
+
+def breaker_states():
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.snapshot() for breaker in breakers}
+
+
+class GuardedBedrockClient:
+    """Wraps a bedrock-runtime client so every converse call goes through the breaker for its model id"""
+
+    def __init__(self, client):
+        self._client = client
+
+    def converse(self, **kwargs):
+        return get_breaker(f"bedrock:{kwargs.get('modelId')}").call(self._client.converse, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def upstream_error(message, exc):
+    """Error result for a failed model call; outages are marked so the server can degrade and answer 503,
+    cancellations so it does not retry them"""
+    result = {"error": message}
+    if isinstance(exc, RequestCancelled):
+        result.update(error=str(exc), cancelled=True)
+    elif isinstance(exc, (CircuitOpenError, ServerOverloaded)):
+        result.update(error=str(exc), unavailable=True, retry_after=round(exc.retry_after))
+    elif is_upstream_failure(exc):
+        result.update(unavailable=True, retry_after=5)
+    return result
@@ -0,0 +1,371 @@
+"""Tabular experiment data (CSV/TSV/XLSX) parsed into NumPy columns and profiled locally.
+
+The model only sees a compact statistical profile plus a small sample; the full dataset is stored under
+data/datasets and loaded into the generated notebook as a DataFrame named `df`.
+"""
+import base64
+import csv
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from analysis_cache import DATA_DIR, is_analysis_id
+
+DATASET_DIR = os.path.join(DATA_DIR, 'datasets')
+
+TABULAR_TYPES = {
+    'text/csv': 'csv',
+    'application/csv': 'csv',
+    'text/tab-separated-values': 'tsv',
+    'application/vnd.ms-excel': 'csv',  # What Windows browsers report for .csv
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': 'xlsx',
+}
+TABULAR_EXTENSIONS = {'.csv': 'csv', '.tsv': 'tsv', '.xlsx': 'xlsx'}
+
+CHUNK_ROWS = 65536
+MAX_ROWS = 2000000
+MAX_PROFILE_COLUMNS = 40
+SAMPLE_ROWS = 8
+# Share of non-blank values that may fail to parse before a column is treated as text
+MAX_BAD_NUMERIC_FRACTION = 0.05
+MISSING_VALUES = {'', 'na', 'n/a', 'nan', 'null', 'none', '-'}
+# Tables up to this many rows whose compressed CSV fits in EMBED_LIMIT_BYTES are embedded in the load cell
+EMBED_MAX_ROWS = 20000
+EMBED_LIMIT_BYTES = 150 * 1024
+# Column names that usually hold the independent variable
+INDEPENDENT_NAMES = ('time', 't', 'x', 'trial', 'step', 'distance', 'length', 'angle')
+
+def tabular_format(file_type, filename=None):
+    """'csv', 'tsv' or 'xlsx' for tabular uploads, otherwise None"""
+    if filename:
+        extension = os.path.splitext(filename)[1].lower()
+        if extension in TABULAR_EXTENSIONS:
+            return TABULAR_EXTENSIONS[extension]
+    return TABULAR_TYPES.get(file_type)
+
+def _parse_numeric(values):
+    """Vectorized float conversion with a per-value fallback for blanks and typos; returns (array, failures)"""
+    try:
+        return np.array(values, dtype=np.float64), 0
+    except ValueError:
+        pass
+    out = np.full(len(values), np.nan)
+    failures = 0
+    for i, value in enumerate(values):
+        value = value.strip()
+        if value.lower() in MISSING_VALUES:
+            continue
+        try:
+            out[i] = float(value)
+        except ValueError:
+            failures += 1
+    return out, failures
+
+
+class _ColumnBuilder:
+    """Accumulates one column chunk by chunk, switching from numeric to text if too many values fail to parse"""
+
+    def __init__(self, name):
+        self.name = name
+        self.numeric = True
+        self.chunks = []
+
+    def add(self, values):
+        if self.numeric:
+            parsed, failures = _parse_numeric(values)
+            if not failures or failures <= MAX_BAD_NUMERIC_FRACTION * max(1, np.count_nonzero(~np.isnan(parsed)) + failures):
+                self.chunks.append(parsed)
+                return
+            # Earlier chunks parsed as numbers; turn them back into strings
+            self.numeric = False
+            self.chunks = [np.where(np.isnan(chunk), '', chunk.astype(str)) for chunk in self.chunks]
+        self.chunks.append(np.array([v.strip() for v in values], dtype=str))
+
+    def finish(self):
+        if not self.chunks:
+            return np.array([], dtype=np.float64 if self.numeric else str)
+        return np.concatenate(self.chunks)
+
+
+def _row_chunks(rows, width):
+    """Group an iterator of rows into column-major chunks, padding/truncating ragged rows"""
+    chunk = []
+    for count, row in enumerate(rows):
+        if count >= MAX_ROWS:
+            raise ValueError(f"Tables are limited to {MAX_ROWS} rows")
+        if len(row) != width:
+            row = (list(row) + [''] * width)[:width]
+        chunk.append(row)
+        if len(chunk) >= CHUNK_ROWS:
+            yield [list(col) for col in zip(*chunk)]
+            chunk = []
+    if chunk:
+        yield [list(col) for col in zip(*chunk)]
+
+def _csv_rows(data, delimiter=None):
+    text = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig', errors='replace', newline='')
+    if delimiter is None:
+        head = data[:65536].decode('utf-8', errors='replace')
+        try:
+            delimiter = csv.Sniffer().sniff(head, delimiters=',;\t|').delimiter
+        except csv.Error:
+            delimiter = ','
+    return csv.reader(text, delimiter=delimiter)
+
+def _xlsx_rows(data):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ValueError("XLSX support needs openpyxl (pip install openpyxl)")
+    workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    sheet = workbook.worksheets[0]
+    for row in sheet.iter_rows(values_only=True):
+        if any(value is not None for value in row):
+            yield ['' if value is None else str(value) for value in row]
+    workbook.close()
+
+def _looks_like_header(row):
+    return any(cell.strip() and _parse_numeric([cell])[1] for cell in row)
+
+def read_table(data, table_format):
+    """Stream-parse a table into an ordered {name: ndarray}; numeric columns are float64 with NaN for missing"""
+    rows = _xlsx_rows(data) if table_format == 'xlsx' else _csv_rows(data, '\t' if table_format == 'tsv' else None)
+    rows = filter(None, rows)  # csv yields [] for blank lines
+
+    first = next(rows, None)
+    if first is None:
+        raise ValueError("The file has no rows")
+    if _looks_like_header(first):
+        names = [cell.strip() or f"column_{i + 1}" for i, cell in enumerate(first)]
+        pending = []
+    else:
+        names = [f"column_{i + 1}" for i in range(len(first))]
+        pending = [first]
+    # Duplicate headers would collide in the DataFrame
+    seen = {}
+    for i, name in enumerate(names):
+        seen[name] = seen.get(name, 0) + 1
+        if seen[name] > 1:
+            names[i] = f"{name}_{seen[name]}"
+
+    builders = [_ColumnBuilder(name) for name in names]
+    row_count = 0
+    for chunk in _row_chunks(itertools.chain(pending, rows), len(names)):
+        row_count += len(chunk[0])
+        for builder, values in zip(builders, chunk):
+            builder.add(values)
+    return {builder.name: builder.finish() for builder in builders}, row_count
+
+def _fit(x, y):
+    """Least-squares fits of y against x; returns {model: {"params", "r2"}} for the models that apply"""
+    mask = np.isfinite(x) & np.isfinite(y)
+    x, y = x[mask], y[mask]
+    if len(x) < 3 or np.ptp(x) == 0:
+        return {}
+    total = np.sum((y - y.mean()) ** 2) or 1e-12
+
+    def r2(predicted):
+        return float(1 - np.sum((y - predicted) ** 2) / total)
+
+    fits = {}
+    linear = np.polyfit(x, y, 1)
+    fits["linear"] = {"params": linear.tolist(), "r2": r2(np.polyval(linear, x))}
+    if len(x) >= 4:
+        quadratic = np.polyfit(x, y, 2)
+        fits["quadratic"] = {"params": quadratic.tolist(), "r2": r2(np.polyval(quadratic, x))}
+    if np.all(y > 0):
+        slope, intercept = np.polyfit(x, np.log(y), 1)
+        fits["exponential"] = {"params": [float(np.exp(intercept)), float(slope)], "r2": r2(np.exp(intercept) * np.exp(slope * x))}
+        if np.all(x > 0):
+            power, log_a = np.polyfit(np.log(x), np.log(y), 1)
+            fits["power"] = {"params": [float(np.exp(log_a)), float(power)], "r2": r2(np.exp(log_a) * x ** power)}
+    return fits
+
+def profile_table(columns, row_count):
+    """Summary statistics, outliers, correlations and fits for the numeric columns (vectorized across columns)"""
+    numeric = [name for name, values in columns.items() if values.dtype.kind == 'f']
+    text = [name for name in columns if name not in numeric]
+    profile = {"rows": row_count, "columns": list(columns), "numeric": {}, "text": {}, "fits": {}, "correlations": []}
+
+    if numeric and row_count:
+        matrix = np.column_stack([columns[name] for name in numeric])
+        finite = np.isfinite(matrix)
+        counts = finite.sum(axis=0)
+        usable = counts > 0
+        with np.errstate(all='ignore'):
+            safe = np.where(finite, matrix, np.nan)
+            means = np.nanmean(safe[:, usable], axis=0) if usable.any() else []
+            stds = np.nanstd(safe[:, usable], axis=0) if usable.any() else []
+            quantiles = np.nanpercentile(safe[:, usable], [0, 25, 50, 75, 100], axis=0) if usable.any() else []
+
+        for j, name in enumerate(np.array(numeric)[usable]):
+            q0, q1, q2, q3, q4 = quantiles[:, j]
+            iqr = q3 - q1
+            column = safe[:, numeric.index(name)]
+            outliers = np.flatnonzero((column < q1 - 1.5 * iqr) | (column > q3 + 1.5 * iqr))
+            profile["numeric"][name] = {
+                "count": int(counts[numeric.index(name)]),
+                "missing": int(row_count - counts[numeric.index(name)]),
+                "mean": float(means[j]), "std": float(stds[j]),
+                "min": float(q0), "p25": float(q1), "median": float(q2), "p75": float(q3), "max": float(q4),
+                "outliers": int(len(outliers)),
+                "outlier_rows": outliers[:5].tolist(),
+            }
+
+        usable_names = list(profile["numeric"])
+        if len(usable_names) > 1:
+            stacked = np.column_stack([columns[name] for name in usable_names])
+            complete = stacked[np.all(np.isfinite(stacked), axis=1)]
+            if len(complete) > 2:
+                with np.errstate(all='ignore'):
+                    corr = np.corrcoef(complete, rowvar=False)
+                pairs = [
+                    (usable_names[a], usable_names[b], float(corr[a, b]))
+                    for a in range(len(usable_names)) for b in range(a + 1, len(usable_names))
+                    if np.isfinite(corr[a, b])
+                ]
+                profile["correlations"] = sorted(pairs, key=lambda p: -abs(p[2]))[:10]
+
+            x_name = next((name for name in usable_names if name.lower().split(' ')[0].strip('()[]') in INDEPENDENT_NAMES), usable_names[0])
+            profile["independent"] = x_name
+            for name in usable_names[:MAX_PROFILE_COLUMNS]:
+                if name != x_name:
+                    profile["fits"][name] = _fit(columns[x_name], columns[name])
+
+    for name in text[:MAX_PROFILE_COLUMNS]:
+        values, counts = np.unique(columns[name][columns[name] != ''], return_counts=True)
+        top = np.argsort(-counts)[:5]
+        profile["text"][name] = {"unique": int(len(values)), "top": [[str(values[i]), int(counts[i])] for i in top]}
+    return profile
+
+def sample_rows(columns, row_count, limit=SAMPLE_ROWS):
+    """First rows plus evenly spaced rows from the rest, as CSV text"""
+    if row_count <= limit:
+        indices = np.arange(row_count)
+    else:
+        indices = np.unique(np.concatenate([np.arange(limit // 2), np.linspace(limit // 2, row_count - 1, limit - limit // 2).astype(int)]))
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for i in indices:
+        writer.writerow([_format_value(values[i]) for values in columns.values()])
+    return buffer.getvalue()
+
+def _format_value(value):
+    if isinstance(value, (float, np.floating)):
+        return '' if np.isnan(value) else f"{value:.6g}"
+    return str(value)
+
+def profile_to_text(profile, sample):
+    """Compact plain-text rendering of a profile for the model prompt"""
+    lines = [f"Rows: {profile['rows']}, columns: {len(profile['columns'])}"]
+    for name, stats in list(profile["numeric"].items())[:MAX_PROFILE_COLUMNS]:
+        lines.append(
+            f"- {name}: mean={stats['mean']:.4g} std={stats['std']:.4g} min={stats['min']:.4g} "
+            f"median={stats['median']:.4g} max={stats['max']:.4g} missing={stats['missing']} outliers={stats['outliers']}"
+        )
+    for name, stats in profile["text"].items():
+        top = ", ".join(f"{value} ({count})" for value, count in stats["top"])
+        lines.append(f"- {name} (text): {stats['unique']} distinct; most common: {top}")
+    if profile["fits"]:
+        lines.append(f"Fits against {profile['independent']}:")
+        for name, fits in profile["fits"].items():
+            if fits:
+                best = max(fits, key=lambda model: fits[model]["r2"])
+                summary = ", ".join(f"{model} R2={fit['r2']:.3f}" for model, fit in fits.items())
+                params = ", ".join(f"{p:.4g}" for p in fits[best]["params"])
+                lines.append(f"- {name}: {summary}; best {best} params [{params}]")
+    if profile["correlations"]:
+        lines.append("Strongest correlations: " + ", ".join(f"{a}~{b} r={r:.2f}" for a, b, r in profile["correlations"][:5]))
+    lines.append(f"Sample rows:\n{sample}")
+    return "\n".join(lines)
+
+def _dataset_path(dataset_id):
+    if not is_analysis_id(dataset_id):
+        raise ValueError(f"Invalid dataset id: {str(dataset_id)[:80]}")
+    return os.path.join(DATASET_DIR, dataset_id[:2], f"{dataset_id}.npz")
+
+def save_dataset(dataset_id, columns):
+    """Store the full parsed table so later cells and requests can use it without re-uploading"""
+    path = _dataset_path(dataset_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, __columns__=np.array(json.dumps(list(columns))),
+                                **{f"c{i}": values for i, values in enumerate(columns.values())})
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+def load_dataset(dataset_id):
+    """Return the stored {name: ndarray} for a dataset, or None"""
+    try:
+        with np.load(_dataset_path(dataset_id)) as stored:
+            names = json.loads(str(stored["__columns__"]))
+            return {name: stored[f"c{i}"] for i, name in enumerate(names)}
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+
+def dataset_to_csv(columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in zip(*columns.values()):
+        writer.writerow([_format_value(value) for value in row])
+    return buffer.getvalue()
+
+def load_cell(dataset):
+    """Notebook cell that recreates the DataFrame `df` (embedded when small enough)"""
+    columns = load_dataset(dataset["id"]) if dataset["rows"] <= EMBED_MAX_ROWS else None
+    compressed = gzip.compress(dataset_to_csv(columns).encode('utf-8')) if columns else b''
+    if columns and len(compressed) <= EMBED_LIMIT_BYTES:
+        code = "\n".join([
+            "# Cell 1: Load your experiment data",
+            "import base64, gzip, io",
+            "import pandas as pd",
+            "",
+            f"# {dataset['filename']}: {dataset['rows']} rows, embedded so the notebook is self-contained",
+            f"_data = \"{base64.b64encode(compressed).decode('ascii')}\"",
+            "df = pd.read_csv(io.BytesIO(gzip.decompress(base64.b64decode(_data))))",
+            "print(df.shape)",
+            "df.head()",
+        ])
+    else:
+        code = "\n".join([
+            "# Cell 1: Load your experiment data",
+            "import pandas as pd",
+            "from snowflake.snowpark.context import get_active_session",
+            "",
+            f"# TODO: {dataset['filename']} ({dataset['rows']} rows) is too large to embed - load it into a Snowflake table first",
+            "session = get_active_session()",
+            "df = session.table(\"EXPERIMENT_DATA\").to_pandas()",
+            "print(df.shape)",
+            "df.head()",
+        ])
+    return {"cell_type": "code", "language": "python", "description": "Load your experiment data", "code": code, "cell_number": 1}
+
+def ingest_table(data, table_format, filename=None):
+    """Parse, profile and store an uploaded table; returns the dataset summary used by the analysis"""
+    dataset_id = hashlib.sha256(data).hexdigest()
+    columns, row_count = read_table(data, table_format)
+    if row_count == 0:
+        raise ValueError("The table has a header but no data rows")
+    save_dataset(dataset_id, columns)
+
+    profile = profile_table(columns, row_count)
+    return {
+        "id": dataset_id,
+        "filename": filename or f"data.{table_format}",
+        "rows": row_count,
+        "columns": list(columns),
+        "profile": profile,
+        "profile_text": profile_to_text(profile, sample_rows(columns, row_count)),
+    }
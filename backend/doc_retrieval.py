@@ -0,0 +1,310 @@
+"""Chunk extracted documents and retrieve only the parts relevant to the student's question.
+
+A document's blocks (see document_extract.py) are packed into section-aware chunks of about CHUNK_CHARS
+characters; headings start new chunks and every chunk remembers its heading path. Chunks are indexed with
+BM25 in NumPy (postings sorted by term, scored with np.add.at) and, when an embedding model is configured,
+a flat matrix of normalized embeddings searched with one matrix-vector product. The two rankings are merged
+with reciprocal rank fusion. Indexes are cached in the artifact store under the document's hash.
+
+    LABRAT_EMBEDDINGS=sentence-transformers LABRAT_EMBEDDING_MODEL=all-MiniLM-L6-v2 python server.py
+"""
+import io
+import json
+import logging
+import os
+import re
+
+import numpy as np
+
+from artifact_store import artifact_store
+from document_extract import block_to_text
+
+logger = logging.getLogger(__name__)
+
+CHUNK_CHARS = int(os.getenv('LABRAT_CHUNK_CHARS', '1500'))
+# Documents shorter than this are sent whole; longer ones are reduced to their top chunks
+CONTEXT_CHARS = int(os.getenv('LABRAT_CONTEXT_CHARS', '8000'))
+TOP_K = int(os.getenv('LABRAT_RETRIEVAL_TOP_K', '6'))
+INDEX_VERSION = 1
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60
+
+# Used when the upload comes without a question: what a lab-report analysis usually needs
+DEFAULT_QUERY = "experiment procedure measurements data results equations model analysis uncertainty error"
+
+STOPWORDS = set("""a an and are as at be by for from has have in is it its of on or that the this to was were
+will with which what when where how why do does can you your we our they their these those then than into""".split())
+
+EMBEDDERS = {}
+
+def register_embedder(name, factory):
+    """Make an embedding model available under a name selectable with LABRAT_EMBEDDINGS"""
+    EMBEDDERS[name] = factory
+
+def _sentence_transformers():
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(os.getenv('LABRAT_EMBEDDING_MODEL', 'all-MiniLM-L6-v2'), device='cpu')
+
+    def embed(texts):
+        return np.asarray(model.encode(texts, batch_size=32, normalize_embeddings=True), dtype=np.float32)
+    embed.name = f"sentence-transformers:{os.getenv('LABRAT_EMBEDDING_MODEL', 'all-MiniLM-L6-v2')}"
+    return embed
+
+register_embedder('sentence-transformers', _sentence_transformers)
+
+_embedder = None
+_embedder_loaded = False
+
+def get_embedder():
+    """The configured embedding function (texts -> normalized float32 rows), or None for BM25 only"""
+    global _embedder, _embedder_loaded
+    if not _embedder_loaded:
+        _embedder_loaded = True
+        name = os.getenv('LABRAT_EMBEDDINGS')
+        if name:
+            try:
+                _embedder = EMBEDDERS[name]()
+            except Exception as e:
+                logger.warning(f"Embedding model '{name}' unavailable, using BM25 only: {e}")
+    return _embedder
+
+
+# --- Chunking ---
+
+def tokenize(text):
+    """Lowercase word tokens without stopwords, with plural/verb suffixes stripped"""
+    tokens = []
+    for word in re.findall(r'[a-z0-9]+', text.lower()):
+        if word in STOPWORDS:
+            continue
+        for suffix in ('ing', 'ed', 'es', 's'):
+            if len(word) > len(suffix) + 3 and word.endswith(suffix):
+                word = word[:-len(suffix)]
+                break
+        tokens.append(word)
+    return tokens
+
+def _split_block_text(text, limit):
+    """Split an oversized paragraph (or rendered table) at sentence or line boundaries"""
+    pieces = re.split(r'(?<=[.!?])\s+|\n', text)
+    current = ''
+    for piece in pieces:
+        while len(piece) > limit:
+            if current:
+                yield current
+                current = ''
+            yield piece[:limit]
+            piece = piece[limit:]
+        if current and len(current) + len(piece) + 1 > limit:
+            yield current
+            current = ''
+        current = f"{current} {piece}".strip() if current else piece
+    if current:
+        yield current
+
+def _table_pieces(rows, limit):
+    """Render a table in row groups that fit the chunk size, repeating the header row in each"""
+    header, body = rows[:1], rows[1:]
+    group = []
+    for row in body or header:
+        candidate = block_to_text({"type": "table", "rows": header + group + [row]})
+        if group and len(candidate) > limit:
+            yield block_to_text({"type": "table", "rows": header + group})
+            group = []
+        group.append(row)
+    yield block_to_text({"type": "table", "rows": header + group if body else group})
+
+def chunk_blocks(blocks, chunk_chars=CHUNK_CHARS):
+    """Pack blocks into chunks: {"index", "heading", "text", "page"}; headings always start a new chunk"""
+    chunks = []
+    headings = []
+    current, current_page = [], None
+
+    def flush():
+        if current:
+            chunks.append({
+                "index": len(chunks),
+                "heading": " > ".join(text for _, text in headings),
+                "text": "\n\n".join(current),
+                "page": current_page,
+            })
+            current.clear()
+
+    for block in blocks:
+        if block["type"] == "heading":
+            flush()
+            headings = [(level, text) for level, text in headings if level < block["level"]] + [(block["level"], block["text"])]
+            continue
+        if block["type"] == "table":
+            pieces = list(_table_pieces(block["rows"], chunk_chars))
+        else:
+            text = block_to_text(block)
+            pieces = [text] if len(text) <= chunk_chars else list(_split_block_text(text, chunk_chars))
+        for piece in pieces:
+            if current and sum(len(part) + 2 for part in current) + len(piece) > chunk_chars:
+                flush()
+            if not current:
+                current_page = block.get("page")
+            current.append(piece)
+    flush()
+    return chunks
+
+
+# --- Index ---
+
+class DocumentIndex:
+    """BM25 postings (plus optional dense embeddings) over one document's chunks"""
+
+    def __init__(self, chunks, vocabulary, postings_doc, postings_tf, term_offsets, doc_lengths, embeddings=None, embedder_name=None):
+        self.chunks = chunks
+        self.vocabulary = vocabulary
+        self.term_ids = {term: i for i, term in enumerate(vocabulary)}
+        self.postings_doc = postings_doc
+        self.postings_tf = postings_tf
+        self.term_offsets = term_offsets
+        self.doc_lengths = doc_lengths
+        self.embeddings = embeddings
+        self.embedder_name = embedder_name
+        document_frequency = np.diff(term_offsets).astype(np.float64)
+        self.idf = np.log1p((len(chunks) - document_frequency + 0.5) / (document_frequency + 0.5))
+        self.average_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+
+    @classmethod
+    def build(cls, chunks, embedder=None):
+        term_ids = {}
+        doc_ids, tids, counts, lengths = [], [], [], []
+        for doc_id, chunk in enumerate(chunks):
+            tokens = tokenize(f"{chunk['heading']} {chunk['text']}")
+            lengths.append(len(tokens))
+            ids = np.fromiter((term_ids.setdefault(token, len(term_ids)) for token in tokens), dtype=np.int64, count=len(tokens))
+            unique, tf = np.unique(ids, return_counts=True)
+            doc_ids.append(np.full(len(unique), doc_id, dtype=np.int32))
+            tids.append(unique)
+            counts.append(tf.astype(np.float32))
+
+        if chunks:
+            doc_ids, tids, counts = np.concatenate(doc_ids), np.concatenate(tids), np.concatenate(counts)
+        else:
+            doc_ids, tids, counts = np.zeros(0, np.int32), np.zeros(0, np.int64), np.zeros(0, np.float32)
+        order = np.argsort(tids, kind='stable')
+        term_offsets = np.zeros(len(term_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(tids, minlength=len(term_ids)), out=term_offsets[1:])
+
+        vocabulary = [None] * len(term_ids)
+        for term, i in term_ids.items():
+            vocabulary[i] = term
+
+        embeddings = None
+        if embedder is not None and chunks:
+            embeddings = embedder([f"{chunk['heading']}\n{chunk['text']}" for chunk in chunks])
+        return cls(chunks, vocabulary, doc_ids[order], counts[order], term_offsets, np.array(lengths, dtype=np.float32),
+                   embeddings, getattr(embedder, 'name', None))
+
+    def bm25(self, query):
+        scores = np.zeros(len(self.chunks), dtype=np.float64)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths / max(self.average_length, 1e-9))
+        for term in set(tokenize(query)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            docs, tf = self.postings_doc[start:end], self.postings_tf[start:end]
+            np.add.at(scores, docs, self.idf[term_id] * tf * (BM25_K1 + 1) / (tf + norm[docs]))
+        return scores
+
+    def search(self, query, k=TOP_K, embedder=None):
+        """Top-k chunk positions, best first (BM25, fused with dense similarity when embeddings exist)"""
+        if not self.chunks:
+            return []
+        bm25 = self.bm25(query)
+        if self.embeddings is not None and embedder is not None:
+            dense = self.embeddings @ embedder([query])[0]
+            fused = np.zeros(len(self.chunks))
+            for scores in (bm25, dense):
+                ranks = np.empty(len(scores), dtype=np.int64)
+                ranks[np.argsort(-scores, kind='stable')] = np.arange(len(scores))
+                fused += 1.0 / (RRF_K + ranks + 1)
+            return [int(i) for i in np.argsort(-fused, kind='stable')[:k]]
+        ranked = np.argsort(-bm25, kind='stable')[:k]
+        return [int(i) for i in ranked if bm25[i] > 0] or [int(i) for i in ranked]
+
+    def to_bytes(self):
+        buffer = io.BytesIO()
+        arrays = {
+            "chunks": np.array(json.dumps(self.chunks)),
+            "vocabulary": np.array(json.dumps(self.vocabulary)),
+            "postings_doc": self.postings_doc,
+            "postings_tf": self.postings_tf,
+            "term_offsets": self.term_offsets,
+            "doc_lengths": self.doc_lengths,
+        }
+        if self.embeddings is not None:
+            arrays["embeddings"] = self.embeddings
+            arrays["embedder_name"] = np.array(self.embedder_name or '')
+        np.savez_compressed(buffer, **arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            return cls(
+                json.loads(str(arrays["chunks"])),
+                json.loads(str(arrays["vocabulary"])),
+                arrays["postings_doc"], arrays["postings_tf"], arrays["term_offsets"], arrays["doc_lengths"],
+                arrays["embeddings"] if "embeddings" in arrays else None,
+                str(arrays["embedder_name"]) if "embedder_name" in arrays else None,
+            )
+
+def _cache_kind(embedder):
+    return f"doc_index:v{INDEX_VERSION}:{CHUNK_CHARS}:{getattr(embedder, 'name', 'bm25')}"
+
+def document_index(source_hash, blocks, store=artifact_store):
+    """The retrieval index for a document, built once and cached under its hash"""
+    embedder = get_embedder()
+    kind = _cache_kind(embedder)
+    cached = store.get_derived(source_hash, kind)
+    if cached is not None:
+        return DocumentIndex.from_bytes(cached)
+
+    index = DocumentIndex.build(chunk_blocks(blocks), embedder)
+    try:
+        store.put_derived(source_hash, kind, index.to_bytes(), 'application/x-npz')
+    except Exception as e:
+        logger.warning(f"Could not cache document index: {e}")
+    return index
+
+def select_context(extraction, source_hash, question=None, context_chars=CONTEXT_CHARS, k=TOP_K):
+    """Prompt context for a document: the whole text when it fits, otherwise the top-k chunks for the question
+
+    Returns {"text", "retrieved": bool, "chunks": [indexes sent], "total_chunks"}.
+    """
+    if len(extraction["text"]) <= context_chars:
+        return {"text": extraction["text"], "retrieved": False, "chunks": [], "total_chunks": None}
+
+    index = document_index(source_hash, extraction["blocks"])
+    selected, used = [], 0
+    for position in index.search(question or DEFAULT_QUERY, k=k, embedder=get_embedder()):
+        chunk = index.chunks[position]
+        size = len(chunk["text"]) + len(chunk["heading"]) + 20
+        if selected and used + size > context_chars:
+            continue
+        selected.append(chunk)
+        used += size
+
+    # Reading order reads better than relevance order
+    selected.sort(key=lambda chunk: chunk["index"])
+    sections = []
+    for chunk in selected:
+        location = f"Section: {chunk['heading']}" if chunk["heading"] else f"Part {chunk['index'] + 1}"
+        if chunk.get("page"):
+            location += f" (page {chunk['page']})"
+        sections.append(f"[{location}]\n{chunk['text']}")
+    return {
+        "text": "\n\n".join(sections),
+        "retrieved": True,
+        "chunks": [chunk["index"] for chunk in selected],
+        "total_chunks": len(index.chunks),
+    }
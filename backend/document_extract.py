@@ -0,0 +1,415 @@
+"""Text extraction for DOCX, PDF and plain-text uploads behind one interface.
+
+Every extractor is a generator of blocks in document order:
+    {"type": "heading", "text": ..., "level": 1}
+    {"type": "paragraph", "text": ...}        inline equations appear as $latex$, list items start with "- "
+    {"type": "equation", "latex": ...}        display equations (Word OMML is converted to LaTeX)
+    {"type": "table", "rows": [[cell, ...], ...]}
+PDF blocks also carry the page number. DOCX is read straight from word/document.xml with iterparse, so body
+elements are handled and released one at a time instead of building python-docx's object tree.
+
+Results are cached under the uploaded file's hash, so re-uploading a handout is free: in the artifact store,
+or in the shared cache when LABRAT_CACHE_URL is set (cache_backends.py).
+"""
+import hashlib
+import io
+import logging
+import re
+import time
+import unicodedata
+import xml.etree.ElementTree as ET
+import zipfile
+
+from PyPDF2 import PdfReader
+
+from artifact_store import artifact_store
+from cache_backends import open_cache, CACHE_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Bump when the block format or the extractors change so cached extractions are recomputed
+EXTRACTOR_VERSION = 1
+CACHE_KIND = f"document_text:v{EXTRACTOR_VERSION}"
+
+DOCUMENT_TYPES = {
+    'application/pdf': 'pdf',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': 'docx',
+    'application/msword': 'docx',
+}
+DOCUMENT_EXTENSIONS = {'.pdf': 'pdf', '.docx': 'docx', '.doc': 'docx', '.txt': 'txt', '.md': 'txt', '.tex': 'txt'}
+
+W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+M = '{http://schemas.openxmlformats.org/officeDocument/2006/math}'
+
+def document_format(file_type, filename=None):
+    """'docx', 'pdf' or 'txt' for document uploads, otherwise None (check tabular_format first for text/csv)"""
+    if filename:
+        extension = re.search(r'\.[^.]+$', filename)
+        if extension and extension.group(0).lower() in DOCUMENT_EXTENSIONS:
+            return DOCUMENT_EXTENSIONS[extension.group(0).lower()]
+    if file_type in DOCUMENT_TYPES:
+        return DOCUMENT_TYPES[file_type]
+    if (file_type or '').startswith('text/'):
+        return 'txt'
+    return None
+
+
+# --- OMML (Word equations) to LaTeX ---
+
+SYMBOLS = {
+    '×': r'\times ', '·': r'\cdot ', '⋅': r'\cdot ', '÷': r'\div ', '±': r'\pm ', '∓': r'\mp ', '−': '-',
+    '≤': r'\leq ', '≥': r'\geq ', '≠': r'\neq ', '≈': r'\approx ', '≡': r'\equiv ', '∝': r'\propto ', '∼': r'\sim ',
+    '∞': r'\infty ', '∂': r'\partial ', '∇': r'\nabla ', 'ℏ': r'\hbar ', '°': r'^\circ ', '′': "'", '″': "''",
+    '→': r'\to ', '←': r'\leftarrow ', '⇒': r'\Rightarrow ', '⇔': r'\Leftrightarrow ', '↔': r'\leftrightarrow ',
+    '∈': r'\in ', '∉': r'\notin ', '⊂': r'\subset ', '⊆': r'\subseteq ', '∪': r'\cup ', '∩': r'\cap ',
+    '∀': r'\forall ', '∃': r'\exists ', '¬': r'\neg ', '∧': r'\wedge ', '∨': r'\vee ', '∅': r'\emptyset ',
+    '…': r'\ldots ', '⋯': r'\cdots ', '∑': r'\sum ', '∏': r'\prod ', '∫': r'\int ', '√': r'\sqrt ',
+    '{': r'\{', '}': r'\}', '%': r'\%', '#': r'\#', '&': '&', '⁡': '', '⁢': '', '⁣': ',',
+}
+
+NARY = {'∑': r'\sum', '∏': r'\prod', '∐': r'\coprod', '∫': r'\int', '∬': r'\iint', '∭': r'\iiint',
+        '∮': r'\oint', '⋃': r'\bigcup', '⋂': r'\bigcap'}
+ACCENTS = {'̂': r'\hat', '̃': r'\tilde', '̄': r'\bar', '̅': r'\bar', '̇': r'\dot',
+           '̈': r'\ddot', '⃗': r'\vec', '⃑': r'\vec'}
+DELIMITERS = {'{': r'\{', '}': r'\}', '⌈': r'\lceil', '⌉': r'\rceil', '⌊': r'\lfloor', '⌋': r'\rfloor',
+              '⟨': r'\langle', '⟩': r'\rangle', '‖': r'\|', '': '.'}
+FUNCTIONS = {'sin', 'cos', 'tan', 'cot', 'sec', 'csc', 'arcsin', 'arccos', 'arctan', 'sinh', 'cosh', 'tanh',
+             'log', 'ln', 'exp', 'lim', 'max', 'min', 'det', 'sup', 'inf'}
+
+def _symbol(char):
+    if char in SYMBOLS:
+        return SYMBOLS[char]
+    if char.isascii():
+        return char
+    name = unicodedata.name(char, '')
+    if name.startswith('GREEK'):
+        letter = name.split()[-1].lower().replace('lamda', 'lambda')
+        if 'FINAL' in name:
+            return r'\varsigma '
+        if 'CAPITAL' in name:
+            # Capitals that look like Latin letters have no LaTeX command
+            latex = '\\' + letter.capitalize()
+            return latex + ' ' if letter.capitalize() in ('Gamma', 'Delta', 'Theta', 'Lambda', 'Xi', 'Pi', 'Sigma', 'Upsilon', 'Phi', 'Psi', 'Omega') else char
+        return f"\\{letter} "
+    if name.startswith('MATHEMATICAL') and len(name.split()[-1]) == 1:
+        # Styled letters (math italic x, ...) become plain letters
+        letter = name.split()[-1]
+        return letter if 'CAPITAL' in name else letter.lower()
+    return char
+
+def _val(element, path, default=None):
+    found = element.find(path)
+    if found is None:
+        return default
+    return found.get(M + 'val', default)
+
+def _group(text):
+    text = text.strip()
+    return text if len(text) == 1 else '{' + text + '}'
+
+def _children(element, name):
+    return ''.join(_omml(child) for child in element.findall(M + name))
+
+def _omml(element):
+    tag = element.tag
+    if not tag.startswith(M) or tag.endswith('Pr'):
+        return ''
+    name = tag[len(M):]
+
+    if name == 'r':
+        text = ''.join(t.text or '' for t in element.findall(M + 't'))
+        if element.find(f'{M}rPr/{M}nor') is not None and len(text) > 1:
+            return r'\text{' + text + '}'
+        return ''.join(_symbol(char) for char in text)
+    if name == 'f':
+        num, den = _children(element, 'num'), _children(element, 'den')
+        if _val(element, f'{M}fPr/{M}type') == 'lin':
+            return f"{_group(num)}/{_group(den)}"
+        return r'\frac{' + num.strip() + '}{' + den.strip() + '}'
+    if name in ('sSup', 'sSub', 'sSubSup', 'sPre'):
+        base = _group(_children(element, 'e'))
+        sub, sup = _children(element, 'sub'), _children(element, 'sup')
+        scripts = (f"_{_group(sub)}" if element.find(M + 'sub') is not None else '') + \
+                  (f"^{_group(sup)}" if element.find(M + 'sup') is not None else '')
+        return '{}' + scripts + base if name == 'sPre' else base + scripts
+    if name == 'rad':
+        degree = _children(element, 'deg').strip()
+        radicand = _children(element, 'e').strip()
+        return (r'\sqrt[' + degree + ']{' if degree else r'\sqrt{') + radicand + '}'
+    if name == 'd':
+        begin = _val(element, f'{M}dPr/{M}begChr', '(')
+        end = _val(element, f'{M}dPr/{M}endChr', ')')
+        separator = _val(element, f'{M}dPr/{M}sepChr', '|')
+        inner = f" {_symbol(separator).strip() or separator} ".join(_omml(e).strip() for e in element.findall(M + 'e'))
+        return r'\left' + DELIMITERS.get(begin, begin) + ' ' + inner + r' \right' + DELIMITERS.get(end, end)
+    if name == 'nary':
+        operator = NARY.get(_val(element, f'{M}naryPr/{M}chr', '∫'), r'\int')
+        sub, sup = _children(element, 'sub').strip(), _children(element, 'sup').strip()
+        limits = (f"_{_group(sub)}" if sub else '') + (f"^{_group(sup)}" if sup else '')
+        return f" {operator}{limits} {_children(element, 'e').strip()}"
+    if name == 'func':
+        function = _children(element, 'fName').strip()
+        if function in FUNCTIONS:
+            function = '\\' + function
+        elif function.startswith(r'\text{') and function[6:-1] in FUNCTIONS:
+            function = '\\' + function[6:-1]
+        return f"{function}{_group(_children(element, 'e'))}"
+    if name in ('limLow', 'limUpp'):
+        base = _children(element, 'e').strip()
+        limit = _children(element, 'lim').strip()
+        if base in ('lim', r'\text{lim}'):
+            base = r'\lim'
+        return f"{base}{'_' if name == 'limLow' else '^'}{_group(limit)}"
+    if name == 'acc':
+        accent = ACCENTS.get(_val(element, f'{M}accPr/{M}chr', '̂'), r'\hat')
+        return accent + '{' + _children(element, 'e').strip() + '}'
+    if name == 'bar':
+        command = r'\overline' if _val(element, f'{M}barPr/{M}pos', 'bot') == 'top' else r'\underline'
+        return command + '{' + _children(element, 'e').strip() + '}'
+    if name == 'groupChr':
+        command = r'\overbrace' if _val(element, f'{M}groupChrPr/{M}chr', '⏟') == '⏞' else r'\underbrace'
+        return command + '{' + _children(element, 'e').strip() + '}'
+    if name == 'eqArr':
+        return r'\begin{aligned}' + r' \\ '.join(_omml(e).strip() for e in element.findall(M + 'e')) + r'\end{aligned}'
+    if name == 'm':
+        rows = [' & '.join(_omml(e).strip() for e in row.findall(M + 'e')) for row in element.findall(M + 'mr')]
+        return r'\begin{matrix}' + r' \\ '.join(rows) + r'\end{matrix}'
+    # oMath, e, num, den, sub, sup, box, borderBox, phant, ...: just the content
+    return ''.join(_omml(child) for child in element)
+
+def omml_to_latex(element):
+    """LaTeX for an m:oMath (or m:oMathPara) element"""
+    return re.sub(r'\s+', ' ', _omml(element)).strip()
+
+
+# --- Extractors ---
+
+HEADING_STYLE = re.compile(r'^(?:heading|überschrift|titre|título|kop)\s*(\d)$', re.IGNORECASE)
+
+def _docx_heading_styles(archive):
+    """styleId -> heading level, from word/styles.xml (style ids are localized, style names are not)"""
+    levels = {}
+    try:
+        root = ET.fromstring(archive.read('word/styles.xml'))
+    except (KeyError, ET.ParseError):
+        return levels
+    for style in root.iter(W + 'style'):
+        style_id = style.get(W + 'styleId', '')
+        name_element = style.find(W + 'name')
+        name = name_element.get(W + 'val', '') if name_element is not None else ''
+        for candidate in (name, style_id):
+            match = HEADING_STYLE.match(candidate)
+            if match:
+                levels[style_id] = int(match.group(1))
+                break
+        if name.lower() == 'title' or style_id == 'Title':
+            levels[style_id] = 1
+    return levels
+
+def _paragraph_parts(element, parts):
+    """Collect text, inline LaTeX and display equations of a paragraph in reading order"""
+    for child in element:
+        tag = child.tag
+        if tag == W + 't':
+            parts.append(('text', child.text or ''))
+        elif tag == W + 'tab':
+            parts.append(('text', '\t'))
+        elif tag in (W + 'br', W + 'cr'):
+            parts.append(('text', '\n'))
+        elif tag == M + 'oMathPara':
+            for math in child.iter(M + 'oMath'):
+                parts.append(('display', omml_to_latex(math)))
+        elif tag == M + 'oMath':
+            parts.append(('inline', omml_to_latex(child)))
+        elif tag in (W + 'del', W + 'pPr', W + 'rPr', W + 'instrText'):
+            continue
+        else:
+            # Runs, hyperlinks, insertions, smart tags, content controls
+            _paragraph_parts(child, parts)
+    return parts
+
+def _docx_paragraph(paragraph, heading_styles):
+    parts = _paragraph_parts(paragraph, [])
+    text = ''.join(value if kind == 'text' else f"${value}$" for kind, value in parts if kind != 'display').strip()
+    blocks = []
+    if text:
+        style = paragraph.find(f'{W}pPr/{W}pStyle')
+        style_id = style.get(W + 'val', '') if style is not None else ''
+        level = heading_styles.get(style_id)
+        if level:
+            blocks.append({"type": "heading", "text": text, "level": level})
+        elif paragraph.find(f'{W}pPr/{W}numPr') is not None or style_id.startswith(('ListBullet', 'ListNumber')):
+            blocks.append({"type": "paragraph", "text": f"- {text}"})
+        else:
+            blocks.append({"type": "paragraph", "text": text})
+    blocks.extend({"type": "equation", "latex": value} for kind, value in parts if kind == 'display' and value)
+    return blocks
+
+def _docx_cell_text(cell):
+    paragraphs = []
+    for paragraph in cell.iter(W + 'p'):
+        parts = _paragraph_parts(paragraph, [])
+        text = ''.join(value if kind == 'text' else f"${value}$" for kind, value in parts).strip()
+        if text:
+            paragraphs.append(text)
+    return ' '.join(paragraphs)
+
+def _docx_body_element(element, heading_styles):
+    if element.tag == W + 'p':
+        return _docx_paragraph(element, heading_styles)
+    if element.tag == W + 'tbl':
+        rows = [[_docx_cell_text(cell) for cell in row.findall(W + 'tc')] for row in element.findall(W + 'tr')]
+        rows = [row for row in rows if any(row)]
+        return [{"type": "table", "rows": rows}] if rows else []
+    if element.tag == W + 'sdt':
+        # Block-level content controls (tables of contents, form fields) wrap ordinary paragraphs and tables
+        content = element.find(W + 'sdtContent')
+        return [block for child in (content if content is not None else []) for block in _docx_body_element(child, heading_styles)]
+    return []
+
+def iter_docx_blocks(data):
+    if not zipfile.is_zipfile(io.BytesIO(data)):
+        raise ValueError("Not a .docx file (legacy .doc files are not supported - save as .docx)")
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        heading_styles = _docx_heading_styles(archive)
+        with archive.open('word/document.xml') as document:
+            depth = 0
+            body = None
+            for event, element in ET.iterparse(document, events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    if depth == 2 and element.tag == W + 'body':
+                        body = element
+                    continue
+                depth -= 1
+                if depth == 2 and body is not None:
+                    yield from _docx_body_element(element, heading_styles)
+                    # Drop finished body elements so memory stays flat on long documents
+                    body.clear()
+
+def iter_pdf_blocks(data):
+    reader = PdfReader(io.BytesIO(data))
+    for page_number, page in enumerate(reader.pages, 1):
+        text = page.extract_text() or ''
+        for chunk in re.split(r'\n\s*\n', text):
+            chunk = chunk.strip()
+            if chunk:
+                yield {"type": "paragraph", "text": chunk, "page": page_number}
+
+def _decode_text(data):
+    for encoding in ('utf-8-sig', 'cp1252'):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode('latin-1')
+
+def iter_text_blocks(data):
+    """Blank-line separated paragraphs; Markdown '#' headings and $$...$$ display math are recognized"""
+    text = _decode_text(data).replace('\r\n', '\n').replace('\r', '\n')
+    for chunk in re.split(r'\n\s*\n', text):
+        chunk = chunk.strip()
+        if not chunk:
+            continue
+        heading = re.match(r'^(#{1,6})\s+(.+)$', chunk)
+        if heading and '\n' not in chunk:
+            yield {"type": "heading", "text": heading.group(2).strip(), "level": len(heading.group(1))}
+        elif chunk.startswith('$$') and chunk.endswith('$$') and len(chunk) > 4:
+            yield {"type": "equation", "latex": chunk[2:-2].strip()}
+        else:
+            yield {"type": "paragraph", "text": chunk}
+
+EXTRACTORS = {
+    'docx': iter_docx_blocks,
+    'pdf': iter_pdf_blocks,
+    'txt': iter_text_blocks,
+}
+
+def iter_blocks(data, fmt):
+    """Stream the blocks of a document in reading order"""
+    if fmt not in EXTRACTORS:
+        raise ValueError(f"Unsupported document format: {fmt}")
+    return EXTRACTORS[fmt](data)
+
+def block_to_text(block):
+    if block["type"] == "heading":
+        return f"{'#' * block['level']} {block['text']}"
+    if block["type"] == "equation":
+        return f"$$ {block['latex']} $$"
+    if block["type"] == "table":
+        return '\n'.join('| ' + ' | '.join(cell.replace('|', '/') for cell in row) + ' |' for row in block["rows"])
+    return block["text"]
+
+def blocks_to_text(blocks):
+    """Markdown-like text for the prompt: headings, pipe tables and $$ equations keep the document's structure"""
+    return '\n\n'.join(block_to_text(block) for block in blocks)
+
+def extract_document(data, fmt):
+    """Extract all blocks plus their rendered text and counts"""
+    started = time.perf_counter()
+    blocks = list(iter_blocks(data, fmt))
+    text = blocks_to_text(blocks)
+    counts = {}
+    for block in blocks:
+        counts[block["type"]] = counts.get(block["type"], 0) + 1
+    return {
+        "format": fmt,
+        "blocks": blocks,
+        "text": text,
+        "stats": {
+            "bytes": len(data),
+            "blocks": len(blocks),
+            "paragraphs": counts.get("paragraph", 0),
+            "headings": counts.get("heading", 0),
+            "tables": counts.get("table", 0),
+            "equations": counts.get("equation", 0),
+            "chars": len(text),
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        },
+    }
+
+
+class DerivedBlobBackend:
+    """Cache backend over the artifact store's derived blobs, keyed by the source file's hash"""
+
+    def __init__(self, store, kind):
+        self.store = store
+        self.kind = kind
+
+    def get(self, key):
+        return self.store.get_derived(key, self.kind)
+
+    def set(self, key, data, ttl=None):
+        # Derived blobs expire with the store's own garbage collection
+        self.store.put_derived(key, self.kind, data, 'application/json')
+
+    def delete(self, key):
+        pass
+
+    def stamp(self, key):
+        data = self.get(key)
+        return hashlib.sha256(data).hexdigest()[:16] if data is not None else None
+
+    def describe(self):
+        return f"artifact store ({self.kind})"
+
+
+# The namespace carries the extractor version so shared backends recompute after a bump too
+document_texts = open_cache(f'document_text_v{EXTRACTOR_VERSION}', DerivedBlobBackend(artifact_store, CACHE_KIND), ttl=CACHE_TTL_SECONDS)
+
+def extract_document_cached(data, fmt, cache=None):
+    """extract_document, cached under the SHA-256 of the file (returned as source_hash)"""
+    cache = cache or document_texts
+    source_hash = hashlib.sha256(data).hexdigest()
+    extraction = cache.get(source_hash)
+    if extraction is not None:
+        extraction["cached"] = True
+        extraction["source_hash"] = source_hash
+        return extraction
+
+    extraction = extract_document(data, fmt)
+    # A full store or an unreachable cache only costs us the cache (Cache.set logs it)
+    cache.set(source_hash, extraction)
+    extraction["cached"] = False
+    extraction["source_hash"] = source_hash
+    return extraction
@@ -0,0 +1,144 @@
+import base64
+import io
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from analysis_cache import image_bytes_from_base64
+from stroke_renderer import MAX_CANVAS_DIMENSION
+
+# A pixel counts as changed when its gray level moves by more than this
+DIFF_PIXEL_THRESHOLD = 48
+# Ignore anti-aliasing noise below this many changed pixels
+MIN_CHANGED_PIXELS = 10
+# Padding around the changed region so the model sees the surrounding terms
+DIFF_MARGIN = 24
+# Above this share of the drawing's inked area a delta update is not worth it - re-run the full analysis
+MAX_DELTA_AREA_FRACTION = 0.35
+# Small crops are upscaled so handwriting stays legible to the vision model
+MIN_CROP_EDGE = 256
+
+SESSION_TTL_SECONDS = 2 * 60 * 60
+MAX_SESSIONS = 500
+
+def to_canvas_space(image_base64, image_meta=None):
+    """Place an uploaded drawing back into canvas coordinates as a grayscale array
+
+    The extension crops to the inked area and may downscale (see canvas-encoder.js); the crop box and
+    source size it reports let successive uploads be compared pixel for pixel.
+    """
+    with Image.open(io.BytesIO(image_bytes_from_base64(image_base64))) as img:
+        gray = img.convert('L')
+
+    crop = (image_meta or {}).get('crop')
+    source = (image_meta or {}).get('sourceSize')
+    if not crop or not source:
+        return np.asarray(gray)
+
+    # Sizes come from the client: bound them before anything is allocated
+    source_width, source_height = int(source['width']), int(source['height'])
+    if not (0 < source_width <= MAX_CANVAS_DIMENSION and 0 < source_height <= MAX_CANVAS_DIMENSION):
+        raise ValueError(f"Canvas size {source_width}x{source_height} outside 1..{MAX_CANVAS_DIMENSION} pixels")
+    if not (0 < int(crop['width']) <= source_width and 0 < int(crop['height']) <= source_height
+            and 0 <= int(crop['x']) < source_width and 0 <= int(crop['y']) < source_height):
+        raise ValueError("Crop box outside the canvas")
+    canvas = Image.new('L', (source_width, source_height), 255)
+    # The encoder may pad tiny crops up to a minimum size; only the scaled crop area holds drawing pixels
+    scale = image_meta.get('scale') or min(gray.width / crop['width'], gray.height / crop['height'])
+    drawn = gray.crop((0, 0, round(crop['width'] * scale), round(crop['height'] * scale)))
+    canvas.paste(drawn.resize((int(crop['width']), int(crop['height'])), Image.Resampling.BILINEAR), (int(crop['x']), int(crop['y'])))
+    return np.asarray(canvas)
+
+def _bounding_box(mask):
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0:
+        return None
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+def changed_region(previous, current, ink_level=250):
+    """Vectorized diff of two canvas-space drawings; None when they cannot be compared"""
+    if previous.shape != current.shape:
+        return None
+
+    changed = np.abs(previous.astype(np.int16) - current.astype(np.int16)) > DIFF_PIXEL_THRESHOLD
+    changed_pixels = int(np.count_nonzero(changed))
+    if changed_pixels < MIN_CHANGED_PIXELS:
+        return {"bbox": None, "changed_pixels": changed_pixels, "area_fraction": 0.0}
+
+    height, width = current.shape
+    left, top, right, bottom = _bounding_box(changed)
+    bbox = (max(0, left - DIFF_MARGIN), max(0, top - DIFF_MARGIN), min(width, right + DIFF_MARGIN), min(height, bottom + DIFF_MARGIN))
+
+    ink_box = _bounding_box((previous < ink_level) | (current < ink_level)) or (0, 0, width, height)
+    ink_area = max(1, (ink_box[2] - ink_box[0]) * (ink_box[3] - ink_box[1]))
+    changed_area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+
+    return {"bbox": bbox, "changed_pixels": changed_pixels, "area_fraction": min(1.0, changed_area / ink_area)}
+
+def crop_to_base64(canvas_array, bbox):
+    """JPEG crop of the changed region, upscaled when tiny"""
+    crop = Image.fromarray(canvas_array).crop(bbox).convert('RGB')
+    longest = max(crop.width, crop.height)
+    if longest < MIN_CROP_EDGE:
+        ratio = MIN_CROP_EDGE / longest
+        crop = crop.resize((max(10, round(crop.width * ratio)), max(10, round(crop.height * ratio))), Image.Resampling.LANCZOS)
+
+    buffer = io.BytesIO()
+    crop.save(buffer, format='JPEG', quality=90)
+    return f"data:image/jpeg;base64,{base64.b64encode(buffer.getvalue()).decode('utf-8')}"
+
+
+class DrawingSessions:
+    """Last analyzed drawing and its analysis per session, for incremental re-analysis"""
+
+    def __init__(self, ttl=SESSION_TTL_SECONDS, max_sessions=MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def remember(self, session_id, canvas_array, result):
+        canvas_array = np.asarray(canvas_array)
+        with self._lock:
+            self._sessions[session_id] = {"canvas": canvas_array, "result": result, "updated_at": time.time()}
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def forget(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def plan(self, session_id, canvas_array):
+        """Decide between reusing, delta-updating or fully re-running the previous analysis"""
+        canvas_array = np.asarray(canvas_array)
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session and session["updated_at"] < time.time() - self.ttl:
+                del self._sessions[session_id]
+                session = None
+        if session is None:
+            return {"mode": "full", "reason": "no previous analysis"}
+
+        region = changed_region(session["canvas"], canvas_array)
+        if region is None:
+            return {"mode": "full", "reason": "canvas size changed"}
+        if region["bbox"] is None:
+            return {"mode": "unchanged", "prior": session["result"]}
+        if region["area_fraction"] > MAX_DELTA_AREA_FRACTION:
+            return {"mode": "full", "reason": f"{region['area_fraction']:.0%} of the drawing changed"}
+
+        return {
+            "mode": "delta",
+            "prior": session["result"],
+            "region": region,
+            "crop": crop_to_base64(canvas_array, region["bbox"]),
+            "canvas_size": [canvas_array.shape[1], canvas_array.shape[0]],
+        }
+
+
+drawing_sessions = DrawingSessions()
@@ -0,0 +1,170 @@
+import keyword
+import re
+import string
+
+try:
+    import sympy
+    from sympy.parsing.sympy_parser import (
+        parse_expr, standard_transformations, implicit_multiplication_application, convert_xor
+    )
+except ImportError:  # SymPy is optional - without it recognized equations go to the cheap text model
+    sympy = None
+
+GREEK_LETTERS = {
+    "alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta", "iota", "kappa", "lambda", "mu",
+    "nu", "xi", "rho", "sigma", "tau", "phi", "chi", "psi", "omega", "Gamma", "Delta", "Theta", "Lambda",
+    "Sigma", "Phi", "Psi", "Omega",
+}
+# Derivatives and integrals would parse as plain products (d*theta/(d*t)) - leave those to the text model
+UNSUPPORTED_NOTATION = re.compile(r"\\frac\s*\{\s*d[\s^{\\]|\\(partial|dot|ddot|int|sum|prod|lim)\b|'")
+# Python keywords among the letters; SymPy's own spelling is used for the symbol instead
+KEYWORD_LETTERS = {"lambda": "lamda"}
+# Preferred independent variables when picking what to sweep in the generated plot
+INDEPENDENT_VARIABLES = ("t", "x", "theta", "r", "n")
+
+def latex_to_sympy_source(latex):
+    """Rewrite the simple LaTeX a handwriting recognizer emits into SymPy-parsable source
+
+    Every replaced command is surrounded by spaces: 2\\pi\\sqrt{x} must become "2 pi sqrt(x)", not "2pisqrt(x)",
+    which implicit multiplication would split into single letters.
+    """
+    src = latex.replace(r"\left", "").replace(r"\right", "")
+    src = re.sub(r"\\(cdot|times)", " * ", src)
+    src = re.sub(r"\\[,;! ]", " ", src)
+
+    # \frac{a}{b} and \sqrt[n]{a}, innermost first so nesting works
+    previous = None
+    while previous != src:
+        previous = src
+        src = re.sub(r"\\frac\s*\{([^{}]*)\}\s*\{([^{}]*)\}", r" ((\1)/(\2)) ", src)
+        src = re.sub(r"\\sqrt\s*\[([^\]]*)\]\s*\{([^{}]*)\}", r" ((\2)**(1/(\1))) ", src)
+        src = re.sub(r"\\sqrt\s*\{([^{}]*)\}", r" sqrt(\1) ", src)
+
+    src = re.sub(r"_\{([^{}]*)\}", lambda m: "_" + re.sub(r"\W", "", m.group(1)), src)
+    # A subscript stays attached to its command (\\theta_0 -> theta_0)
+    src = re.sub(r"\\([A-Za-z]+)(_\w+)?", lambda m: " log " if m.group(1) == "ln" else
+                 f" {KEYWORD_LETTERS.get(m.group(1), m.group(1))}{m.group(2) or ''} ", src)
+    src = src.replace("{", "(").replace("}", ")").replace("^", "**")
+    return src
+
+def parse_equation(latex):
+    """Parse 'lhs = rhs' LaTeX into (target symbol, expression); None when SymPy is missing or parsing fails"""
+    if sympy is None or latex.count("=") != 1 or UNSUPPORTED_NOTATION.search(latex):
+        return None
+
+    transformations = standard_transformations + (implicit_multiplication_application, convert_xor)
+    # Plain symbols, so E, I, S, N, beta or lambda in handwriting do not turn into SymPy constants or functions
+    names = set(string.ascii_letters) | {KEYWORD_LETTERS.get(name, name) for name in GREEK_LETTERS}
+    local_dict = {name: sympy.Symbol(name) for name in names}
+    # ...except e, Euler's number in y = e^{-x}, unless a side of the equation is e itself
+    if not any(side.strip() == "e" for side in latex.split("=")):
+        local_dict["e"] = sympy.E
+    try:
+        lhs, rhs = (parse_expr(latex_to_sympy_source(side), local_dict=local_dict, transformations=transformations)
+                    for side in latex.split("="))
+    except Exception:
+        return None
+
+    if isinstance(lhs, sympy.Symbol):
+        return lhs, rhs
+    if isinstance(rhs, sympy.Symbol):
+        return rhs, lhs
+
+    # Implicit form: solve for the first symbol on the left-hand side
+    for symbol in sorted(lhs.free_symbols, key=str):
+        try:
+            solutions = sympy.solve(sympy.Eq(lhs, rhs), symbol)
+        except Exception:
+            continue
+        if solutions:
+            return symbol, solutions[0]
+    return None
+
+def _py_name(symbol):
+    name = str(symbol)
+    if name.isidentifier() and not keyword.iskeyword(name):
+        return name
+    return re.sub(r"\W", "_", name) + "_"
+
+def equation_to_notebook_cells(latex):
+    """Template notebook cells (SymPy setup, vectorized NumPy evaluation, plot) for a recognized equation"""
+    parsed = parse_equation(latex)
+    if parsed is None:
+        return None
+    target, expr = parsed
+
+    symbols = sorted(expr.free_symbols, key=str)
+    names = [str(symbol) for symbol in symbols]
+    independent = next((name for name in INDEPENDENT_VARIABLES if name in names), names[0] if names else None)
+    parameters = [name for name in names if name != independent]
+    target_name = _py_name(target)
+    # Sweeping a denominator from 0 would start the curve at infinity
+    denominator = {symbol for power in expr.atoms(sympy.Pow) if power.exp.is_negative for symbol in power.base.free_symbols}
+    sweep_start = 0.1 if independent is not None and sympy.Symbol(independent) in denominator else 0
+
+    setup_code = "\n".join([
+        "# Cell 1: Equation from your drawing",
+        "import sympy as sp",
+        "",
+        f"# Recognized: {latex}",
+        f"symbols = {{name: sp.Symbol(name) for name in {names!r}}}",
+        f"{target_name}_symbol = sp.Symbol('{target}')",
+        f"expr = sp.sympify('{sympy.sstr(expr)}', locals=symbols)",
+        f"equation = sp.Eq({target_name}_symbol, expr)",
+        "sp.pprint(equation)",
+    ])
+
+    if independent is None:
+        evaluate_code = "\n".join([
+            "# Cell 2: Evaluate the equation",
+            f"{target_name} = float(expr)",
+            f"print('{target} =', {target_name})",
+        ])
+        plot_code = "\n".join([
+            "# Cell 3: Next steps",
+            "# TODO: This equation has no variables to sweep - try adding a parameter and plotting how it changes the result",
+        ])
+    else:
+        evaluate_code = "\n".join([
+            "# Cell 2: Vectorized evaluation",
+            "import numpy as np",
+            "",
+            "_f = sp.lambdify(list(symbols.values()), expr, 'numpy')",
+            "",
+            "# TODO: Replace these placeholder values with the parameters from your experiment",
+            *[f"{_py_name(name)} = 1.0" for name in parameters],
+            "",
+            f"# Evaluate over a whole range of {independent} at once - no Python loop needed",
+            f"{_py_name(independent)} = np.linspace({sweep_start}, 10, 500)",
+            f"{target_name} = _f({', '.join(_py_name(name) for name in names)}) * np.ones_like({_py_name(independent)})",
+            f"print({target_name}[:5])",
+        ])
+        plot_code = "\n".join([
+            "# Cell 3: Plot the relationship",
+            "import matplotlib.pyplot as plt",
+            "",
+            "plt.figure(figsize=(8, 5))",
+            f"plt.plot({_py_name(independent)}, {target_name})",
+            f"plt.xlabel('{independent}')",
+            f"plt.ylabel('{target}')",
+            f"plt.title('{target} as a function of {independent}')",
+            "plt.grid(True)",
+            "plt.show()",
+            "",
+            "# TODO: Change one parameter at a time and describe how the curve responds",
+        ])
+
+    return [
+        {
+            "cell_type": "code",
+            "language": "python",
+            "description": description,
+            "code": code,
+            "cell_number": i + 1
+        }
+        for i, (description, code) in enumerate([
+            ("Equation from your drawing", setup_code),
+            ("Vectorized evaluation", evaluate_code),
+            ("Plot the relationship", plot_code),
+        ])
+    ]
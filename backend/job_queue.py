@@ -0,0 +1,365 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from cancellation import cancellations, RequestCancelled
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.getenv('LABRAT_DATA_DIR', os.path.join(os.path.dirname(__file__), 'data'))
+DEFAULT_DB_PATH = os.getenv('LABRAT_JOB_DB', os.path.join(DATA_DIR, 'jobs.db'))
+
+# Lower rank is served first. Interactive canvas requests always jump ahead of bulk uploads; speculative
+# analyses of a drawing in progress only run when nothing else is waiting.
+LANES = {
+    "interactive": 0,
+    "bulk": 1,
+    "speculative": 2,
+}
+
+# Most jobs a lane may have running at once (lanes not listed are only bounded by the worker count)
+LANE_LIMITS = {
+    "speculative": int(os.getenv('LABRAT_SPECULATIVE_WORKERS', '1')),
+}
+
+JOB_STATUSES = ("queued", "running", "done", "failed", "cancelled")
+
+# A running job's lease is renewed by its process while it runs; a job whose lease ran out belonged to a
+# process (or node sharing the database) that died, and goes back in line
+LEASE_SECONDS = float(os.getenv('LABRAT_JOB_LEASE_SECONDS', '60'))
+# A job that keeps taking its process down with it (out of memory, a crash in native code) is failed
+# after this many starts instead of being requeued forever
+MAX_ATTEMPTS = int(os.getenv('LABRAT_JOB_MAX_ATTEMPTS', '3'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    batch_id TEXT,
+    kind TEXT NOT NULL,
+    lane TEXT NOT NULL,
+    lane_rank INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    filename TEXT,
+    payload TEXT,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    lease_until REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs (status, lane_rank, created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs (batch_id, created_at);
+"""
+
+
+class JobQueue:
+    """SQLite-backed job queue with priority lanes and a pool of background workers"""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, handlers=None):
+        self.db_path = db_path
+        self.handlers = dict(handlers or {})
+        self._wakeup = threading.Condition()
+        self._workers = []
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+        self._running = set()  # ids of the jobs this process is running, whose leases it renews
+        self._running_lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "lease_until" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN lease_until REAL")
+            recovered = self._recover_stale(conn)
+        if recovered:
+            logger.info(f"Job queue recovered {recovered} interrupted jobs")
+
+    @staticmethod
+    def _recover_stale(conn):
+        """Put running jobs whose lease expired back in line (or fail them once they used up their attempts);
+        jobs other processes are still running keep theirs"""
+        now = time.time()
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', finished_at = ?, lease_until = NULL, payload = NULL, "
+            "error = COALESCE(error, 'Interrupted ' || attempts || ' times - its worker stopped while running it') "
+            "WHERE status = 'running' AND (lease_until IS NULL OR lease_until < ?) AND attempts >= ?",
+            (now, now, MAX_ATTEMPTS)
+        )
+        return conn.execute(
+            "UPDATE jobs SET status = 'queued', started_at = NULL, lease_until = NULL "
+            "WHERE status = 'running' AND (lease_until IS NULL OR lease_until < ?)",
+            (now,)
+        ).rowcount
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        return _Transaction(conn)
+
+    def register_handler(self, kind, handler):
+        """Register the function that processes jobs of a given kind"""
+        self.handlers[kind] = handler
+
+    def submit(self, kind, payload, lane="bulk", batch_id=None, filename=None):
+        """Queue a single job and return its id"""
+        return self.submit_many(kind, [payload], lane, batch_id, [filename])[0]
+
+    def submit_many(self, kind, payloads, lane="bulk", batch_id=None, filenames=None):
+        """Queue several jobs of the same kind in one transaction and return their ids"""
+        if kind not in self.handlers:
+            raise ValueError(f"No handler registered for job kind: {kind}")
+        if lane not in LANES:
+            raise ValueError(f"Unknown lane: {lane}")
+
+        filenames = filenames or [None] * len(payloads)
+        now = time.time()
+        job_ids = []
+        with self._connect() as conn:
+            conn.execute("BEGIN")
+            for offset, (payload, filename) in enumerate(zip(payloads, filenames)):
+                job_id = uuid.uuid4().hex
+                conn.execute(
+                    "INSERT INTO jobs (id, batch_id, kind, lane, lane_rank, status, filename, payload, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, 'queued', ?, ?, ?)",
+                    # Offset keeps FIFO order inside a batch even when timestamps collide
+                    (job_id, batch_id, kind, lane, LANES[lane], filename, json.dumps(payload), now + offset * 1e-6)
+                )
+                job_ids.append(job_id)
+
+        with self._wakeup:
+            self._wakeup.notify_all()
+        return job_ids
+
+    def get(self, job_id, include_result=True):
+        """Return a job's status (and result once finished), or None if unknown"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = _row_to_job(row, include_result)
+            if row["status"] == "queued":
+                job["queue_position"] = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND "
+                    "(lane_rank < ? OR (lane_rank = ? AND created_at < ?))",
+                    (row["lane_rank"], row["lane_rank"], row["created_at"])
+                ).fetchone()[0]
+            return job
+
+    def list(self, batch_id=None, status=None, page=1, page_size=20, include_results=False):
+        """Return one page of jobs, optionally filtered by batch and status"""
+        page = max(1, int(page))
+        page_size = max(1, min(100, int(page_size)))
+
+        clauses, params = [], []
+        if batch_id:
+            clauses.append("batch_id = ?")
+            params.append(batch_id)
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+        with self._connect() as conn:
+            total = conn.execute(f"SELECT COUNT(*) FROM jobs {where}", params).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT * FROM jobs {where} ORDER BY created_at LIMIT ? OFFSET ?",
+                params + [page_size, (page - 1) * page_size]
+            ).fetchall()
+
+        return {
+            "jobs": [_row_to_job(row, include_results) for row in rows],
+            "total": total,
+            "page": page,
+            "page_size": page_size,
+            "pages": (total + page_size - 1) // page_size,
+        }
+
+    def cancel(self, job_id):
+        """Cancel a queued job, or tell a running one to stop at its next checkpoint; returns True if either happened"""
+        with self._connect() as conn:
+            cancelled = conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id)
+            ).rowcount
+        return cancelled > 0 or cancellations.cancel(f"job:{job_id}", 'job_cancel')
+
+    def cancel_batch(self, batch_id, reason='superseded'):
+        """Cancel every queued job of a batch and signal its running ones; returns how many were cancelled"""
+        with self._connect() as conn:
+            cancelled = conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE batch_id = ? AND status = 'queued'",
+                (time.time(), batch_id)
+            ).rowcount
+            running = [row["id"] for row in conn.execute(
+                "SELECT id FROM jobs WHERE batch_id = ? AND status = 'running'", (batch_id,)
+            )]
+        return cancelled + sum(1 for job_id in running if cancellations.cancel(f"job:{job_id}", reason))
+
+    def stats(self):
+        """Count jobs per lane and status"""
+        counts = {lane: {status: 0 for status in JOB_STATUSES} for lane in LANES}
+        with self._connect() as conn:
+            for row in conn.execute("SELECT lane, status, COUNT(*) AS n FROM jobs GROUP BY lane, status"):
+                counts.setdefault(row["lane"], {})[row["status"]] = row["n"]
+        return {"lanes": counts, "workers": len(self._workers)}
+
+    def start_workers(self, num_workers=2, interactive_workers=1):
+        """Start the worker pool once; extra interactive-only workers keep canvas requests responsive"""
+        with self._start_lock:
+            if self._workers:
+                return
+            self._stopping.clear()
+            all_lanes = sorted(LANES, key=LANES.get)
+            for i in range(num_workers):
+                self._spawn(f"job-worker-{i}", all_lanes)
+            for i in range(interactive_workers):
+                self._spawn(f"job-worker-interactive-{i}", ["interactive"])
+            threading.Thread(target=self._heartbeat_loop, name="job-lease-heartbeat", daemon=True).start()
+            logger.info(f"Job queue started {num_workers} general and {interactive_workers} interactive workers")
+
+    def stop(self, timeout=5):
+        """Signal workers to exit after their current job"""
+        self._stopping.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for worker in self._workers:
+            worker.join(timeout)
+        self._workers = []
+
+    def _spawn(self, name, lanes):
+        worker = threading.Thread(target=self._worker_loop, args=(lanes,), name=name, daemon=True)
+        worker.start()
+        self._workers.append(worker)
+
+    def _heartbeat_loop(self):
+        """Renew the leases of this process's running jobs well before they expire"""
+        while not self._stopping.wait(LEASE_SECONDS / 3):
+            with self._running_lock:
+                running = list(self._running)
+            if not running:
+                continue
+            try:
+                with self._connect() as conn:
+                    conn.execute(
+                        f"UPDATE jobs SET lease_until = ? WHERE status = 'running' AND id IN ({','.join('?' for _ in running)})",
+                        [time.time() + LEASE_SECONDS] + running
+                    )
+            except sqlite3.OperationalError as e:
+                logger.warning(f"Job lease renewal failed, retrying: {e}")
+
+    def _claim(self, lanes):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            recovered = self._recover_stale(conn)
+            if recovered:
+                logger.info(f"Job queue recovered {recovered} jobs with expired leases")
+            limited = [lane for lane in lanes if lane in LANE_LIMITS]
+            if limited:
+                running = dict(conn.execute(
+                    f"SELECT lane, COUNT(*) FROM jobs WHERE status = 'running' AND lane IN ({','.join('?' for _ in limited)}) GROUP BY lane",
+                    limited
+                ).fetchall())
+                lanes = [lane for lane in lanes if lane not in LANE_LIMITS or running.get(lane, 0) < LANE_LIMITS[lane]]
+                if not lanes:
+                    return None
+            placeholders = ",".join("?" for _ in lanes)
+            row = conn.execute(
+                f"SELECT * FROM jobs WHERE status = 'queued' AND lane IN ({placeholders}) "
+                "ORDER BY lane_rank, created_at LIMIT 1",
+                lanes
+            ).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                (now, now + LEASE_SECONDS, row["id"])
+            )
+            with self._running_lock:
+                self._running.add(row["id"])
+            return row
+
+    def _finish(self, job_id, status, result=None, error=None):
+        with self._running_lock:
+            self._running.discard(job_id)
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, lease_until = NULL, payload = NULL WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None, error, time.time(), job_id)
+            )
+
+    def _worker_loop(self, lanes):
+        while not self._stopping.is_set():
+            try:
+                row = self._claim(lanes)
+            except sqlite3.OperationalError as e:
+                logger.warning(f"Job claim failed, retrying: {e}")
+                row = None
+
+            if row is None:
+                with self._wakeup:
+                    self._wakeup.wait(timeout=1.0)
+                continue
+
+            handler = self.handlers.get(row["kind"])
+            try:
+                # A running job can be cancelled through its token (see cancel)
+                with cancellations.scope(f"job:{row['id']}"):
+                    result = handler(json.loads(row["payload"]))
+                if isinstance(result, dict) and result.get("cancelled"):
+                    self._finish(row["id"], "cancelled", result=result, error=result.get("error"))
+                elif isinstance(result, dict) and result.get("error") and not result.get("success"):
+                    self._finish(row["id"], "failed", result=result, error=result["error"])
+                else:
+                    self._finish(row["id"], "done", result=result)
+            except RequestCancelled as e:
+                self._finish(row["id"], "cancelled", error=str(e))
+            except Exception as e:
+                logger.exception(f"Job {row['id']} ({row['kind']}) failed")
+                self._finish(row["id"], "failed", error=str(e))
+
+
+class _Transaction:
+    """Context manager that commits or rolls back an autocommit sqlite connection and closes it"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.conn.close()
+        return False
+
+
+def _row_to_job(row, include_result=True):
+    job = {
+        "job_id": row["id"],
+        "batch_id": row["batch_id"],
+        "kind": row["kind"],
+        "lane": row["lane"],
+        "status": row["status"],
+        "filename": row["filename"],
+        "attempts": row["attempts"],
+        "created_at": row["created_at"],
+        "started_at": row["started_at"],
+        "finished_at": row["finished_at"],
+    }
+    if row["error"]:
+        job["error"] = row["error"]
+    if include_result and row["result"]:
+        job["result"] = json.loads(row["result"])
+    return job
@@ -0,0 +1,156 @@
+"""Local handwritten-math recognition that runs before the vision model.
+
+A recognizer turns a drawing into LaTeX plus a confidence. Pure-equation drawings recognized with high
+confidence skip the Opus vision call entirely (see analyze_recognized_equation in model.py).
+
+Recognizers are CPU-only CTC line recognizers (CRNN-style) exported to ONNX or TorchScript, with this contract:
+    input:  float32 [1, 1, INPUT_HEIGHT, W] grayscale, ink = 1.0, paper = 0.0
+    output: float32 [1, T, V] per-timestep logits over a vocabulary whose index 0 is the CTC blank
+The vocabulary file has one LaTeX token per line (line 1 = blank).
+
+    LABRAT_MATH_OCR=onnx LABRAT_MATH_OCR_MODEL=model.onnx LABRAT_MATH_OCR_VOCAB=vocab.txt python server.py
+"""
+import io
+import logging
+import os
+
+import numpy as np
+from PIL import Image
+
+from analysis_cache import image_bytes_from_base64
+
+logger = logging.getLogger(__name__)
+
+INPUT_HEIGHT = 64
+MAX_INPUT_WIDTH = 1024
+MIN_CONFIDENCE = float(os.getenv('LABRAT_MATH_OCR_MIN_CONFIDENCE', '0.9'))
+
+RECOGNIZERS = {}
+
+def register_recognizer(name, factory):
+    """Make a recognizer available under a name selectable with LABRAT_MATH_OCR"""
+    RECOGNIZERS[name] = factory
+
+def load_vocabulary(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f]
+
+def preprocess_for_recognizer(image):
+    """Crop to ink, scale to the recognizer's line height and invert so ink is 1.0"""
+    gray = np.asarray(image.convert('L'), dtype=np.float32) / 255.0
+    ink = gray < 0.8
+    rows, cols = np.flatnonzero(ink.any(axis=1)), np.flatnonzero(ink.any(axis=0))
+    if rows.size == 0:
+        return None
+
+    pad = 4
+    top, bottom = max(0, rows[0] - pad), min(gray.shape[0], rows[-1] + 1 + pad)
+    left, right = max(0, cols[0] - pad), min(gray.shape[1], cols[-1] + 1 + pad)
+    cropped = Image.fromarray(((1.0 - gray[top:bottom, left:right]) * 255).astype(np.uint8))
+
+    width = min(MAX_INPUT_WIDTH, max(INPUT_HEIGHT, round(cropped.width * INPUT_HEIGHT / cropped.height)))
+    resized = cropped.resize((width, INPUT_HEIGHT), Image.Resampling.BILINEAR)
+    return (np.asarray(resized, dtype=np.float32) / 255.0)[None, None, :, :]
+
+def ctc_greedy_decode(logits, vocabulary):
+    """Collapse repeats and blanks; confidence is the mean max-probability of the emitted tokens"""
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    probs = np.exp(logits)
+    probs /= probs.sum(axis=-1, keepdims=True)
+
+    best = probs.argmax(axis=-1)
+    best_prob = probs.max(axis=-1)
+    keep = (best != 0) & np.concatenate(([True], best[1:] != best[:-1]))
+    tokens = [vocabulary[i] for i in best[keep] if i < len(vocabulary)]
+    confidence = float(best_prob[keep].mean()) if keep.any() else 0.0
+    return " ".join(tokens), confidence
+
+
+class OnnxMathRecognizer:
+    """CTC recognizer running on onnxruntime's CPU provider"""
+
+    name = "onnx"
+
+    def __init__(self, model_path, vocab_path):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = int(os.getenv('LABRAT_MATH_OCR_THREADS', '2'))
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.vocabulary = load_vocabulary(vocab_path)
+
+    def recognize(self, image):
+        batch = preprocess_for_recognizer(image)
+        if batch is None:
+            return {"latex": "", "confidence": 0.0}
+        logits = self.session.run(None, {self.input_name: batch})[0][0]
+        latex, confidence = ctc_greedy_decode(logits, self.vocabulary)
+        return {"latex": latex, "confidence": confidence}
+
+
+class TorchScriptMathRecognizer:
+    """Same contract as OnnxMathRecognizer for a TorchScript export, pinned to the CPU"""
+
+    name = "torchscript"
+
+    def __init__(self, model_path, vocab_path):
+        import torch
+
+        torch.set_num_threads(int(os.getenv('LABRAT_MATH_OCR_THREADS', '2')))
+        self.torch = torch
+        self.model = torch.jit.load(model_path, map_location="cpu").eval()
+        self.vocabulary = load_vocabulary(vocab_path)
+
+    def recognize(self, image):
+        batch = preprocess_for_recognizer(image)
+        if batch is None:
+            return {"latex": "", "confidence": 0.0}
+        with self.torch.inference_mode():
+            logits = self.model(self.torch.from_numpy(batch))[0].numpy()
+        latex, confidence = ctc_greedy_decode(logits, self.vocabulary)
+        return {"latex": latex, "confidence": confidence}
+
+
+register_recognizer("onnx", OnnxMathRecognizer)
+register_recognizer("torchscript", TorchScriptMathRecognizer)
+
+_recognizer = None
+_recognizer_loaded = False
+
+def get_recognizer():
+    """The configured recognizer, loaded once; None when the fast path is disabled or unavailable"""
+    global _recognizer, _recognizer_loaded
+    if _recognizer_loaded:
+        return _recognizer
+    _recognizer_loaded = True
+
+    name = os.getenv('LABRAT_MATH_OCR', '').lower()
+    if not name or name == 'none':
+        return None
+    factory = RECOGNIZERS.get(name)
+    if factory is None:
+        logger.warning(f"Unknown math OCR recognizer '{name}', local fast path disabled")
+        return None
+    try:
+        _recognizer = factory(os.getenv('LABRAT_MATH_OCR_MODEL'), os.getenv('LABRAT_MATH_OCR_VOCAB'))
+        logger.info(f"Loaded local math recognizer: {name}")
+    except Exception as e:
+        logger.warning(f"Could not load math OCR recognizer '{name}', local fast path disabled: {e}")
+    return _recognizer
+
+def recognize_equation(image_base64, recognizer=None):
+    """Run local recognition on a drawing; returns {"latex", "confidence"} or None if no recognizer is set up"""
+    recognizer = recognizer or get_recognizer()
+    if recognizer is None:
+        return None
+    with Image.open(io.BytesIO(image_bytes_from_base64(image_base64))) as img:
+        return recognizer.recognize(img)
+
+def is_confident_equation(recognition, min_confidence=MIN_CONFIDENCE):
+    """Only single equations recognized with high confidence may bypass the vision model"""
+    return bool(
+        recognition
+        and recognition["confidence"] >= min_confidence
+        and recognition["latex"].count("=") == 1
+    )
@@ -1,4 +1,5 @@
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import json
 import logging
@@ -8,6 +9,10 @@ import io
 from PIL import Image
 import requests
 import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 
 # Load environment variables from .env file
 def load_env_file():
@@ -24,9 +29,35 @@ def load_env_file():
 # Load .env file
 load_env_file()
 
-client = boto3.client("bedrock-runtime", region_name="us-west-2")
+# Imported after .env is loaded so LABRAT_MODEL_STUB can be set there
+import model_stub
+from circuit_breaker import GuardedBedrockClient, get_breaker, upstream_error, CircuitOpenError
+from cancellation import StreamingBedrockClient, checkpoint, RequestCancelled
+from usage_ledger import MeteredClient, usage_ledger
+from response_profiles import response_profiles
+from notebook_model import assign_cell_ids
+from admission import admission
+from burst_pool import SlottedClient
+
+if model_stub.stub_enabled():
+    # Local fault-injecting stand-in (see model_stub.py)
+    client = MeteredClient(SlottedClient(GuardedBedrockClient(StreamingBedrockClient(model_stub.StubBedrockClient(model_stub.injector))), admission.scheduler), usage_ledger)
+else:
+    # Bounded timeouts and retries: a struggling upstream should trip the breaker, not hold threads for minutes.
+    # SlottedClient sits outside the breaker so waiting for a model slot never counts as an upstream failure.
+    client = MeteredClient(SlottedClient(GuardedBedrockClient(StreamingBedrockClient(boto3.client(
+        "bedrock-runtime",
+        region_name="us-west-2",
+        config=Config(
+            connect_timeout=5,
+            read_timeout=int(os.getenv('LABRAT_BEDROCK_READ_TIMEOUT', '90')),
+            retries={"max_attempts": 2, "mode": "standard"}
+        )
+    ))), admission.scheduler), usage_ledger)
 
 model_id = "us.anthropic.claude-opus-4-20250514-v1:0"
+# Cheap text-only model for work that needs no vision, e.g. cells for a locally recognized equation
+text_model_id = os.getenv('LABRAT_TEXT_MODEL_ID', "us.anthropic.claude-3-5-haiku-20241022-v1:0")
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -139,25 +170,35 @@ def call_model(user_input, image_data=None):
     
     try:
         # Send the message to the model with educational configuration
+        max_tokens = response_profiles.max_tokens('tutor')
         response = client.converse(
             modelId=model_id,
             messages=conversation,
             inferenceConfig={
-                "maxTokens": 500,  # Longer responses for step-by-step guidance
+                "maxTokens": max_tokens,  # Covers the observed p99 of step-by-step guidance
                 "temperature": 0.1,  # Lower temperature for more consistent educational responses
                 "topP": 0.9
             }
         )
+        response_profiles.observe_converse('tutor', response, max_tokens)
         
         # Extract and return the response text
         response_text = response["output"]["message"]["content"][0]["text"]
         return {"success": True, "text": response_text, "model": model_id}
         
     except (ClientError, Exception) as e:
-        return {"error": f"Can't invoke '{model_id}'. Reason: {e}"}
+        return upstream_error(f"Can't invoke '{model_id}'. Reason: {e}", e)
 
 def process_whiteboard_to_code(equation_description):
     """Specific function for converting whiteboard equations to code"""
+    from sim_templates import match_template, extract_parameters, template_result
+    
+    # Standard lab setups are rendered from a template instead of asking the model
+    template_name, score = match_template(text=equation_description)
+    if template_name:
+        log_reasoning_step("Simulation Template", f"Using the {template_name} template (score {score})")
+        return template_result(template_name, extract_parameters(template_name, equation_description), source="whiteboard_text")
+    
     prompt = f"""I see this mathematical equation on the whiteboard: {equation_description}
     
     Help me understand how to convert this to Python code for data analysis."""
@@ -172,6 +213,57 @@ def analyze_experiment_data(experiment_description):
 
     return call_model(prompt)
 
+DATASET_ANALYSIS_PROMPT = """A student uploaded experiment data. It was profiled locally; here is the summary (not the raw data):
+
+    {profile}
+
+    Please respond in this format:
+
+    ## DATA INTERPRETATION
+    What the data likely shows, which relationships look real, and anything suspicious (outliers, missing values, units).
+
+    ## NOTEBOOK CODE CELLS
+    The full dataset is already loaded as a pandas DataFrame named `df` with columns {columns}.
+    Provide 2-4 Python cells that analyze it (cleaning, vectorized fits with NumPy, plots), formatted like:
+    ```python
+    # Cell 2: Description
+    [actual Python code]
+    ```
+
+    Do not recreate or re-load `df`. Add TODO comments where the student should think or decide."""
+
+def analyze_dataset_profile(profile_text, column_names, verbose=True):
+    """Analyze an uploaded dataset from its local statistical profile instead of the raw rows"""
+    try:
+        log_reasoning_step("Dataset Analysis", f"Sending a {len(profile_text)}-character profile instead of the raw table", verbose)
+        max_tokens = response_profiles.max_tokens('dataset')
+        response = client.converse(
+            modelId=model_id,
+            messages=[{"role": "user", "content": [{"text": DATASET_ANALYSIS_PROMPT.format(
+                profile=profile_text, columns=", ".join(repr(name) for name in column_names)
+            )}]}],
+            inferenceConfig={
+                "maxTokens": max_tokens,
+                "temperature": 0.1,
+                "topP": 0.9
+            }
+        )
+        response_profiles.observe_converse('dataset', response, max_tokens)
+        response_text = response["output"]["message"]["content"][0]["text"]
+        return {
+            "success": True,
+            "text": response_text,
+            "model": model_id,
+            "notebook_cells": extract_code_cells_from_response(response_text),
+            "analysis_type": "dataset_profile"
+        }
+        
+    except (ClientError, Exception) as e:
+        error_msg = f"Can't analyze dataset with '{model_id}'. Reason: {e}"
+        if verbose:
+            print(f"Error: {error_msg}")
+        return upstream_error(error_msg, e)
+
 '''# Test the educational model
 if __name__ == "__main__":
     # Test cases for your lab scenarios
@@ -232,11 +324,109 @@ def guide_simulation_building(drawing_description, student_context=""):
     
     return call_model(simulation_prompt)
 
-def extract_math_from_drawing(image_base64, include_reasoning=True, verbose=True):
-    """Extract mathematical content from a drawing and provide detailed analysis with Snowflake code recommendations"""
+DRAWING_EXTRACTION_PROMPT = """You are an expert data scientist analyzing a mathematical drawing to create Snowflake/SQL solutions.
+
+    Please provide a structured analysis following this format:
+
+    ## VISUAL ANALYSIS
+    Describe what you observe in the drawing:
+    - Mathematical equations, formulas, or expressions
+    - Graphs, charts, or data visualizations
+    - Variables, parameters, and their relationships
+    - Any data patterns or trends shown
+
+    ## DETAILED REASONING PROCESS
+    Step-by-step breakdown of your analytical thinking:
+    1. **Initial Interpretation**: What mathematical concept is being illustrated?
+    2. **Variable Identification**: What are the key variables and relationships?
+    3. **Computational Requirements**: What type of analysis or computation is needed?
+    4. **Data Flow Analysis**: What would be the expected inputs and outputs?
+    5. **Implementation Feasibility**: How confident are you this can be converted to code? (1-10)
+    6. **Complexity Assessment**: What challenges might arise in implementation?
+
+    ## CODE CONVERSION ASSESSMENT
+    Evaluate the feasibility of turning this into executable code:
+    - **Feasibility Score (1-10)**: How easily can this be converted to code?
+    - **Primary Challenges**: What obstacles exist for code conversion?
+    - **Required Dependencies**: What libraries/tools would be needed?
+    - **Expected Complexity**: Simple/Moderate/Complex implementation?
+
+    ## SNOWFLAKE RECOMMENDATIONS
+    Based on your analysis, provide specific recommendations for:
+    - SQL queries needed to analyze similar data
+    - Data transformations or calculations
+    - Visualization approaches in Snowflake
+    - Sample table structures if applicable
+
+    ## NOTEBOOK CODE CELLS
+    Provide 2-3 Python code cells that could be used in a Snowflake notebook:
+    1. Data connection and query setup
+    2. Main analysis/calculation code
+    3. Visualization or results formatting
+
+    Format the code cells like this:
+    ```python
+    # Cell 1: Description
+    [actual Python/SQL code]
+    ```
+
+    Be specific and practical - focus on actionable Snowflake/Python code that addresses the mathematical concepts in the drawing.
     
-    if not image_base64:
-        return {"error": "No image data provided"}
+    ## REASONING SUMMARY
+    Conclude with:
+    - Overall assessment of code conversion potential
+    - Key insights from your analysis
+    - Recommendations for next steps"""
+
+# Used when the client does not show the reasoning: only the sections parse_drawing_analysis needs, so
+# generation is roughly half as long
+DRAWING_BRIEF_PROMPT = """You are an expert data scientist analyzing a mathematical drawing to create Snowflake/SQL solutions.
+
+    Please respond in this format, and be brief:
+
+    ## VISUAL ANALYSIS
+    In 2-3 sentences: the equations, graphs and variables in the drawing.
+
+    ## CODE CONVERSION ASSESSMENT
+    - **Feasibility Score (1-10)**: How easily can this be converted to code?
+
+    ## NOTEBOOK CODE CELLS
+    Provide 2-3 Python code cells that could be used in a Snowflake notebook:
+    1. Data connection and query setup
+    2. Main analysis/calculation code
+    3. Visualization or results formatting
+
+    Format the code cells like this:
+    ```python
+    # Cell 1: Description
+    [actual Python/SQL code]
+    ```"""
+
+# Drawings the extension already cropped, downscaled and encoded within these limits skip re-encoding
+MAX_VISION_DIMENSION = 1568
+MAX_VISION_IMAGE_MB = 3.0
+# Prepared images kept by input digest, so the burst pool's CPU stage and the model call share the work
+PREPARED_IMAGE_CACHE_SIZE = int(os.getenv('LABRAT_PREPARED_IMAGE_CACHE', '64'))
+_prepared_images = OrderedDict()
+_prepared_images_lock = threading.Lock()
+
+def prepare_drawing_image(image_base64, verbose=True):
+    """Validate, resize and re-encode a drawing for the vision model. Returns (image_base64, image_format, error)"""
+    key = hashlib.sha256(image_base64.encode('utf-8')).digest()
+    with _prepared_images_lock:
+        prepared = _prepared_images.get(key)
+        if prepared is not None:
+            _prepared_images.move_to_end(key)
+            return prepared
+    prepared = _prepare_drawing_image(image_base64, verbose)
+    if prepared[2] is None:
+        with _prepared_images_lock:
+            _prepared_images[key] = prepared
+            while len(_prepared_images) > PREPARED_IMAGE_CACHE_SIZE:
+                _prepared_images.popitem(last=False)
+    return prepared
+
+def _prepare_drawing_image(image_base64, verbose):
     
     # Handle image format and base64 conversion
     image_format = "png"  # default
@@ -262,7 +452,18 @@ def extract_math_from_drawing(image_base64, include_reasoning=True, verbose=True
         except Exception as e:
             if verbose:
                 print(f"Base64 decode error: {e}")
-            return {"error": f"Invalid base64 image data: {str(e)}"}
+            return None, None, {"error": f"Invalid base64 image data: {str(e)}"}
+        
+        # Fast path for payloads normalized client-side: only the header is parsed, pixels are never decoded
+        if image_format in ('jpeg', 'webp') and len(image_bytes) <= MAX_VISION_IMAGE_MB * 1024 * 1024:
+            with Image.open(io.BytesIO(image_bytes)) as probe:
+                if ((probe.format or '').lower() == image_format
+                        and probe.mode in ('RGB', 'L')
+                        and 10 <= probe.width <= MAX_VISION_DIMENSION
+                        and 10 <= probe.height <= MAX_VISION_DIMENSION):
+                    if verbose:
+                        print(f"Pre-normalized {image_format} accepted as-is: {probe.width}x{probe.height}, {len(image_bytes)} bytes")
+                    return image_base64, image_format, None
         
         # Open with PIL to validate and potentially convert
         with Image.open(io.BytesIO(image_bytes)) as img:
@@ -271,7 +472,7 @@ def extract_math_from_drawing(image_base64, include_reasoning=True, verbose=True
             
             # Check for minimum size (too small images can cause issues)
             if img.width < 10 or img.height < 10:
-                return {"error": "Image too small to process"}
+                return None, None, {"error": "Image too small to process"}
             
             # Check image size and resize if too large (Claude has limits)
             max_dimension = 1024  # More conservative limit
@@ -328,9 +529,9 @@ def extract_math_from_drawing(image_base64, include_reasoning=True, verbose=True
         try:
             test_decode = base64.b64decode(image_base64)
             if len(test_decode) == 0:
-                return {"error": "Processed image resulted in empty data"}
+                return None, None, {"error": "Processed image resulted in empty data"}
         except Exception as e:
-            return {"error": f"Final base64 validation failed: {str(e)}"}
+            return None, None, {"error": f"Final base64 validation failed: {str(e)}"}
         
         if verbose:
             print(f"Image processed successfully as {image_format}, size: {image_size_mb:.1f}MB")
@@ -339,70 +540,30 @@ def extract_math_from_drawing(image_base64, include_reasoning=True, verbose=True
     except Exception as e:
         if verbose:
             print(f"Image processing error: {e}")
-        return {"error": f"Failed to process image: {str(e)}"}
+        return None, None, {"error": f"Failed to process image: {str(e)}"}
     
-    if verbose:
-        print("Analyzing drawing for mathematical content and code potential...")
-    
-    extraction_prompt = """You are an expert data scientist analyzing a mathematical drawing to create Snowflake/SQL solutions.
-
-    Please provide a structured analysis following this format:
-
-    ## VISUAL ANALYSIS
-    Describe what you observe in the drawing:
-    - Mathematical equations, formulas, or expressions
-    - Graphs, charts, or data visualizations
-    - Variables, parameters, and their relationships
-    - Any data patterns or trends shown
-
-    ## DETAILED REASONING PROCESS
-    Step-by-step breakdown of your analytical thinking:
-    1. **Initial Interpretation**: What mathematical concept is being illustrated?
-    2. **Variable Identification**: What are the key variables and relationships?
-    3. **Computational Requirements**: What type of analysis or computation is needed?
-    4. **Data Flow Analysis**: What would be the expected inputs and outputs?
-    5. **Implementation Feasibility**: How confident are you this can be converted to code? (1-10)
-    6. **Complexity Assessment**: What challenges might arise in implementation?
-
-    ## CODE CONVERSION ASSESSMENT
-    Evaluate the feasibility of turning this into executable code:
-    - **Feasibility Score (1-10)**: How easily can this be converted to code?
-    - **Primary Challenges**: What obstacles exist for code conversion?
-    - **Required Dependencies**: What libraries/tools would be needed?
-    - **Expected Complexity**: Simple/Moderate/Complex implementation?
-
-    ## SNOWFLAKE RECOMMENDATIONS
-    Based on your analysis, provide specific recommendations for:
-    - SQL queries needed to analyze similar data
-    - Data transformations or calculations
-    - Visualization approaches in Snowflake
-    - Sample table structures if applicable
+    return image_base64, image_format, None
 
-    ## NOTEBOOK CODE CELLS
-    Provide 2-3 Python code cells that could be used in a Snowflake notebook:
-    1. Data connection and query setup
-    2. Main analysis/calculation code
-    3. Visualization or results formatting
-
-    Format the code cells like this:
-    ```python
-    # Cell 1: Description
-    [actual Python/SQL code]
-    ```
-
-    Be specific and practical - focus on actionable Snowflake/Python code that addresses the mathematical concepts in the drawing.
+def extract_math_from_drawing(image_base64, include_reasoning=True, verbose=True):
+    """Extract mathematical content from a drawing and provide detailed analysis with Snowflake code recommendations"""
     
-    ## REASONING SUMMARY
-    Conclude with:
-    - Overall assessment of code conversion potential
-    - Key insights from your analysis
-    - Recommendations for next steps"""
+    if not image_base64:
+        return {"error": "No image data provided"}
     
+    image_base64, image_format, error = prepare_drawing_image(image_base64, verbose)
+    if error:
+        return error
+    
+    if verbose:
+        print("Analyzing drawing for mathematical content and code potential...")
+    
+    # Skip the reasoning sections (and their generation time) when the client will not show them
+    profile = 'drawing' if include_reasoning else 'drawing_brief'
     conversation = [
         {
             "role": "user",
             "content": [
-                {"text": extraction_prompt},
+                {"text": DRAWING_EXTRACTION_PROMPT if include_reasoning else DRAWING_BRIEF_PROMPT},
                 {
                     "image": {
                         "format": image_format,
@@ -429,48 +590,21 @@ def extract_math_from_drawing(image_base64, include_reasoning=True, verbose=True
         if image_format not in ['png', 'jpeg', 'webp']:
             raise ValueError(f"Unsupported image format: {image_format}")
         
+        max_tokens = response_profiles.max_tokens(profile)
         response = client.converse(
             modelId=model_id,
             messages=conversation,
             inferenceConfig={
-                "maxTokens": 2500,  # Increased for detailed reasoning analysis
+                "maxTokens": max_tokens,  # Observed p99 for this prompt variant
                 "temperature": 0.1,
                 "topP": 0.9
             }
         )
+        response_profiles.observe_converse(profile, response, max_tokens)
         
         response_text = response["output"]["message"]["content"][0]["text"]
         
-        if verbose:
-            print("Analysis complete!")
-            if include_reasoning:
-                print("\n" + "="*80)
-                print("MODEL'S REASONING FOR CODE CONVERSION:")
-                print("="*80)
-                # Extract and highlight the reasoning section
-                reasoning_section = extract_reasoning_section(response_text)
-                if reasoning_section:
-                    print(reasoning_section)
-                else:
-                    print("Full response (reasoning embedded):")
-                    print(response_text)
-                print("="*80 + "\n")
-        
-        # Extract code cells from the response
-        notebook_cells = extract_code_cells_from_response(response_text)
-        
-        # Extract feasibility score from reasoning
-        feasibility_score = extract_score_from_text(response_text, "feasibility score")
-        
-        return {
-            "success": True, 
-            "text": response_text, 
-            "model": model_id,
-            "notebook_cells": notebook_cells,
-            "reasoning_included": include_reasoning,
-            "feasibility_score": feasibility_score,
-            "analysis_type": "enhanced_with_reasoning"
-        }
+        return parse_drawing_analysis(response_text, include_reasoning, verbose)
         
     except (ClientError, Exception) as e:
         error_msg = f"Can't analyze image with '{model_id}'. Reason: {e}"
@@ -487,7 +621,274 @@ def extract_math_from_drawing(image_base64, include_reasoning=True, verbose=True
             print(f"- Base64 length: {len(image_base64)}")
             print(f"- Model attempted: {model_id}")
         
-        return {"error": error_msg}
+        return upstream_error(error_msg, e)
+
+def parse_drawing_analysis(response_text, include_reasoning=True, verbose=True):
+    """Turn the model's drawing analysis text into the structured result returned to the extension"""
+    
+    if verbose:
+        print("Analysis complete!")
+        if include_reasoning:
+            print("\n" + "="*80)
+            print("MODEL'S REASONING FOR CODE CONVERSION:")
+            print("="*80)
+            # Extract and highlight the reasoning section
+            reasoning_section = extract_reasoning_section(response_text)
+            if reasoning_section:
+                print(reasoning_section)
+            else:
+                print("Full response (reasoning embedded):")
+                print(response_text)
+            print("="*80 + "\n")
+    
+    # Extract code cells from the response
+    notebook_cells = extract_code_cells_from_response(response_text)
+    
+    # Extract feasibility score from reasoning
+    feasibility_score = extract_score_from_text(response_text, "feasibility score")
+    
+    return {
+        "success": True, 
+        "text": response_text, 
+        "model": model_id,
+        "notebook_cells": notebook_cells,
+        "reasoning_included": include_reasoning,
+        "feasibility_score": feasibility_score,
+        "analysis_type": "enhanced_with_reasoning"
+    }
+
+DELTA_UPDATE_PROMPT = """You previously analyzed a student's mathematical drawing. The student has since added to or changed one region of it.
+
+    ## PREVIOUS ANALYSIS (condensed)
+    {prior_summary}
+
+    ## PREVIOUS NOTEBOOK CODE CELLS
+    {prior_cells}
+
+    The attached image shows ONLY the changed region (pixels {left},{top} to {right},{bottom} of a {width}x{height} canvas).
+
+    Please respond in this format:
+
+    ## CHANGES
+    Describe what was added or changed and how it affects the mathematical interpretation.
+
+    ## CODE CONVERSION ASSESSMENT
+    - **Feasibility Score (1-10)**: Updated score for the whole drawing
+
+    ## NOTEBOOK CODE CELLS
+    Provide the complete updated set of Python code cells for the whole drawing (not just the change), formatted like:
+    ```python
+    # Cell 1: Description
+    [actual Python/SQL code]
+    ```
+
+    Keep unchanged cells as they were. Be concise."""
+
+def summarize_prior_analysis(prior_result, max_chars=1500):
+    """Condense a previous analysis to the parts a delta update needs as context"""
+    import re
+    
+    text = prior_result.get('text', '')
+    sections = re.findall(r"## (VISUAL ANALYSIS|CHANGES|REASONING SUMMARY)(.*?)(?=\n##|$)", text, re.DOTALL | re.IGNORECASE)
+    summary = "\n".join(f"{title}: {body.strip()}" for title, body in sections) or text
+    return summary[:max_chars]
+
+def update_analysis_from_diff(crop_base64, prior_result, region, canvas_size, include_reasoning=True, verbose=True):
+    """Cheap delta update: send only the changed crop plus the prior analysis instead of re-analyzing everything"""
+    
+    crop_base64, image_format, error = prepare_drawing_image(crop_base64, verbose)
+    if error:
+        return error
+    
+    left, top, right, bottom = region['bbox']
+    prior_cells = "\n\n".join(
+        f"```python\n{cell['code']}\n```" for cell in prior_result.get('notebook_cells', [])
+    ) or "(none)"
+    prompt = DELTA_UPDATE_PROMPT.format(
+        prior_summary=summarize_prior_analysis(prior_result),
+        prior_cells=prior_cells,
+        left=left, top=top, right=right, bottom=bottom,
+        width=canvas_size[0], height=canvas_size[1]
+    )
+    
+    conversation = [
+        {
+            "role": "user",
+            "content": [
+                {"text": prompt},
+                {
+                    "image": {
+                        "format": image_format,
+                        "source": {
+                            "bytes": crop_base64
+                        }
+                    }
+                }
+            ]
+        }
+    ]
+    
+    try:
+        if verbose:
+            print(f"Sending delta update for region {region['bbox']} ({region['area_fraction']:.0%} of the drawing)")
+        
+        max_tokens = response_profiles.max_tokens('drawing_delta')
+        response = client.converse(
+            modelId=model_id,
+            messages=conversation,
+            inferenceConfig={
+                "maxTokens": max_tokens,  # Delta only - changes plus the updated cells
+                "temperature": 0.1,
+                "topP": 0.9
+            }
+        )
+        response_profiles.observe_converse('drawing_delta', response, max_tokens)
+        
+        delta_text = response["output"]["message"]["content"][0]["text"]
+        delta = parse_drawing_analysis(delta_text, include_reasoning, verbose)
+        
+        # Merge: keep the previous analysis text and append the update; take the new cells if the model sent any
+        merged = dict(prior_result)
+        merged.pop('notebook', None)
+        merged.pop('cached', None)
+        merged['text'] = f"{prior_result.get('text', '')}\n\n## INCREMENTAL UPDATE\n{delta_text}"
+        merged['notebook_cells'] = delta['notebook_cells'] or prior_result.get('notebook_cells', [])
+        merged['feasibility_score'] = delta['feasibility_score']
+        merged['analysis_type'] = "incremental_delta"
+        merged['delta_region'] = list(region['bbox'])
+        return merged
+        
+    except (ClientError, Exception) as e:
+        error_msg = f"Can't update analysis with '{model_id}'. Reason: {e}"
+        if verbose:
+            print(f"Error: {error_msg}")
+        return upstream_error(error_msg, e)
+
+EQUATION_CELLS_PROMPT = """A student handwrote this equation, recognized as LaTeX: {latex}
+
+    Please respond in this format:
+
+    ## VISUAL ANALYSIS
+    One or two sentences on what the equation describes.
+
+    ## NOTEBOOK CODE CELLS
+    Provide 2-3 Python cells that set up the equation, evaluate it over a range with vectorized NumPy and plot it, formatted like:
+    ```python
+    # Cell 1: Description
+    [actual Python code]
+    ```
+
+    Use placeholder parameter values marked with TODO comments. Be concise."""
+
+def analyze_recognized_equation(latex, confidence, include_reasoning=True, verbose=True):
+    """Notebook cells for an equation recognized locally, without a vision model call
+
+    SymPy templates the cells when it can parse the LaTeX; otherwise a short text-only call to the cheap
+    model writes them.
+    """
+    from equation_codegen import equation_to_notebook_cells
+    from sim_templates import match_template, template_result
+    
+    summary = f"## VISUAL ANALYSIS\nRecognized handwritten equation: ${latex}$ (local recognizer, confidence {confidence:.2f})"
+    
+    # Standard lab setups (pendulum, projectile, ...) get the full simulation template
+    template_name, score = match_template(latex=latex)
+    if template_name:
+        log_reasoning_step("Local Math OCR", f"{latex} matches the {template_name} template (score {score})", verbose)
+        result = template_result(template_name, source="math_ocr")
+        result.update({"recognized_latex": latex, "ocr_confidence": confidence})
+        return result
+    
+    cells = equation_to_notebook_cells(latex)
+    if cells:
+        log_reasoning_step("Local Math OCR", f"Generated {len(cells)} cells for {latex} with SymPy", verbose)
+        return {
+            "success": True,
+            "text": summary,
+            "model": "local-math-ocr",
+            "notebook_cells": cells,
+            "reasoning_included": False,
+            "feasibility_score": None,
+            "analysis_type": "local_equation",
+            "recognized_latex": latex,
+            "ocr_confidence": confidence
+        }
+    
+    try:
+        log_reasoning_step("Local Math OCR", f"SymPy could not template {latex}, asking {text_model_id}", verbose)
+        max_tokens = response_profiles.max_tokens('equation_cells')
+        response = client.converse(
+            modelId=text_model_id,
+            messages=[{"role": "user", "content": [{"text": EQUATION_CELLS_PROMPT.format(latex=latex)}]}],
+            inferenceConfig={
+                "maxTokens": max_tokens,  # A few short cells, no image to describe
+                "temperature": 0.1,
+                "topP": 0.9
+            }
+        )
+        response_profiles.observe_converse('equation_cells', response, max_tokens)
+        response_text = response["output"]["message"]["content"][0]["text"]
+        result = parse_drawing_analysis(response_text, include_reasoning=False, verbose=False)
+        result.update({
+            "text": f"{summary}\n\n{response_text}",
+            "model": text_model_id,
+            "analysis_type": "local_equation",
+            "recognized_latex": latex,
+            "ocr_confidence": confidence
+        })
+        return result
+        
+    except (ClientError, Exception) as e:
+        error_msg = f"Can't generate cells with '{text_model_id}'. Reason: {e}"
+        if verbose:
+            print(f"Error: {error_msg}")
+        return upstream_error(error_msg, e)
+
+CELL_REPAIR_PROMPT = """These Python notebook cells were generated for a student's lab analysis, but some of them fail.
+
+    {cells}
+
+    Fix the failing cells. Keep the same number of cells, in the same order, and change as little as possible.
+    Snowflake connections are not available while checking, so do not rely on query results being non-empty.
+    Reply with only the code cells, each formatted like:
+    ```python
+    # Cell 1: Description
+    [actual Python code]
+    ```"""
+
+def repair_cells(cells, reports, verbose=True):
+    """Send cells that failed validation back to the model with their errors; returns the corrected cells"""
+    errors = {report['cell_number']: report for report in reports if report['status'] != 'ok'}
+    listing = "\n\n".join(
+        f"Cell {cell['cell_number']}"
+        + (f" - FAILED with {errors[cell['cell_number']]['status']}: {errors[cell['cell_number']]['error']}" if cell['cell_number'] in errors else " - ok")
+        + f"\n```python\n{cell['code']}\n```"
+        for cell in cells
+    )
+    
+    try:
+        log_reasoning_step("Cell Repair", f"Asking the model to fix {len(errors)} failing cell(s)", verbose)
+        max_tokens = response_profiles.max_tokens('cell_repair')
+        response = client.converse(
+            modelId=model_id,
+            messages=[{"role": "user", "content": [{"text": CELL_REPAIR_PROMPT.format(cells=listing)}]}],
+            inferenceConfig={
+                "maxTokens": max_tokens,
+                "temperature": 0.0,
+                "topP": 0.9
+            }
+        )
+        response_profiles.observe_converse('cell_repair', response, max_tokens)
+        repaired = extract_code_cells_from_response(response["output"]["message"]["content"][0]["text"])
+        if len(repaired) != len(cells):
+            return {"error": f"Repair returned {len(repaired)} cells for {len(cells)}"}
+        return {"success": True, "notebook_cells": repaired}
+        
+    except (ClientError, Exception) as e:
+        error_msg = f"Can't repair cells with '{model_id}'. Reason: {e}"
+        if verbose:
+            print(f"Error: {error_msg}")
+        return upstream_error(error_msg, e)
 
 def extract_code_cells_from_response(response_text):
     """Extract code cells from the AI response for notebook creation"""
@@ -544,7 +945,8 @@ def create_snowflake_notebook(cells, notebook_name="LabRat_Analysis"):
     }
     notebook_structure["cells"].append(conclusion_cell)
     
-    return notebook_structure
+    # Stable ids and content hashes let a re-run be sent to the extension as a patch (notebook_model.py)
+    return assign_cell_ids(notebook_structure)
 
 def analyze_drawing_with_reasoning(image_base64, verbose=True):
     """Analyze a drawing with detailed step-by-step reasoning about code conversion potential"""
@@ -631,15 +1033,17 @@ def analyze_drawing_with_reasoning(image_base64, verbose=True):
             print("Starting detailed reasoning analysis of drawing...")
             print("Sending image to Claude for comprehensive analysis...")
         
+        max_tokens = response_profiles.max_tokens('drawing_reasoning')
         response = client.converse(
             modelId=model_id,
             messages=conversation,
             inferenceConfig={
-                "maxTokens": 3000,  # Increased for detailed reasoning
+                "maxTokens": max_tokens,  # Observed p99 of detailed reasoning
                 "temperature": 0.1,  # Low temperature for consistent reasoning
                 "topP": 0.9
             }
         )
+        response_profiles.observe_converse('drawing_reasoning', response, max_tokens)
         
         response_text = response["output"]["message"]["content"][0]["text"]
         
@@ -672,7 +1076,7 @@ def analyze_drawing_with_reasoning(image_base64, verbose=True):
         error_msg = f"Can't analyze image with '{model_id}'. Reason: {e}"
         if verbose:
             print(f"Error during analysis: {error_msg}")
-        return {"error": error_msg}
+        return upstream_error(error_msg, e)
 
 def extract_score_from_text(text, score_type):
     """Extract numerical scores from the reasoning text"""
@@ -834,12 +1238,15 @@ def analyze_with_landingai(image_base64):
     except Exception as e:
         return {"error": f"LandingAI analysis failed: {str(e)}"}
 
-def call_writer_vision(prompt, image_data=None):
+# Throttling and 5xx answers count as failures even though requests does not raise for them
+writer_breaker = get_breaker("writer", is_failed_result=lambda response: response.status_code == 429 or response.status_code >= 500)
+
+def call_writer_vision(prompt, image_data=None, profile='writer'):
     """Call WRITER's vision API for image analysis and code generation"""
     
     try:
         # Get WRITER API key from environment
-        writer_api_key = os.getenv('WRITER_API_KEY')
+        writer_api_key = os.getenv('WRITER_API_KEY') or ('stub' if model_stub.stub_enabled() else None)
         if not writer_api_key:
             return {"error": "WRITER_API_KEY environment variable not set"}
         
@@ -895,16 +1302,35 @@ def call_writer_vision(prompt, image_data=None):
         payload = {
             "model": "palmyra-vision",  # WRITER's vision model
             "messages": messages,
-            "max_tokens": 1000,
+            "max_tokens": response_profiles.max_tokens(profile),
             "temperature": 0.1,
             "top_p": 0.9
         }
         
-        response = requests.post(writer_url, headers=headers, json=payload, timeout=30)
+        post = model_stub.stub_writer_post if model_stub.stub_enabled() else requests.post
+        # The Writer call is not streamed, so it can only be skipped, not interrupted
+        checkpoint('before_model_call')
+        started = time.perf_counter()
+        try:
+            response = writer_breaker.call(post, writer_url, headers=headers, json=payload, timeout=30)
+        except Exception as e:
+            usage_ledger.record("palmyra-vision", "call_writer_vision", wall_ms=round((time.perf_counter() - started) * 1000, 1),
+                                error=type(e).__name__, provider="writer")
+            raise
+        writer_usage = (response.json().get("usage") or {}) if response.status_code == 200 else {}
+        usage_ledger.record(
+            "palmyra-vision", "call_writer_vision",
+            usage={"inputTokens": writer_usage.get("prompt_tokens", 0), "outputTokens": writer_usage.get("completion_tokens", 0)},
+            wall_ms=round((time.perf_counter() - started) * 1000, 1),
+            error=None if response.status_code == 200 else f"HTTP {response.status_code}",
+            provider="writer"
+        )
         
         if response.status_code == 200:
             result = response.json()
             response_text = result["choices"][0]["message"]["content"]
+            response_profiles.observe(profile, writer_usage.get("completion_tokens"), payload["max_tokens"],
+                                      result["choices"][0].get("finish_reason") == "length")
             return {
                 "success": True,
                 "text": response_text,
@@ -913,13 +1339,30 @@ def call_writer_vision(prompt, image_data=None):
             }
         else:
             error_msg = f"WRITER API error {response.status_code}: {response.text}"
+            if response.status_code == 429 or response.status_code >= 500:
+                return {"error": error_msg, "unavailable": True, "retry_after": 5}
             return {"error": error_msg}
             
-    except requests.exceptions.RequestException as e:
-        return {"error": f"WRITER API request failed: {str(e)}"}
+    except (CircuitOpenError, RequestCancelled, requests.exceptions.RequestException) as e:
+        return upstream_error(f"WRITER API request failed: {str(e)}", e)
     except Exception as e:
         return {"error": f"WRITER vision analysis failed: {str(e)}"}
 
+WRITER_BRIEF_PROMPT = """You are an educational assistant for university students working on mathematical modeling and data analysis projects.
+
+Please analyze this image which may contain handwritten notes, mathematical equations, diagrams, or research content, and provide code cell suggestions for a Jupyter notebook. Be brief.
+
+## VISUAL ANALYSIS
+In 2-3 sentences: the equations, graphs and variables in the image.
+
+## CODE CELL SUGGESTIONS
+Provide 2-3 Python code cells that students could use in a Jupyter notebook:
+
+```python
+# Cell 1: Setup and data preparation
+# [Include actual code]
+```"""
+
 def analyze_with_writer_vision(image_data, include_reasoning=True, verbose=True):
     """Analyze drawing using WRITER's vision model with educational focus"""
     
@@ -979,7 +1422,10 @@ Focus on creating educational, step-by-step guidance that helps students learn t
     
     try:
         # Call WRITER Vision API
-        response = call_writer_vision(educational_prompt, image_data)
+        if not include_reasoning:
+            # Same analysis without the tutoring sections the client will not show
+            educational_prompt = WRITER_BRIEF_PROMPT
+        response = call_writer_vision(educational_prompt, image_data, 'writer' if include_reasoning else 'writer_brief')
         
         if response.get("success"):
             response_text = response["text"]
@@ -1013,7 +1459,7 @@ Focus on creating educational, step-by-step guidance that helps students learn t
             error_msg = response.get("error", "Unknown WRITER error")
             if verbose:
                 print(f"✗ WRITER Vision analysis failed: {error_msg}")
-            return {"error": error_msg}
+            return response
             
     except Exception as e:
         error_msg = f"WRITER vision analysis failed: {str(e)}"
@@ -0,0 +1,177 @@
+"""Local stand-in for Bedrock and the Writer API with injectable faults.
+
+With LABRAT_MODEL_STUB set, model.py talks to these stubs instead of the real services, so outages can be
+rehearsed without credentials: throttling, 5xx errors, timeouts and slow responses at configurable rates.
+
+    LABRAT_MODEL_STUB=1 python server.py
+    LABRAT_MODEL_STUB="error_rate=0.5,error=ThrottlingException,latency=0.2" python server.py
+
+Faults can also be changed at runtime through POST /api/stub/faults while the stub is active.
+"""
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+STUB_SPEC = os.getenv('LABRAT_MODEL_STUB', '')
+
+STUB_RESPONSE = """## VISUAL ANALYSIS
+A linear relationship, y = m x + b, sketched with labeled axes.
+
+## CODE CONVERSION ASSESSMENT
+- **Feasibility Score (1-10)**: 8
+
+## NOTEBOOK CODE CELLS
+```python
+# Cell 1: Evaluate the line
+import numpy as np
+x = np.linspace(0, 10, 50)
+y = 2 * x + 1  # TODO: use your fitted slope and intercept
+print(y[:5])
+```
+"""
+
+STREAM_CHUNK_CHARS = 40
+STREAM_CHUNK_SECONDS = 0.02
+
+DEFAULT_FAULTS = {
+    "latency": 0.0,        # seconds added to every call
+    "error_rate": 0.0,     # fraction of calls that fail
+    "error": "ThrottlingException",  # Bedrock error code, or 'timeout'
+    "timeout_seconds": 1.0,
+}
+
+def parse_faults(spec):
+    """'error_rate=0.5,error=ThrottlingException' -> fault settings (a bare '1' means no faults)"""
+    faults = dict(DEFAULT_FAULTS)
+    for part in spec.split(','):
+        if '=' not in part:
+            continue
+        key, value = (s.strip() for s in part.split('=', 1))
+        if key not in DEFAULT_FAULTS:
+            raise ValueError(f"Unknown stub fault: {key}")
+        faults[key] = value if key == 'error' else float(value)
+    return faults
+
+
+class FaultInjector:
+    def __init__(self, faults):
+        self.faults = faults
+        self.calls = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def configure(self, **faults):
+        unknown = set(faults) - set(DEFAULT_FAULTS)
+        if unknown:
+            raise ValueError(f"Unknown stub faults: {', '.join(sorted(unknown))}")
+        with self._lock:
+            self.faults.update({key: value if key == 'error' else float(value) for key, value in faults.items()})
+
+    def next_fault(self):
+        """Sleep the configured latency, then return the error to raise for this call (or None)"""
+        with self._lock:
+            self.calls += 1
+            faults = dict(self.faults)
+            failing = random.random() < faults["error_rate"]
+            if failing:
+                self.failures += 1
+        if faults["latency"]:
+            time.sleep(faults["latency"])
+        if not failing:
+            return None
+        if faults["error"] == 'timeout':
+            time.sleep(faults["timeout_seconds"])
+        return faults["error"]
+
+    def snapshot(self):
+        with self._lock:
+            return {"faults": dict(self.faults), "calls": self.calls, "failures": self.failures}
+
+
+class StubBedrockClient:
+    """Answers converse() with a canned analysis in the real response shape"""
+
+    def __init__(self, injector):
+        self.injector = injector
+
+    def converse(self, modelId=None, messages=None, inferenceConfig=None, **kwargs):
+        fault = self.injector.next_fault()
+        if fault == 'timeout':
+            raise ReadTimeoutError(endpoint_url="stub://bedrock-runtime")
+        if fault:
+            status = 429 if fault == 'ThrottlingException' else 503
+            raise ClientError(
+                {"Error": {"Code": fault, "Message": "Injected by LABRAT_MODEL_STUB"}, "ResponseMetadata": {"HTTPStatusCode": status}},
+                "Converse"
+            )
+        prompt_chars = sum(len(part.get("text", "")) for message in messages or [] for part in message["content"])
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": STUB_RESPONSE}]}},
+            "stopReason": "end_turn",
+            "usage": {"inputTokens": prompt_chars // 4, "outputTokens": len(STUB_RESPONSE) // 4,
+                      "totalTokens": (prompt_chars + len(STUB_RESPONSE)) // 4},
+            "metrics": {"latencyMs": int(self.injector.faults["latency"] * 1000)},
+        }
+
+
+    def converse_stream(self, modelId=None, messages=None, inferenceConfig=None, **kwargs):
+        """The same answer as an event stream, a few words per chunk, so cancellation can cut it short"""
+        response = self.converse(modelId=modelId, messages=messages, inferenceConfig=inferenceConfig, **kwargs)
+        text = response["output"]["message"]["content"][0]["text"]
+        return {"stream": StubEventStream(text, response["stopReason"], response["usage"], response["metrics"])}
+
+
+class StubEventStream:
+    """Iterable of converse_stream events; chunks arrive STREAM_CHUNK_SECONDS apart"""
+
+    def __init__(self, text, stop_reason, usage, metrics):
+        self.text = text
+        self.stop_reason = stop_reason
+        self.usage = usage
+        self.metrics = metrics
+        self.closed = False
+
+    def __iter__(self):
+        yield {"messageStart": {"role": "assistant"}}
+        for start in range(0, len(self.text), STREAM_CHUNK_CHARS):
+            if self.closed:
+                return
+            time.sleep(STREAM_CHUNK_SECONDS)
+            yield {"contentBlockDelta": {"delta": {"text": self.text[start:start + STREAM_CHUNK_CHARS]}, "contentBlockIndex": 0}}
+        yield {"contentBlockStop": {"contentBlockIndex": 0}}
+        yield {"messageStop": {"stopReason": self.stop_reason}}
+        yield {"metadata": {"usage": self.usage, "metrics": self.metrics}}
+
+    def close(self):
+        self.closed = True
+
+
+class StubWriterResponse:
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self._payload = payload
+        self.text = str(payload)
+
+    def json(self):
+        return self._payload
+
+
+def stub_writer_post(url, headers=None, json=None, timeout=None):
+    """Drop-in for requests.post against the Writer chat completions API"""
+    import requests
+
+    fault = injector.next_fault()
+    if fault == 'timeout':
+        raise requests.exceptions.Timeout("Injected timeout (LABRAT_MODEL_STUB)")
+    if fault:
+        return StubWriterResponse(429 if fault == 'ThrottlingException' else 503, {"error": fault})
+    return StubWriterResponse(200, {"choices": [{"message": {"content": STUB_RESPONSE}}]})
+
+
+injector = FaultInjector(parse_faults(STUB_SPEC)) if STUB_SPEC else None
+
+def stub_enabled():
+    return injector is not None
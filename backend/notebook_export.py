@@ -0,0 +1,179 @@
+"""Generated notebooks as real .ipynb files: nbformat v4, plain Jupyter or Snowflake Notebooks flavoured.
+
+create_snowflake_notebook() builds LabRat's own structure ({cell_type, content | code, description, ...}).
+to_ipynb() converts it once, on the server, so Jupyter, VS Code and Snowflake's "Import .ipynb" read it as is:
+
+    ipynb      nbformat 4.5 with a python3 kernelspec
+    snowflake  the same document with Snowflake's cell metadata (unique cell name, language) and kernelspec
+
+iter_ipynb() serializes cell by cell (serialization.dumps: orjson when installed) so a large notebook is
+streamed, not built as one string. NotebookExports caches every export per analysis id and format under
+data/exports; the ETag comes from the stored notebook's stamp (its modification time on local disk, a
+content hash on a shared cache), so a conditional GET is answered without converting anything and a
+repeated download is a file copy.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+
+from analysis_cache import DATA_DIR, load_notebook, notebook_stamp
+from notebook_model import assign_cell_ids
+from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR = os.getenv('LABRAT_EXPORT_DIR', os.path.join(DATA_DIR, 'exports'))
+# Bump when the converted documents change so cached exports are not served any more
+EXPORT_VERSION = 1
+FORMATS = ('ipynb', 'snowflake')
+CHUNK_BYTES = 64 * 1024
+
+KERNELSPECS = {
+    'ipynb': {"display_name": "Python 3", "language": "python", "name": "python3"},
+    'snowflake': {"display_name": "Streamlit Notebook", "name": "streamlit"},
+}
+
+def _source_lines(text):
+    # nbformat stores source as a list of lines, each keeping its newline
+    return (text or '').splitlines(keepends=True)
+
+def _snowflake_name(cell, index, used):
+    base = re.sub(r'[^0-9a-zA-Z_]+', '_', (cell.get('description') or '').strip().lower()).strip('_')[:40]
+    name = base or f"cell{index + 1}"
+    suffix = 1
+    while name in used:
+        suffix += 1
+        name = f"{base or 'cell'}_{suffix}"
+    used.add(name)
+    return name
+
+def convert_cell(cell, index, fmt='ipynb', used_names=None):
+    """One LabRat cell as an nbformat v4 cell"""
+    if cell.get('cell_type') == 'markdown':
+        converted = {"cell_type": "markdown", "id": cell['id'], "metadata": {}, "source": _source_lines(cell.get('content'))}
+    else:
+        converted = {"cell_type": "code", "execution_count": None, "id": cell['id'], "metadata": {},
+                     "outputs": [], "source": _source_lines(cell.get('code'))}
+        if cell.get('description'):
+            converted["metadata"]["labrat"] = {"description": cell['description']}
+    if fmt == 'snowflake':
+        language = 'markdown' if cell.get('cell_type') == 'markdown' else (cell.get('language') or 'python').lower()
+        converted["metadata"].update({
+            "name": _snowflake_name(cell, index, used_names if used_names is not None else set()),
+            "language": language,
+            "collapsed": False,
+        })
+    return converted
+
+def notebook_metadata(notebook, fmt='ipynb'):
+    return {
+        "kernelspec": KERNELSPECS[fmt],
+        "language_info": {"name": "python"},
+        "labrat": {"name": notebook.get('name'), "description": notebook.get('description')},
+    }
+
+def iter_ipynb(notebook, fmt='ipynb'):
+    """The .ipynb document as byte chunks of about CHUNK_BYTES, serialized one cell at a time"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown notebook format: {fmt} (choose from {', '.join(FORMATS)})")
+    assign_cell_ids(notebook)
+    used_names = set()
+    buffer = bytearray(b'{"cells":[')
+    for index, cell in enumerate(notebook['cells']):
+        if index:
+            buffer += b','
+        buffer += dumps(convert_cell(cell, index, fmt, used_names))
+        if len(buffer) >= CHUNK_BYTES:
+            yield bytes(buffer)
+            buffer.clear()
+    buffer += b'],"metadata":' + dumps(notebook_metadata(notebook, fmt)) + b',"nbformat":4,"nbformat_minor":5}\n'
+    yield bytes(buffer)
+
+def to_ipynb(notebook, fmt='ipynb'):
+    """The .ipynb document as a dict, for callers that work with it in process"""
+    return json.loads(b''.join(iter_ipynb(notebook, fmt)))
+
+
+class NotebookExports:
+    """Cached .ipynb exports per analysis id and format, with ETags for conditional GETs"""
+
+    def __init__(self, root=EXPORT_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(("hits", "misses", "not_modified"), 0)
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def etag(self, analysis_id, fmt):
+        """Changes whenever the stored notebook is rewritten; None when there is no notebook"""
+        stamp = notebook_stamp(analysis_id)
+        if stamp is None:
+            return None
+        key = f"{EXPORT_VERSION}:{fmt}:{analysis_id}:{stamp}"
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()[:24]
+
+    def _path(self, analysis_id, fmt, etag):
+        return os.path.join(self.root, analysis_id[:2], f"{analysis_id}.{fmt}.{etag}.ipynb")
+
+    def stream(self, analysis_id, fmt, etag):
+        """Chunks of the export: from the cache, or generated while being written to it"""
+        path = self._path(analysis_id, fmt, etag)
+        if os.path.exists(path):
+            self.count("hits")
+            return self._read(path)
+        notebook = load_notebook(analysis_id)
+        if notebook is None:
+            raise FileNotFoundError(analysis_id)
+        self.count("misses")
+        return self._generate(notebook, fmt, path)
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_BYTES)
+                if not chunk:
+                    return
+                yield chunk
+
+    def _generate(self, notebook, fmt, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        complete = False
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter_ipynb(notebook, fmt):
+                    f.write(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            # A download abandoned half way must not leave a truncated export in the cache
+            if complete:
+                os.replace(tmp_path, path)
+                self._remove_stale(path)
+            else:
+                os.unlink(tmp_path)
+
+    @staticmethod
+    def _remove_stale(path):
+        analysis_id, fmt = os.path.basename(path).split('.')[:2]
+        for stale in glob.glob(os.path.join(os.path.dirname(path), f"{glob.escape(analysis_id)}.{fmt}.*.ipynb")):
+            if stale != path:
+                try:
+                    os.unlink(stale)
+                except OSError as e:
+                    logger.warning(f"Could not remove stale export {stale}: {e}")
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+notebook_exports = NotebookExports()
@@ -0,0 +1,240 @@
+"""Notebook cells with stable ids and content hashes, and compact patches between two notebooks.
+
+A cell's id comes from what the cell is (its description, or its place among the markdown cells), so
+re-running an analysis that produces the same cells produces the same ids. Its hash is the SHA-256 of its
+source (trailing newlines are not part of a cell's content). diff_notebooks() compares a notebook the
+extension already injected with a newer one and returns only what changed:
+
+    {"base_version": ..., "version": ..., "unchanged": 5, "ops": [
+        {"op": "update", "id": "c3f0...", "cell_type": "code", "base": "<old hash>", "hash": "<new hash>",
+         "edits": [[12, 30, "x**3"]]},
+        {"op": "add", "id": "c9a1...", "after": "c3f0...", "cell": {...}},
+        {"op": "move", "id": "c07b...", "after": null},
+        {"op": "remove", "id": "c5d2..."}]}
+
+Edits are [from, to, insert] against the old source, the shape of a CodeMirror change, so the injector
+applies them to the editor as one transaction. Cells of the new notebook that match an old cell (same id,
+same content, or same position) keep the old cell's id; the new notebook is returned with those ids so the
+next patch can start from it.
+"""
+import difflib
+import hashlib
+import re
+
+SOURCE_FIELDS = {"code": "code", "markdown": "content"}
+# Cell fields that are not content but still travel in an update when they change
+META_FIELDS = ("language", "description", "cell_number")
+
+class PatchConflict(ValueError):
+    """A patch does not apply to the notebook it was given"""
+
+
+def cell_source(cell):
+    return (cell.get(SOURCE_FIELDS.get(cell.get("cell_type"), "code")) or "").rstrip("\n")
+
+def cell_hash(cell):
+    return hashlib.sha256(cell_source(cell).encode("utf-8")).hexdigest()[:16]
+
+def _identity(cell, markdown_index):
+    if cell.get("cell_type") == "markdown":
+        return f"markdown:{markdown_index}"
+    label = cell.get("description") or cell_source(cell).split("\n", 1)[0]
+    return "code:" + re.sub(r"\s+", " ", label).strip().lower()
+
+def assign_cell_ids(notebook):
+    """Add an id and content hash to every cell (existing ids are kept); returns the notebook"""
+    used = {cell["id"] for cell in notebook["cells"] if cell.get("id")}
+    markdown_index = 0
+    for cell in notebook["cells"]:
+        if not cell.get("id"):
+            digest = hashlib.sha256(_identity(cell, markdown_index).encode("utf-8")).hexdigest()
+            cell_id, suffix = f"c{digest[:10]}", 1
+            while cell_id in used:
+                suffix += 1
+                cell_id = f"c{digest[:10]}-{suffix}"
+            cell["id"] = cell_id
+            used.add(cell_id)
+        cell["hash"] = cell_hash(cell)
+        markdown_index += cell.get("cell_type") == "markdown"
+    return notebook
+
+def notebook_version(notebook):
+    """Hash of the ordered (id, hash) pairs: equal versions mean equal cells"""
+    digest = hashlib.sha256()
+    for cell in notebook["cells"]:
+        digest.update(f"{cell['id']}:{cell['hash']}\n".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+def text_edits(old, new):
+    """[from, to, insert] edits turning old into new, diffed by line and then by character within a line"""
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    offsets = [0]
+    for line in old_lines:
+        offsets.append(offsets[-1] + len(line))
+
+    edits = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes():
+        if tag == "equal":
+            continue
+        start, end = offsets[i1], offsets[i2]
+        old_text, new_text = old[start:end], "".join(new_lines[j1:j2])
+        # Trim the common prefix and suffix so a one-character fix is sent as one character
+        prefix = 0
+        while prefix < min(len(old_text), len(new_text)) and old_text[prefix] == new_text[prefix]:
+            prefix += 1
+        suffix = 0
+        while (suffix < min(len(old_text), len(new_text)) - prefix
+               and old_text[-1 - suffix] == new_text[-1 - suffix]):
+            suffix += 1
+        edits.append([start + prefix, end - suffix, new_text[prefix:len(new_text) - suffix]])
+    return edits
+
+def apply_text_edits(text, edits):
+    for start, end, insert in sorted(edits, key=lambda edit: edit[0], reverse=True):
+        text = text[:start] + insert + text[end:]
+    return text
+
+def _match_cells(old_cells, new_cells):
+    """new index -> old index, by id, then identical content, then position among the same cell type"""
+    matches, taken = {}, set()
+    old_by_id = {cell["id"]: i for i, cell in enumerate(old_cells)}
+    for j, cell in enumerate(new_cells):
+        i = old_by_id.get(cell.get("id"))
+        if i is not None and i not in taken and old_cells[i].get("cell_type") == cell.get("cell_type"):
+            matches[j] = i
+            taken.add(i)
+
+    old_by_hash = {}
+    for i, cell in enumerate(old_cells):
+        if i not in taken:
+            old_by_hash.setdefault(cell["hash"], []).append(i)
+    for j, cell in enumerate(new_cells):
+        candidates = old_by_hash.get(cell_hash(cell)) if j not in matches else None
+        while candidates:
+            i = candidates.pop(0)
+            if i not in taken:
+                matches[j] = i
+                taken.add(i)
+                break
+
+    free_old = [i for i in range(len(old_cells)) if i not in taken]
+    for j, cell in enumerate(new_cells):
+        if j in matches:
+            continue
+        for i in free_old:
+            if old_cells[i].get("cell_type") == cell.get("cell_type"):
+                matches[j] = i
+                free_old.remove(i)
+                break
+    return matches
+
+def _stationary(sequence):
+    """Positions of a longest increasing subsequence: matched cells that keep their relative order"""
+    tails, tail_positions, previous = [], [], [None] * len(sequence)
+    for position, value in enumerate(sequence):
+        low, high = 0, len(tails)
+        while low < high:
+            mid = (low + high) // 2
+            if tails[mid] < value:
+                low = mid + 1
+            else:
+                high = mid
+        previous[position] = tail_positions[low - 1] if low else None
+        if low == len(tails):
+            tails.append(value)
+            tail_positions.append(position)
+        else:
+            tails[low] = value
+            tail_positions[low] = position
+    keep = set()
+    position = tail_positions[-1] if tail_positions else None
+    while position is not None:
+        keep.add(position)
+        position = previous[position]
+    return keep
+
+def diff_notebooks(old, new):
+    """Compact patch from old to new, and new with the ids of the old cells it matched"""
+    assign_cell_ids(old)
+    new_cells = [dict(cell) for cell in new["cells"]]
+    matches = _match_cells(old["cells"], new_cells)
+
+    # Matched cells inherit the old id; an unmatched cell whose id is now taken gets a fresh one
+    used = set()
+    for j, cell in enumerate(new_cells):
+        if j in matches:
+            cell["id"] = old["cells"][matches[j]]["id"]
+            used.add(cell["id"])
+    for j, cell in enumerate(new_cells):
+        if j not in matches and cell.get("id") in used:
+            cell.pop("id")
+    rebased = assign_cell_ids({**new, "cells": new_cells})
+
+    ops = [{"op": "remove", "id": cell["id"]}
+           for i, cell in enumerate(old["cells"]) if i not in set(matches.values())]
+    matched_positions = [j for j in range(len(new_cells)) if j in matches]
+    stationary = {matched_positions[k] for k in _stationary([matches[j] for j in matched_positions])}
+    unchanged = 0
+    for j, cell in enumerate(new_cells):
+        after = new_cells[j - 1]["id"] if j else None
+        if j not in matches:
+            ops.append({"op": "add", "id": cell["id"], "after": after, "cell": cell})
+            continue
+        old_cell = old["cells"][matches[j]]
+        if j not in stationary:
+            ops.append({"op": "move", "id": cell["id"], "after": after})
+        fields = {field: cell.get(field) for field in META_FIELDS if cell.get(field) != old_cell.get(field)}
+        if cell["hash"] != old_cell["hash"] or fields:
+            update = {"op": "update", "id": cell["id"], "cell_type": cell.get("cell_type"), "base": old_cell["hash"],
+                      "hash": cell["hash"], "edits": text_edits(cell_source(old_cell), cell_source(cell))}
+            if fields:
+                update["fields"] = fields
+            ops.append(update)
+        elif j in stationary:
+            unchanged += 1
+
+    patch = {
+        "base_version": notebook_version(old),
+        "version": notebook_version(rebased),
+        "unchanged": unchanged,
+        "ops": ops,
+    }
+    if new.get("name") != old.get("name"):
+        patch["name"] = new.get("name")
+    return patch, rebased
+
+def apply_patch(notebook, patch):
+    """Apply a patch from diff_notebooks to the notebook it was computed from; returns a new notebook"""
+    assign_cell_ids(notebook)
+    if notebook_version(notebook) != patch["base_version"]:
+        raise PatchConflict("Patch was computed from a different notebook version")
+    cells = {cell["id"]: dict(cell) for cell in notebook["cells"]}
+    order = [cell["id"] for cell in notebook["cells"]]
+
+    for op in patch["ops"]:
+        if op["op"] in ("remove", "move"):
+            if op["id"] not in cells:
+                raise PatchConflict(f"Unknown cell: {op['id']}")
+            order.remove(op["id"])
+            if op["op"] == "remove":
+                del cells[op["id"]]
+        if op["op"] in ("add", "move"):
+            if op["op"] == "add":
+                cells[op["id"]] = dict(op["cell"])
+            order.insert(order.index(op["after"]) + 1 if op["after"] else 0, op["id"])
+        elif op["op"] == "update":
+            cell = cells[op["id"]]
+            if cell["hash"] != op["base"]:
+                raise PatchConflict(f"Cell {op['id']} changed since the patch was computed")
+            cell.update(op.get("fields", {}))
+            field = SOURCE_FIELDS.get(cell.get("cell_type"), "code")
+            cell[field] = apply_text_edits(cell_source(cell), op["edits"])
+            cell["hash"] = cell_hash(cell)
+
+    result = {**notebook, "cells": [cells[cell_id] for cell_id in order]}
+    if "name" in patch:
+        result["name"] = patch["name"]
+    if notebook_version(result) != patch["version"]:
+        raise PatchConflict("Patched notebook does not match the patch's version")
+    return result
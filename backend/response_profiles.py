@@ -0,0 +1,132 @@
+"""Output-length profiles per request type: maxTokens from observed answer lengths instead of fixed guesses.
+
+Every model call names a profile ('tutor', 'drawing', 'drawing_brief', ...). After the call, the answer's
+output token count is added to that profile's rolling window. Once a profile has MIN_SAMPLES answers its
+maxTokens becomes p99 * HEADROOM, rounded up to a multiple of 64 and kept between the profile's floor and
+ceiling. A truncated answer only says the real length was larger than the limit, so it is recorded as
+TRUNCATION_GROWTH times the limit, which lifts p99 until truncations stop.
+
+Windows are saved to data/response_profiles.json so a restart does not fall back to the defaults.
+
+    LABRAT_ADAPTIVE_MAX_TOKENS=0 python server.py     # always use the profile defaults
+"""
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from analysis_cache import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+ADAPTIVE = os.getenv('LABRAT_ADAPTIVE_MAX_TOKENS', '1').lower() not in ('0', 'false', 'off')
+PROFILES_PATH = os.getenv('LABRAT_RESPONSE_PROFILES', os.path.join(DATA_DIR, 'response_profiles.json'))
+WINDOW = int(os.getenv('LABRAT_RESPONSE_PROFILE_WINDOW', '500'))
+MIN_SAMPLES = 20
+HEADROOM = 1.15
+TRUNCATION_GROWTH = 1.5
+SAVE_INTERVAL_SECONDS = 30
+
+# name: (default maxTokens, floor, ceiling); the defaults are the limits used before profiling
+PROFILES = {
+    'tutor': (500, 256, 1500),
+    'drawing': (2500, 1024, 4096),
+    'drawing_brief': (1200, 512, 2500),
+    'drawing_delta': (1200, 512, 2500),
+    'drawing_reasoning': (3000, 1024, 4096),
+    'equation_cells': (800, 256, 1600),
+    'cell_repair': (2000, 512, 4096),
+    'dataset': (1500, 512, 3000),
+    'writer': (1000, 512, 2000),
+    'writer_brief': (800, 256, 1500),
+}
+
+class ResponseProfiles:
+    """Rolling output-length windows per profile and the maxTokens they imply"""
+
+    def __init__(self, path=PROFILES_PATH, window=WINDOW, adaptive=ADAPTIVE):
+        self.path = path
+        self.adaptive = adaptive
+        self._samples = {name: deque(maxlen=window) for name in PROFILES}
+        self._truncations = dict.fromkeys(PROFILES, 0)
+        self._lock = threading.Lock()
+        self._saved_at = time.time()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                stored = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        for name, samples in stored.items():
+            if name in self._samples:
+                self._samples[name].extend(samples)
+
+    def _save(self):
+        with self._lock:
+            payload = {name: list(samples) for name, samples in self._samples.items() if samples}
+            self._saved_at = time.time()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(payload, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not save response profiles: {e}")
+
+    def max_tokens(self, name):
+        """maxTokens for the next call of a profile: the default until MIN_SAMPLES answers were seen"""
+        default, floor, ceiling = PROFILES[name]
+        if not self.adaptive:
+            return default
+        with self._lock:
+            samples = np.array(self._samples[name], dtype=np.float64)
+        if samples.size < MIN_SAMPLES:
+            return default
+        limit = math.ceil(np.percentile(samples, 99) * HEADROOM / 64) * 64
+        return int(min(ceiling, max(floor, limit)))
+
+    def observe(self, name, output_tokens, max_tokens, truncated=False):
+        """Add one answer's length; truncated answers count as longer than the limit they hit"""
+        if not output_tokens:
+            return
+        with self._lock:
+            if truncated:
+                self._truncations[name] += 1
+                output_tokens = max(output_tokens, max_tokens) * TRUNCATION_GROWTH
+            self._samples[name].append(int(output_tokens))
+            due = time.time() - self._saved_at > SAVE_INTERVAL_SECONDS
+        if due:
+            self._save()
+
+    def observe_converse(self, name, response, max_tokens):
+        """Record a Bedrock converse response (usage.outputTokens, stopReason 'max_tokens')"""
+        self.observe(name, (response.get('usage') or {}).get('outputTokens'), max_tokens,
+                     response.get('stopReason') == 'max_tokens')
+
+    def snapshot(self):
+        result = {}
+        for name, (default, floor, ceiling) in PROFILES.items():
+            with self._lock:
+                samples = np.array(self._samples[name], dtype=np.float64)
+                truncations = self._truncations[name]
+            result[name] = {
+                "samples": int(samples.size),
+                "p50_tokens": round(float(np.percentile(samples, 50))) if samples.size else None,
+                "p99_tokens": round(float(np.percentile(samples, 99))) if samples.size else None,
+                "truncations": truncations,
+                "default_max_tokens": default,
+                "max_tokens": self.max_tokens(name),
+            }
+        return result
+
+
+response_profiles = ResponseProfiles()
@@ -0,0 +1,145 @@
+"""Response serialization: a faster JSON encoder, negotiated compression and de-duplicated notebook cells.
+
+FastJSONProvider replaces Flask's json provider, so every jsonify() goes through orjson when it is
+installed (the standard library otherwise, with the same output apart from key order and whitespace).
+numpy values are serialized natively instead of failing.
+
+compress_response() is an after_request hook. It brotli- or gzip-encodes JSON, CSV and text bodies of at
+least MIN_COMPRESS_BYTES, following the client's Accept-Encoding. Streamed responses and files (exports,
+blobs) are left alone.
+
+A drawing analysis carries its code cells twice, once in notebook_cells and again in notebook.cells.
+Clients that send "X-LabRat-Cell-Refs: 1" get the notebook's copies as {"cell_ref": <id>}, and resolve
+them against notebook_cells (assistant.js resolveCellRefs).
+
+    LABRAT_COMPRESSION=0 python server.py      # send uncompressed bodies
+    python benchmarks/bench_serialization.py   # encode time and bytes on the wire per endpoint
+"""
+import decimal
+import gzip
+import json
+import os
+
+from flask import has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # Listed in requirements.txt; without it the standard library encoder is used
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # Listed in requirements.txt; without it only gzip is offered
+    brotli = None
+
+COMPRESSION = os.getenv('LABRAT_COMPRESSION', '1').lower() not in ('0', 'false', 'off')
+MIN_COMPRESS_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ipynb+json', 'text/csv', 'text/plain', 'text/html')
+CELL_REFS_HEADER = 'X-LabRat-Cell-Refs'
+# How deep to look for analysis results (job listings nest them as jobs[].result)
+MAX_DEDUPE_DEPTH = 4
+
+def _default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    return DefaultJSONProvider.default(value)
+
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+def dumps(value):
+    """JSON bytes, compact"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, default=_default, option=ORJSON_OPTIONS)
+        except TypeError:
+            # Integers beyond 64 bits, subclasses orjson rejects: the standard library handles them
+            pass
+    return json.dumps(value, default=_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dedupe_cells(payload, depth=0):
+    """Copy of payload where notebook cells identical to a notebook_cells entry become {"cell_ref": id}"""
+    if depth > MAX_DEDUPE_DEPTH:
+        return payload
+    if isinstance(payload, list):
+        return [dedupe_cells(item, depth + 1) for item in payload]
+    if not isinstance(payload, dict):
+        return payload
+
+    result = {key: dedupe_cells(value, depth + 1) if isinstance(value, (dict, list)) else value
+              for key, value in payload.items()}
+    notebook, cells = result.get('notebook'), result.get('notebook_cells')
+    if isinstance(notebook, dict) and isinstance(cells, list):
+        by_id = {cell.get('id'): cell for cell in cells if isinstance(cell, dict) and cell.get('id')}
+        result['notebook'] = {**notebook, "cells": [
+            {"cell_ref": cell['id']} if isinstance(cell, dict) and by_id.get(cell.get('id')) == cell else cell
+            for cell in notebook.get('cells', [])
+        ]}
+    return result
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask json provider on the encoder above; honours the cell-reference opt-in of the request"""
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if has_request_context() and request.headers.get(CELL_REFS_HEADER) == '1':
+            obj = dedupe_cells(obj)
+        return self._app.response_class(dumps(obj) + b"\n", mimetype=self.mimetype)
+
+
+def choose_encoding(accept_encodings):
+    """'br', 'gzip' or None for an Accept-Encoding header (as parsed by werkzeug)"""
+    br = accept_encodings.quality('br') if brotli is not None else 0
+    gz = accept_encodings.quality('gzip')
+    if br and br >= gz:
+        return 'br'
+    return 'gzip' if gz else None
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+def compress_response(response):
+    """after_request hook: compress a buffered text body when the client accepts it"""
+    if (not COMPRESSION or response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.content_length is not None and response.content_length < MIN_COMPRESS_BYTES:
+        return response
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    body = response.get_data()
+    if len(body) < MIN_COMPRESS_BYTES:
+        return response
+    response.set_data(compress(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
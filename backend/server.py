@@ -2,28 +2,368 @@ import boto3
 from botocore.exceptions import ClientError
 import json
 import base64
+import contextlib
 import io
-from flask import Flask, request, jsonify
+import os
+import functools
+import math
+import uuid
+from flask import Flask, Response, request, jsonify, send_file, make_response
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.utils import secure_filename
 from flask_cors import CORS
-from PyPDF2 import PdfReader
-from docx import Document
 from PIL import Image
 
+from serialization import FastJSONProvider, compress_response
+
 app = Flask(__name__)
-CORS(app)  # Allow requests from your Chrome extension
+# Behind a reverse proxy, LABRAT_PROXY_HOPS=1 takes the client address (which admission limits) from X-Forwarded-For
+if int(os.getenv('LABRAT_PROXY_HOPS', '0')):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.getenv('LABRAT_PROXY_HOPS')))
+CORS(app, expose_headers=['Retry-After', 'X-LabRat-Cache-Node'])  # Allow requests from your Chrome extension
+# orjson-backed jsonify, cell references for opted-in clients, gzip/brotli bodies
+app.json = FastJSONProvider(app)
+app.after_request(compress_response)
 
 # Import your educational model
-from model import call_model, process_whiteboard_to_code, analyze_experiment_data, guide_simulation_building, extract_math_from_drawing, create_snowflake_notebook, analyze_with_landingai, analyze_drawing_with_reasoning, analyze_with_writer_vision, print_analysis_header, log_reasoning_step
+from model import call_model, process_whiteboard_to_code, analyze_experiment_data, guide_simulation_building, update_analysis_from_diff, analyze_recognized_equation, repair_cells, analyze_dataset_profile, create_snowflake_notebook, analyze_drawing_with_reasoning, print_analysis_header, log_reasoning_step, prepare_drawing_image
+from job_queue import JobQueue, LANES
+from stroke_renderer import render_stroke_update, render_strokes_canvas, stroke_sessions, StrokeSyncError
+from drawing_diff import drawing_sessions, to_canvas_space
+from analysis_cache import analysis_key, get_cached_analysis, store_analysis, save_notebook, load_notebook, is_analysis_id
+from notebook_model import diff_notebooks
+from notebook_export import notebook_exports, iter_ipynb, FORMATS as EXPORT_FORMATS
+from math_ocr import recognize_equation, is_confident_equation
+from sim_templates import list_templates, render_template
+from simulation_runner import simulate, encode_json, encode_npz, encode_arrow, list_models
+from cell_sandbox import validate_cells
+from data_ingest import tabular_format, ingest_table, load_cell, load_dataset, dataset_to_csv
+from artifact_store import artifact_store, ArtifactQuotaError, ANALYSIS_REF_TTL_SECONDS
+from document_extract import document_format, extract_document_cached
+from doc_retrieval import select_context
+from vision_providers import vision_registry, HEDGE_BY_DEFAULT
+from circuit_breaker import breaker_states, upstream_error, CircuitOpenError, ServerOverloaded
+import model_stub
+from model_stub import stub_enabled
+from admission import admission, estimate_tokens, RateLimited, MAX_IMAGE_TOKENS
+from usage_ledger import usage_ledger, usage_context, annotate_usage
+from response_profiles import response_profiles
+from speculation import speculative_runs
+from cancellation import cancellations, disconnect_monitor, request_socket, checkpoint, RequestCancelled
+from burst_pool import burst_pool, model_slots
+from cache_backends import cache_router, cache_stats
+
+class MissingBlobError(Exception):
+    """A request referenced a blob hash the store does not have - the client should upload it"""
+
+
+def blob_to_data_url(blob_hash, media_type=None):
+    """Base64 data URL for a stored blob, read through mmap"""
+    info = artifact_store.info(blob_hash)
+    if info is None:
+        raise MissingBlobError(blob_hash)
+    with artifact_store.open(blob_hash) as view:
+        encoded = base64.b64encode(view).decode('ascii')
+    return f"data:{media_type or info['media_type'] or 'application/octet-stream'};base64,{encoded}"
+
+def store_upload(file_info):
+    """Put an uploaded file's bytes in the blob store (deduplicated) and return its hash"""
+    if file_info.get('blob'):
+        if artifact_store.info(file_info['blob']) is None:
+            raise MissingBlobError(file_info['blob'])
+        return file_info['blob']
+    data = file_info.get('data') or ''
+    if data.startswith('data:'):
+        data = data.split(',', 1)[1]
+    return artifact_store.put(base64.b64decode(data), file_info.get('type'))
+
+def session_canvas(session_id, image_data, image_meta=None, from_strokes=False):
+    """Canvas-coordinate grayscale rendering of the current drawing, used to diff against the last analysis"""
+    try:
+        if from_strokes:
+            session = stroke_sessions.get(session_id)
+            return render_strokes_canvas(session[1], session[0]) if session else None
+        return to_canvas_space(image_data, image_meta)
+    except Exception as e:
+        log_reasoning_step("Incremental Analysis", f"Could not build canvas for diffing: {e}", False)
+        return None
+
+def preprocess_drawing(data, image_data, vision_model):
+    """CPU stage of a drawing analysis: rasterize strokes, build the diffing canvas and, in burst mode, prepare
+    the model image. Returns (image_data, stroke_info, canvas_image); raises StrokeSyncError or ValueError"""
+    stroke_info = None
+    if data.get('strokes'):
+        image_data, stroke_info = render_stroke_update(
+            data['strokes'],
+            data.get('session_id'),
+            data.get('stroke_base', 0),
+            vision_model
+        )
+    canvas_image = None
+    if data.get('session_id') and image_data and data.get('incremental', True):
+        canvas_image = session_canvas(data['session_id'], image_data, data.get('image_meta'), from_strokes=stroke_info is not None)
+    if burst_pool.enabled and image_data and vision_model in ('claude', 'auto'):
+        # Decoded and re-encoded here on the CPU pool; the vision call then finds it in the prepared-image cache
+        prepare_drawing_image(image_data, verbose=False)
+    return image_data, stroke_info, canvas_image
+
+def server_timing(timing):
+    """Server-Timing header value for the burst pool's queue and CPU times"""
+    names = {"queue_ms": "cpu-queue", "cpu_ms": "cpu"}
+    return ", ".join(f"{names[key]};dur={value:.1f}" for key, value in timing.items() if key in names)
+
+# off | compile | run - how generated cells are checked before they reach the student
+CELL_VALIDATION_MODE = os.getenv('LABRAT_VALIDATE_CELLS', 'compile')
+REPAIR_FAILED_CELLS = os.getenv('LABRAT_REPAIR_CELLS', '1') == '1'
+
+def check_generated_cells(result, mode=CELL_VALIDATION_MODE, repair=REPAIR_FAILED_CELLS, verbose=True, setup_cells=()):
+    """Validate model-generated cells and, when some fail, ask the model once to fix them.
+    setup_cells (a dataset's load cell) run first but are never sent for repair"""
+    setup_cells = list(setup_cells)
+    try:
+        validation = validate_cells(setup_cells + result['notebook_cells'], mode)
+        if not validation['valid'] and repair:
+            repaired = repair_cells(result['notebook_cells'], validation['cells'][len(setup_cells):], verbose)
+            if repaired.get('success'):
+                for cell, original in zip(repaired['notebook_cells'], result['notebook_cells']):
+                    cell['cell_number'] = original['cell_number']
+                retry = validate_cells(setup_cells + repaired['notebook_cells'], mode)
+                failures = lambda v: sum(1 for cell in v['cells'] if cell['status'] != 'ok')
+                if failures(retry) < failures(validation):
+                    result['notebook_cells'] = repaired['notebook_cells']
+                    validation = dict(retry, repaired=True)
+        result['cell_validation'] = validation
+        log_reasoning_step(
+            "Cell Validation",
+            f"{mode}: {'all cells ok' if validation['valid'] else 'some cells fail'}"
+            f"{' after repair' if validation.get('repaired') else ''} ({validation['total_ms']} ms)",
+            verbose
+        )
+    except Exception as e:
+        log_reasoning_step("Cell Validation", f"Skipped: {e}", verbose)
+    return result
+
+def degraded_drawing_result(failure, recognition, plan, include_reasoning=True, verbose=True):
+    """Best answer available while the vision providers are down: a low-confidence local equation, then the
+    session's previous analysis; otherwise the outage error itself"""
+    if recognition and recognition['latex'].count('=') == 1:
+        log_reasoning_step("Degraded Mode", f"Vision unavailable, using the local recognition ({recognition['confidence']:.2f})", verbose)
+        result = analyze_recognized_equation(recognition['latex'], recognition['confidence'], include_reasoning, verbose)
+        if result.get('success'):
+            return {**result, "degraded": True}
+    if plan.get('prior'):
+        log_reasoning_step("Degraded Mode", "Vision unavailable, returning the previous analysis of this drawing", verbose)
+        prior = dict(plan['prior'])
+        prior.pop('cached', None)
+        return {**prior, "degraded": True, "stale": True}
+    return failure
+
+# How long a click waits for a running speculative analysis of the same drawing
+SPECULATIVE_JOIN_SECONDS = float(os.getenv('LABRAT_SPECULATIVE_JOIN_SECONDS', '90'))
+# Speculation is skipped unless the student keeps this many requests in their rate-limit bucket for the click
+SPECULATIVE_MIN_HEADROOM = 2
+
+def analyze_drawing(image_data, vision_model='claude', include_reasoning=True, verbose=True, timestamp='latest', use_cache=True, session_id=None, canvas_image=None, hedge=None):
+    """Analyze a drawing with the chosen vision model ('auto' picks the fastest), reusing the cached result for an identical image
+
+    With a session id and canvas rendering, a small change to the previously analyzed drawing is sent to
+    the model as a cropped delta update instead of a full re-analysis.
+    """
+    if not image_data:
+        return {"error": "No image data provided"}
+    if vision_model != 'auto' and vision_model not in vision_registry.providers:
+        return {"error": f"Unknown vision model: {vision_model}"}
+    
+    track_session = session_id is not None and canvas_image is not None
+    
+    try:
+        key = analysis_key(image_data, 'drawing_analysis', vision_model=vision_model, include_reasoning=include_reasoning)
+    except (ValueError, TypeError):
+        key = None  # Invalid base64 - let the model path report the error
+    
+    if key and use_cache:
+        # The same drawing may already be under speculative analysis: wait for it rather than pay twice
+        if speculative_runs.join(key, SPECULATIVE_JOIN_SECONDS):
+            log_reasoning_step("Speculative Analysis", f"Waited for the speculative analysis {key[:12]}", verbose)
+        cached = get_cached_analysis(key)
+        if cached:
+            log_reasoning_step("Cache Hit", f"Reusing stored analysis {key[:12]}", verbose)
+            cached['cached'] = True
+            if speculative_runs.claim_hit(key):
+                cached['speculative'] = True
+            if track_session:
+                drawing_sessions.remember(session_id, canvas_image, cached)
+            return cached
+    
+    # Incremental re-analysis only applies to the Claude path, which owns the delta prompt
+    plan = {"mode": "full"}
+    if track_session and vision_model in ('claude', 'auto'):
+        plan = drawing_sessions.plan(session_id, canvas_image)
+        log_reasoning_step("Incremental Analysis", f"mode={plan['mode']} {plan.get('reason', '')}".strip(), verbose)
+    
+    result = None
+    recognition = None
+    if plan['mode'] == 'unchanged':
+        result = dict(plan['prior'])
+        result.pop('cached', None)
+        result['unchanged'] = True
+    elif plan['mode'] == 'delta':
+        result = update_analysis_from_diff(plan['crop'], plan['prior'], plan['region'], plan['canvas_size'], include_reasoning, verbose)
+        if not result.get('success'):
+            log_reasoning_step("Incremental Analysis", f"Delta update failed, running full analysis: {result.get('error')}", verbose)
+            result = None
+    
+    # Fast path: a single handwritten equation recognized locally with high confidence skips the vision call
+    checkpoint('drawing_ocr')
+    if result is None and vision_model in ('claude', 'auto'):
+        try:
+            recognition = recognize_equation(image_data)
+        except Exception as e:
+            log_reasoning_step("Local Math OCR", f"Recognition failed, using the vision model: {e}", verbose)
+            recognition = None
+        if is_confident_equation(recognition):
+            result = analyze_recognized_equation(recognition['latex'], recognition['confidence'], include_reasoning, verbose)
+            if not result.get('success'):
+                result = None
+        elif recognition:
+            log_reasoning_step("Local Math OCR", f"Low confidence ({recognition['confidence']:.2f}), using the vision model", verbose)
+    
+    if result is None:
+        checkpoint('drawing_vision')
+        # The registry times every provider call and can hedge a slow one with a second provider
+        result = vision_registry.analyze(image_data, vision_model, include_reasoning, verbose, hedge=hedge)
+        if result.get('unavailable'):
+            result = degraded_drawing_result(result, recognition, plan, include_reasoning, verbose)
+    
+    checkpoint('cell_validation')
+    # Templates are known-good; cached and unchanged results were validated when first produced
+    if (CELL_VALIDATION_MODE != 'off' and result.get('success') and result.get('notebook_cells')
+            and result.get('analysis_type') != 'simulation_template' and 'cell_validation' not in result):
+        result = check_generated_cells(result, verbose=verbose)
+    
+    # Create notebook if analysis was successful
+    if result.get('success') and result.get('notebook_cells'):
+        log_reasoning_step("Notebook Creation", f"Creating notebook with {len(result['notebook_cells'])} code cells", verbose)
+        result['notebook'] = create_snowflake_notebook(
+            result['notebook_cells'], 
+            f"Drawing_Analysis_{timestamp}"
+        )
+        if key and not result.get('degraded'):
+            save_notebook(key, result['notebook'])
+    
+    # Outage fallbacks are only returned: cached or remembered, they would outlive the outage
+    if key and result.get('success') and not result.get('degraded'):
+        result['analysis_id'] = key
+        store_analysis(key, result)
+    
+    if track_session and result.get('success') and not result.get('degraded'):
+        drawing_sessions.remember(session_id, canvas_image, result)
+    
+    return result
+
+def client_identity():
+    """(user id, class id) for admission control: extension headers, falling back to the client address"""
+    user_id = request.headers.get('X-LabRat-User') or request.remote_addr or 'anonymous'
+    class_id = request.headers.get('X-LabRat-Class') or 'default'
+    return user_id[:64], class_id[:64]
+
+def client_address():
+    """The connecting address; unlike the identity headers the client cannot choose it"""
+    return request.remote_addr or 'unknown'
+
+def estimate_request_tokens(data):
+    """Token estimate for a model request body (prompt, inline or referenced image, strokes, files)"""
+    data = data or {}
+    tokens = estimate_tokens(data.get('input') or '', data.get('image'))
+    if data.get('image_blob') or data.get('strokes'):
+        tokens += MAX_IMAGE_TOKENS
+    for file_info in data.get('files', []):
+        if file_info.get('data'):
+            size = len(file_info['data']) * 3 // 4
+        else:
+            size = (artifact_store.info(file_info.get('blob', '')) or {}).get('size', 0) if file_info.get('blob') else 0
+        # Long documents are cut down to their relevant chunks, so file cost is capped
+        tokens += min(size // 4, 4000) + 1500
+    return tokens
+
+def cancelled_response(reason):
+    # 499: nginx's "client closed request" - the client is usually gone, but a beacon-cancelled fetch may read it
+    response = jsonify({"error": f"Request cancelled ({reason})", "cancelled": True})
+    response.status_code = 499
+    return response
+
+def admission_controlled(schedule=True, charge_tokens=True):
+    """Route decorator: charge the caller's user and class budgets, hold a model slot while the view runs,
+    and answer 429 with Retry-After when a limit is reached. Without charge_tokens only the request is counted
+    (queued jobs are charged their tokens as each one starts). Model usage inside the view is attributed to
+    the caller in the usage ledger. In burst mode the slot is taken per model call instead (burst_pool.py),
+    so the view's CPU work does not hold one.
+
+    The view runs in a cancellation scope under the client's X-LabRat-Request id: POST /api/cancel or a
+    dropped connection stops its queued and in-flight model work."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            user_id, class_id = client_identity()
+            address = client_address()
+            request_id = request.headers.get('X-LabRat-Request') or uuid.uuid4().hex
+            slotted = schedule and burst_pool.enabled
+            with cancellations.scope(request_id) as token, disconnect_monitor.watch(request_id, request_socket(request.environ)):
+                try:
+                    tokens = estimate_request_tokens(request.get_json(silent=True)) if charge_tokens else 0
+                    release = admission.admit(user_id, class_id, tokens, schedule and not slotted, address)
+                except RateLimited as e:
+                    response = jsonify({"error": str(e), "limit": e.limit, "retry_after": e.retry_after and round(e.retry_after, 1)})
+                    if e.retry_after is None:
+                        response.status_code = 413
+                    else:
+                        response.status_code = 429
+                        response.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+                    return response
+                except RequestCancelled as e:
+                    return cancelled_response(e.reason)
+                try:
+                    with usage_context(request_type=view.__name__, user=user_id, class_id=class_id), \
+                            (model_slots(class_id) if slotted else contextlib.nullcontext()):
+                        response = make_response(view(*args, **kwargs))
+                except RequestCancelled as e:
+                    response = cancelled_response(e.reason)
+                finally:
+                    release()
+                if token.cancelled:
+                    # Whatever the view made of the interrupted work, the answer is that it was cancelled
+                    response = cancelled_response(token.reason)
+            for limit, remaining in admission.remaining(user_id, class_id, address).items():
+                response.headers[f"X-RateLimit-Remaining-{limit.replace('_', '-').title()}"] = str(remaining)
+            return response
+        return wrapper
+    return decorator
+
+def model_response(result):
+    """JSON response for a model result; upstream outages become 503 with Retry-After so clients back off"""
+    response = jsonify(result)
+    if result.get('cancelled'):
+        response.status_code = 499
+    elif result.get('unavailable'):
+        response.status_code = 503
+        response.headers['Retry-After'] = str(result.get('retry_after', 5))
+    return response
 
 @app.route('/api/labrat', methods=['POST'])
+@admission_controlled()
 def labrat():
     """Main endpoint for educational assistance"""
+    timing = {}
     try:
         data = request.json
         user_input = data.get('input', '')
         request_type = data.get('type', 'general')
+        annotate_usage(request_type=request_type)
         image_data = data.get('image', None)
         vision_model = data.get('vision_model', 'claude')  # Default to Claude
+        # A previously uploaded image can be referenced by hash instead of being sent again
+        if image_data is None and data.get('image_blob'):
+            image_data = blob_to_data_url(data['image_blob'])
         
         # Route to appropriate function based on type
         if request_type == 'whiteboard_conversion':
@@ -37,28 +377,36 @@ def labrat():
             # Print analysis header
             print_analysis_header("Drawing Analysis with Reasoning")
             
-            # Choose vision model based on request
-            if vision_model == 'landingai':
-                result = analyze_with_landingai(image_data)
-            elif vision_model == 'writer':
-                # Use WRITER's vision model
-                include_reasoning = data.get('include_reasoning', True)
-                verbose = data.get('verbose', True)
-                result = analyze_with_writer_vision(image_data, include_reasoning, verbose)
-            else:
-                # Default to Claude Bedrock
-                include_reasoning = data.get('include_reasoning', True)
-                verbose = data.get('verbose', True)
-                result = extract_math_from_drawing(image_data, include_reasoning, verbose)
-            
-            # Create notebook if analysis was successful
-            if result.get('success') and result.get('notebook_cells'):
-                log_reasoning_step("Notebook Creation", f"Creating notebook with {len(result['notebook_cells'])} code cells")
-                notebook = create_snowflake_notebook(
-                    result['notebook_cells'], 
-                    f"Drawing_Analysis_{data.get('timestamp', 'latest')}"
+            # Vector strokes are rasterized at the resolution the chosen vision model wants; in burst mode
+            # this and the image preparation run on the CPU pool, ahead of bulk and speculative work
+            try:
+                image_data, stroke_info, canvas_image = burst_pool.run(
+                    preprocess_drawing, data, image_data, vision_model, priority='interactive', timing=timing)
+            except StrokeSyncError as e:
+                return jsonify({"error": str(e), "resync": True, "stroke_count": e.server_count}), 409
+            except ValueError as e:
+                return jsonify({"error": f"Invalid stroke payload: {str(e)}"}), 400
+            if stroke_info:
+                log_reasoning_step(
+                    "Stroke Rendering",
+                    f"{stroke_info['stroke_count']} strokes ({stroke_info['payload_bytes']} bytes) rendered at "
+                    f"{stroke_info['rendered_size'][0]}x{stroke_info['rendered_size'][1]}",
+                    data.get('verbose', True)
                 )
-                result['notebook'] = notebook
+            
+            result = analyze_drawing(
+                image_data,
+                vision_model,
+                data.get('include_reasoning', True),
+                data.get('verbose', True),
+                data.get('timestamp', 'latest'),
+                use_cache=data.get('use_cache', True),
+                session_id=data.get('session_id'),
+                canvas_image=canvas_image,
+                hedge=data.get('hedge')
+            )
+            if stroke_info:
+                result.update(stroke_info)
         
         elif request_type == 'detailed_reasoning':
             # New endpoint for detailed reasoning analysis
@@ -69,12 +417,85 @@ def labrat():
         else:
             result = call_model(user_input, image_data)
             
-        return jsonify(result)
+        response = model_response(result)
+        if timing:
+            response.headers['Server-Timing'] = server_timing(timing)
+        return response
         
+    except (CircuitOpenError, ServerOverloaded) as e:
+        return model_response(upstream_error(str(e), e))
+    except MissingBlobError as e:
+        return jsonify({"error": f"Unknown blob: {e}", "missing_blob": str(e)}), 404
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-def process_uploaded_file(file_data, file_type):
+def analyze_dataset_upload(file_data, decoded_data, table_format, filename=None):
+    """Profile a tabular upload locally and send only the profile to the model"""
+    key = analysis_key(file_data, 'dataset_analysis')
+    cached = get_cached_analysis(key)
+    if cached:
+        cached['cached'] = True
+        return cached
+    
+    dataset = ingest_table(decoded_data, table_format, filename)
+    log_reasoning_step("Dataset Ingest", f"{dataset['rows']} rows x {len(dataset['columns'])} columns parsed and profiled", False)
+    
+    result = analyze_dataset_profile(dataset['profile_text'], dataset['columns'], verbose=False)
+    if not result.get('success'):
+        return result
+    
+    # The load cell recreates `df` from the stored data; the model's cells build on it
+    data_cell = load_cell(dataset)
+    for i, cell in enumerate(result['notebook_cells']):
+        cell['cell_number'] = i + 2
+    result['dataset'] = {key_: dataset[key_] for key_ in ('id', 'filename', 'rows', 'columns', 'profile')}
+    
+    # Only the model's cells go to repair - the load cell can embed ~150KB of data the prompt must not carry
+    if CELL_VALIDATION_MODE != 'off':
+        result = check_generated_cells(result, verbose=False, setup_cells=[data_cell])
+    result['notebook_cells'] = [data_cell] + result['notebook_cells']
+    result['notebook'] = create_snowflake_notebook(result['notebook_cells'], f"Dataset_{dataset['filename']}")
+    save_notebook(key, result['notebook'])
+    result['analysis_id'] = key
+    store_analysis(key, result)
+    return result
+
+DOCUMENT_LABELS = {'pdf': "PDF content", 'docx': "Document content", 'txt': "Text file content"}
+
+def analyze_document_upload(decoded_data, document_type, question=None):
+    """Extract a document's text (headings, tables and equations included) and analyze the parts relevant to the question"""
+    extraction = extract_document_cached(decoded_data, document_type)
+    stats = extraction['stats']
+    log_reasoning_step(
+        "Document Extract",
+        f"{stats['blocks']} blocks ({stats['tables']} tables, {stats['equations']} equations), "
+        f"{stats['chars']} characters{' from cache' if extraction['cached'] else ''}",
+        False
+    )
+    if not extraction['text'].strip():
+        return {"error": "No text could be extracted from the document"}
+    
+    # Long manuals are reduced to the chunks that match the question instead of being sent whole
+    context = select_context(extraction, extraction['source_hash'], question)
+    label = DOCUMENT_LABELS[document_type]
+    if context['retrieved']:
+        log_reasoning_step("Document Retrieval", f"Sending {len(context['chunks'])} of {context['total_chunks']} chunks ({len(context['text'])} of {stats['chars']} characters)", False)
+        label += f" (the {len(context['chunks'])} most relevant of {context['total_chunks']} sections)"
+    description = f"{label}: {context['text']}"
+    if question:
+        description += f"\n\nStudent question: {question}"
+    
+    result = analyze_experiment_data(description)
+    result['document'] = {
+        "format": document_type,
+        "stats": stats,
+        "cached": extraction['cached'],
+        "retrieved_chunks": context['chunks'],
+        "total_chunks": context['total_chunks'],
+    }
+    return result
+
+def process_uploaded_file(file_data, file_type, filename=None, question=None):
     """Process different types of uploaded files"""
     try:
         # Decode base64 file data
@@ -85,34 +506,15 @@ def process_uploaded_file(file_data, file_type):
         
         if file_type.startswith('image/'):
             # Image processing - already handled by extract_math_from_drawing
-            return extract_math_from_drawing(file_data)
-            
-        elif file_type == 'application/pdf':
-            # PDF processing
-            pdf_stream = io.BytesIO(decoded_data)
-            reader = PdfReader(pdf_stream)
-            
-            text_content = ""
-            for page in reader.pages:
-                text_content += page.extract_text() + "\n"
+            return analyze_drawing(file_data)
             
-            return analyze_experiment_data(f"PDF content: {text_content}")
+        elif tabular_format(file_type, filename):
+            # Spreadsheets and CSVs go through the columnar path instead of being pasted into the prompt
+            return analyze_dataset_upload(file_data, decoded_data, tabular_format(file_type, filename), filename)
             
-        elif file_type in ['application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'application/msword']:
-            # Word document processing
-            doc_stream = io.BytesIO(decoded_data)
-            doc = Document(doc_stream)
-            
-            text_content = ""
-            for paragraph in doc.paragraphs:
-                text_content += paragraph.text + "\n"
-            
-            return analyze_experiment_data(f"Document content: {text_content}")
-            
-        elif file_type.startswith('text/'):
-            # Text file processing
-            text_content = decoded_data.decode('utf-8')
-            return analyze_experiment_data(f"Text file content: {text_content}")
+        elif document_format(file_type, filename):
+            # PDF, Word and text files: structure-preserving extraction, cached by file hash
+            return analyze_document_upload(decoded_data, document_format(file_type, filename), question)
             
         else:
             return {"error": f"Unsupported file type: {file_type}"}
@@ -121,6 +523,7 @@ def process_uploaded_file(file_data, file_type):
         return {"error": f"Error processing file: {str(e)}"}
 
 @app.route('/api/upload', methods=['POST'])
+@admission_controlled()
 def upload_file():
     """Handle file uploads with multimodal processing"""
     try:
@@ -129,20 +532,308 @@ def upload_file():
         results = []
         
         for file_info in files:
-            file_data = file_info.get('data')
             file_type = file_info.get('type')
             file_name = file_info.get('name', 'unknown')
+            blob_hash = store_upload(file_info)
             
-            result = process_uploaded_file(file_data, file_type)
+            checkpoint('upload_file')
+            question = file_info.get('question') or data.get('question')
+            result = process_uploaded_file(blob_to_data_url(blob_hash, file_type), file_type, file_name, question)
             result['filename'] = file_name
+            result['blob'] = blob_hash
+            if result.get('analysis_id'):
+                artifact_store.add_ref(blob_hash, f"analysis:{result['analysis_id']}", ANALYSIS_REF_TTL_SECONDS)
             results.append(result)
         
         return jsonify({"success": True, "results": results})
         
+    except MissingBlobError as e:
+        return jsonify({"error": f"Unknown blob: {e}", "missing_blob": str(e)}), 404
+    except ArtifactQuotaError as e:
+        return jsonify({"error": str(e)}), 507
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def run_upload_job(payload):
+    """Job handler for a single uploaded file (the payload carries the blob hash, not the bytes)"""
+    blob_hash = payload.get('blob')
+    admission.charge_job(payload.get('user') or 'anonymous', payload.get('class') or 'default',
+                         estimate_request_tokens({"files": [payload]}), payload.get('address'))
+    file_data = blob_to_data_url(blob_hash, payload.get('type')) if blob_hash else payload.get('data', '')
+    with usage_context(request_type='upload', user=payload.get('user'), class_id=payload.get('class')):
+        result = process_uploaded_file(file_data, payload.get('type', ''), payload.get('name'), payload.get('question'))
+    result['filename'] = payload.get('name', 'unknown')
+    if blob_hash:
+        result['blob'] = blob_hash
+        if result.get('analysis_id'):
+            artifact_store.add_ref(blob_hash, f"analysis:{result['analysis_id']}", ANALYSIS_REF_TTL_SECONDS)
+    return result
+
+def run_drawing_job(payload):
+    """Job handler for a canvas drawing analysis"""
+    admission.charge_job(payload.get('user') or 'anonymous', payload.get('class') or 'default',
+                         estimate_request_tokens({"image": payload.get('image')}), payload.get('address'))
+    with usage_context(request_type='drawing_analysis', user=payload.get('user'), class_id=payload.get('class')):
+        return analyze_drawing(
+            payload.get('image'),
+            include_reasoning=payload.get('include_reasoning', True),
+            verbose=payload.get('verbose', False),
+            timestamp=payload.get('timestamp', 'latest')
+        )
+
+def run_speculative_job(payload):
+    """Job handler for a speculative drawing analysis: fills the analysis cache before the student clicks"""
+    key = payload['analysis_id']
+    speculative_runs.start(key)
+    result = {}
+    try:
+        with usage_context(request_type='speculative_analysis', user=payload.get('user'), class_id=payload.get('class')):
+            result = analyze_drawing(
+                payload['image'],
+                payload.get('vision_model', 'claude'),
+                include_reasoning=payload.get('include_reasoning', True),
+                verbose=False,
+                timestamp=payload.get('timestamp', 'latest')
+            )
+    finally:
+        speculative_runs.finish(key, bool(result.get('success')))
+    if not result.get('success'):
+        return {"error": result.get('error', 'Speculative analysis failed')}
+    return {"success": True, "analysis_id": result.get('analysis_id'), "cached": bool(result.get('cached'))}
+
+job_queue = JobQueue(handlers={
+    'upload': run_upload_job,
+    'drawing_analysis': run_drawing_job,
+    'speculative_analysis': run_speculative_job,
+})
+
+def ensure_job_workers():
+    """Start the background workers on first use (keeps the debug reloader's parent process idle)"""
+    job_queue.start_workers(
+        num_workers=int(os.getenv('LABRAT_JOB_WORKERS', '2')),
+        interactive_workers=int(os.getenv('LABRAT_INTERACTIVE_WORKERS', '1'))
+    )
+
+@app.route('/api/jobs', methods=['POST'])
+@admission_controlled(schedule=False, charge_tokens=False)
+def submit_jobs():
+    """Queue uploaded files or a drawing for background analysis and return job ids immediately"""
+    try:
+        data = request.json or {}
+        batch_id = uuid.uuid4().hex
+        # Jobs run on worker threads, so the caller travels in the payload for usage attribution
+        user_id, class_id = client_identity()
+
+        if data.get('type') == 'drawing_analysis':
+            if not data.get('image'):
+                return jsonify({"error": "No image data provided"}), 400
+            lane = data.get('lane', 'interactive')
+            if lane not in LANES:
+                return jsonify({"error": f"Unknown lane: {lane}"}), 400
+            job_ids = [job_queue.submit('drawing_analysis', {
+                "image": data['image'],
+                "include_reasoning": data.get('include_reasoning', True),
+                "verbose": data.get('verbose', False),
+                "timestamp": data.get('timestamp', 'latest'),
+                "user": user_id,
+                "class": class_id,
+                "address": client_address()
+            }, lane=lane, batch_id=batch_id, filename='canvas')]
+        else:
+            files = data.get('files', [])
+            if not files:
+                return jsonify({"error": "No files provided"}), 400
+            lane = data.get('lane', 'bulk')
+            if lane not in LANES:
+                return jsonify({"error": f"Unknown lane: {lane}"}), 400
+            job_ids = job_queue.submit_many(
+                'upload',
+                [{
+                    "blob": store_upload(f),
+                    "type": f.get('type', ''),
+                    "name": f.get('name', 'unknown'),
+                    "question": f.get('question') or data.get('question'),
+                    "user": user_id,
+                    "class": class_id,
+                    "address": client_address()
+                } for f in files],
+                lane=lane,
+                batch_id=batch_id,
+                filenames=[f.get('name', 'unknown') for f in files]
+            )
+
+        ensure_job_workers()
+        return jsonify({"success": True, "batch_id": batch_id, "job_ids": job_ids, "lane": lane}), 202
+
+    except MissingBlobError as e:
+        return jsonify({"error": f"Unknown blob: {e}", "missing_blob": str(e)}), 404
+    except ArtifactQuotaError as e:
+        return jsonify({"error": str(e)}), 507
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """Paginated job listing, filtered by batch and/or status"""
+    try:
+        ensure_job_workers()
+        page = job_queue.list(
+            batch_id=request.args.get('batch_id'),
+            status=request.args.get('status'),
+            page=request.args.get('page', 1),
+            page_size=request.args.get('page_size', 20),
+            include_results=request.args.get('include_results', 'false').lower() == 'true'
+        )
+        return jsonify({"success": True, **page})
+
+    except ValueError as e:
+        return jsonify({"error": f"Invalid pagination parameters: {str(e)}"}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Status of a single job, including its result once it is done"""
+    try:
+        ensure_job_workers()
+        job = job_queue.get(job_id, include_result=True)
+        if job is None:
+            return jsonify({"error": f"Unknown job: {job_id}"}), 404
+        return jsonify({"success": True, **job})
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancel a job that is still waiting in the queue"""
+    try:
+        if job_queue.cancel(job_id):
+            # Running jobs stop at their next checkpoint
+            job = job_queue.get(job_id, include_result=False)
+            status = 'cancelled' if job is None or job['status'] == 'cancelled' else 'cancelling'
+            return jsonify({"success": True, "job_id": job_id, "status": status})
+        job = job_queue.get(job_id, include_result=False)
+        if job is None:
+            return jsonify({"error": f"Unknown job: {job_id}"}), 404
+        return jsonify({"error": f"Job is already {job['status']}", "status": job['status']}), 409
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/jobs/stats', methods=['GET'])
+def job_stats():
+    """Queue depth per lane and status"""
+    try:
+        return jsonify({"success": True, **job_queue.stats()})
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/speculate', methods=['POST'])
+def speculate():
+    """Queue a low-priority analysis of a drawing in progress so the student's Analyze click finds it cached"""
+    try:
+        data = request.json or {}
+        vision_model = data.get('vision_model', 'claude')
+        if vision_model != 'auto' and vision_model not in vision_registry.providers:
+            return jsonify({"error": f"Unknown vision model: {vision_model}"}), 400
+        if data.get('strokes'):
+            # The full stroke list, rendered outside the stroke session: the click renders the same strokes
+            # from its session, so both produce the same image and the same analysis id
+            try:
+                image_data, _ = burst_pool.run(render_stroke_update, data['strokes'], None, 0, vision_model, priority='speculative')
+            except ServerOverloaded as e:
+                # Speculation is the first work to go when the server is busy
+                speculative_runs.count('skipped')
+                return jsonify({"success": True, "status": "skipped", "reason": str(e)})
+        else:
+            image_data = data.get('image')
+        if not image_data:
+            return jsonify({"error": "No drawing provided"}), 400
+        include_reasoning = data.get('include_reasoning', True)
+        key = analysis_key(image_data, 'drawing_analysis', vision_model=vision_model, include_reasoning=include_reasoning)
+
+        # Only the latest drawing of a session is worth analyzing
+        user_id, class_id = client_identity()
+        batch_id = f"speculative:{user_id}:{data.get('session_id', '')}"
+        superseded = job_queue.cancel_batch(batch_id)
+        speculative_runs.count('superseded', superseded)
+
+        if speculative_runs.is_running(key) or get_cached_analysis(key):
+            speculative_runs.count('cached')
+            return jsonify({"success": True, "status": "cached", "analysis_id": key, "superseded": superseded})
+
+        # Speculation spends the student's budget, but never the last requests they need for the real click
+        remaining = admission.remaining(user_id, class_id, client_address())
+        if remaining.get('user_requests', SPECULATIVE_MIN_HEADROOM) < SPECULATIVE_MIN_HEADROOM:
+            speculative_runs.count('skipped')
+            return jsonify({"success": True, "status": "skipped", "reason": "rate limit headroom"})
+        try:
+            admission.charge(user_id, class_id, estimate_tokens(image_base64=image_data), address=client_address())
+        except RateLimited as e:
+            speculative_runs.count('skipped')
+            return jsonify({"success": True, "status": "skipped", "reason": str(e)})
+
+        job_id = job_queue.submit('speculative_analysis', {
+            "image": image_data,
+            "analysis_id": key,
+            "vision_model": vision_model,
+            "include_reasoning": include_reasoning,
+            "timestamp": data.get('timestamp', 'latest'),
+            "user": user_id,
+            "class": class_id
+        }, lane='speculative', batch_id=batch_id, filename='canvas')
+        speculative_runs.count('submitted')
+        ensure_job_workers()
+        return jsonify({"success": True, "status": "queued", "job_id": job_id, "analysis_id": key, "superseded": superseded}), 202
+
+    except ValueError as e:
+        return jsonify({"error": f"Invalid drawing: {str(e)}"}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/cancel', methods=['POST'])
+def cancel_requests():
+    """Cancel in-flight requests by their X-LabRat-Request ids (also sent by sendBeacon when the panel closes)"""
+    data = request.get_json(force=True, silent=True) or {}
+    request_ids = data.get('request_ids') or ([data['request_id']] if data.get('request_id') else [])
+    if not request_ids:
+        return jsonify({"error": "No request_id provided"}), 400
+    reason = data.get('reason') if data.get('reason') in ('superseded', 'panel_closed') else 'client'
+    cancelled = [request_id for request_id in request_ids[:50] if cancellations.cancel(str(request_id), reason)]
+    return jsonify({"success": True, "cancelled": cancelled})
+
+@app.route('/api/cancel/stats', methods=['GET'])
+def cancellation_stats():
+    """Live cancellable requests, cancellations by source and where the cancelled work stopped"""
+    return jsonify({"success": True, **cancellations.snapshot()})
+
+@app.route('/api/burst/stats', methods=['GET'])
+def burst_stats():
+    """CPU pool queue depth, queue and CPU times per priority, shed requests and model slot occupancy"""
+    return jsonify({"success": True, **burst_pool.snapshot(), "model_slots": admission.scheduler.snapshot()})
+
+@app.after_request
+def cache_route_hint(response):
+    """Name the node that owns the request's route key, so a load balancer or client can keep it there"""
+    node = cache_router.owner(request.headers.get('X-LabRat-Route'))
+    if node:
+        response.headers['X-LabRat-Cache-Node'] = node
+    return response
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_status():
+    """Hits, misses and errors per cache namespace and backend, and how often requests reached their owner node"""
+    return jsonify({"success": True, "caches": cache_stats(), "routing": cache_router.snapshot()})
+
+@app.route('/api/speculate/stats', methods=['GET'])
+def speculation_stats():
+    """How many speculative analyses ran, were superseded or skipped, and how many clicks they answered"""
+    return jsonify({"success": True, **speculative_runs.snapshot()})
+
 @app.route('/api/analyze-reasoning', methods=['POST'])
+@admission_controlled()
 def analyze_reasoning():
     """Dedicated endpoint for detailed reasoning analysis of drawings"""
     try:
@@ -178,6 +869,13 @@ def create_notebook():
         
         notebook = create_snowflake_notebook(cells, notebook_name)
         
+        export_format = data.get('format')
+        if export_format:
+            if export_format not in EXPORT_FORMATS:
+                return jsonify({"error": f"Unknown notebook format: {export_format}"}), 400
+            return Response(iter_ipynb(notebook, export_format), mimetype='application/x-ipynb+json',
+                            headers={"Content-Disposition": f"attachment; filename={secure_filename(notebook_name) or 'notebook'}.ipynb"})
+        
         return jsonify({
             "success": True,
             "notebook": notebook,
@@ -187,36 +885,263 @@ def create_notebook():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def invalid_analysis_id(*analysis_ids):
+    """400 response when any id is not an analysis id (64 hex characters), else None"""
+    for analysis_id in analysis_ids:
+        if not is_analysis_id(analysis_id):
+            return jsonify({"error": f"Invalid analysis id: {str(analysis_id)[:80]}"}), 400
+    return None
+
+@app.route('/api/notebooks/<analysis_id>', methods=['GET'])
+def get_notebook(analysis_id):
+    """Fetch the stored notebook for a previous (live or batch) analysis"""
+    error = invalid_analysis_id(analysis_id)
+    if error:
+        return error
+    try:
+        notebook = load_notebook(analysis_id)
+        if notebook is None:
+            return jsonify({"error": f"No notebook stored for analysis: {analysis_id}"}), 404
+        return jsonify({"success": True, "analysis_id": analysis_id, "notebook": notebook})
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/notebooks/<analysis_id>/export', methods=['GET'])
+def export_notebook(analysis_id):
+    """Download the notebook of an analysis as .ipynb (format=ipynb or snowflake), revalidated by ETag"""
+    error = invalid_analysis_id(analysis_id)
+    if error:
+        return error
+    try:
+        export_format = request.args.get('format', 'ipynb')
+        if export_format not in EXPORT_FORMATS:
+            return jsonify({"error": f"Unknown notebook format: {export_format}"}), 400
+        etag = notebook_exports.etag(analysis_id, export_format)
+        if etag is None:
+            return jsonify({"error": f"No notebook stored for analysis: {analysis_id}"}), 404
+        
+        if request.if_none_match.contains(etag):
+            notebook_exports.count("not_modified")
+            response = Response(status=304)
+        else:
+            response = Response(notebook_exports.stream(analysis_id, export_format, etag), mimetype='application/x-ipynb+json',
+                                headers={"Content-Disposition": f"attachment; filename={analysis_id[:12]}.ipynb"})
+        response.set_etag(etag)
+        # Cacheable, but always revalidated: a re-run rewrites the stored notebook under the same URL
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+        
+    except FileNotFoundError:
+        return jsonify({"error": f"No notebook stored for analysis: {analysis_id}"}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/notebook-exports/stats', methods=['GET'])
+def notebook_export_stats():
+    """Export cache hits, misses and 304 answers"""
+    return jsonify({"success": True, **notebook_exports.snapshot()})
+
+@app.route('/api/notebooks/<analysis_id>/patch', methods=['POST'])
+def get_notebook_patch(analysis_id):
+    """Only the cells that changed since the notebook of an earlier analysis (the one the extension injected).
+    A POST: the stored notebook is rebased onto the extension's cell ids, which changes its export ETag."""
+    try:
+        base_id = (request.get_json(silent=True) or {}).get('base')
+        if not base_id:
+            return jsonify({"error": "base (the analysis id of the injected notebook) is required"}), 400
+        error = invalid_analysis_id(analysis_id, base_id)
+        if error:
+            return error
+        base, notebook = load_notebook(base_id), load_notebook(analysis_id)
+        for missing_id, stored in ((base_id, base), (analysis_id, notebook)):
+            if stored is None:
+                return jsonify({"error": f"No notebook stored for analysis: {missing_id}"}), 404
+        patch, rebased = diff_notebooks(base, notebook)
+        # The extension's cells now carry the base notebook's ids; the next patch starts from this notebook
+        save_notebook(analysis_id, rebased)
+        return jsonify({"success": True, "analysis_id": analysis_id, "base": base_id, "patch": patch})
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/templates', methods=['GET'])
+def get_templates():
+    """List the built-in simulation templates and their parameters"""
+    return jsonify({"success": True, "templates": list_templates()})
+
+@app.route('/api/templates/<name>', methods=['POST'])
+def render_simulation_template(name):
+    """Render a simulation template with the given parameters into notebook cells, without a model call"""
+    try:
+        data = request.json or {}
+        cells = render_template(name, data.get('parameters'))
+        
+        result = {"success": True, "template": name, "notebook_cells": cells}
+        if data.get('create_notebook', True):
+            result['notebook'] = create_snowflake_notebook(cells, data.get('name', f"LabRat_{name}"))
+        return jsonify(result)
+        
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/simulate', methods=['POST'])
+@admission_controlled(schedule=False)
+def run_simulation():
+    """Run an ODE model over a batch of parameter sets and return columnar time series"""
+    try:
+        data = request.json or {}
+        if not data.get('model'):
+            return jsonify({"error": "No model provided"}), 400
+        
+        result = simulate(
+            data['model'],
+            parameters=data.get('parameters'),
+            initial=data.get('initial'),
+            t_max=data.get('t_max', 10.0),
+            dt=data.get('dt', 0.01),
+            sweep=data.get('sweep', 'grid'),
+            output_points=data.get('output_points', 500),
+            method=data.get('method', 'rk4')
+        )
+        log_reasoning_step("Simulation", f"{result['batch_size']} runs x {result['steps']} steps in {result['elapsed_ms']} ms", False)
+        
+        output_format = data.get('format', 'json')
+        if output_format == 'npz':
+            return Response(encode_npz(result), mimetype='application/octet-stream',
+                            headers={"Content-Disposition": "attachment; filename=simulation.npz"})
+        if output_format == 'arrow':
+            return Response(encode_arrow(result), mimetype='application/vnd.apache.arrow.stream')
+        return jsonify(encode_json(result))
+        
+    except ImportError as e:
+        return jsonify({"error": f"Output format not available: {str(e)}"}), 400
+    except ArithmeticError as e:
+        return jsonify({"error": f"Arithmetic error in model expression: {str(e)}"}), 400
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/simulate/models', methods=['GET'])
+def get_simulation_models():
+    """Built-in ODE models the simulation runner knows by name"""
+    return jsonify({"success": True, "models": list_models()})
+
+@app.route('/api/validate-cells', methods=['POST'])
+@admission_controlled()
+def validate_notebook_cells():
+    """Compile (default) or run notebook cells in the sandbox and report per-cell status and timing"""
+    try:
+        data = request.json or {}
+        cells = data.get('cells', [])
+        if not cells:
+            return jsonify({"error": "No cells provided"}), 400
+        mode = data.get('mode', 'compile')
+        if mode not in ('compile', 'run'):
+            return jsonify({"error": f"Unknown validation mode: {mode}"}), 400
+        
+        result = {"success": True, "notebook_cells": cells}
+        result = check_generated_cells(result, mode, repair=data.get('repair', False), verbose=data.get('verbose', False))
+        if 'cell_validation' not in result:
+            return jsonify({"error": "Sandbox unavailable"}), 503
+        return jsonify(result)
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/datasets/<dataset_id>', methods=['GET'])
+def get_dataset(dataset_id):
+    """Download the full parsed dataset of an earlier upload as CSV"""
+    # Dataset ids are SHA-256 hex digests like analysis ids; anything else must not reach _dataset_path
+    if not is_analysis_id(dataset_id):
+        return jsonify({"error": f"Invalid dataset id: {dataset_id[:80]}"}), 400
+    try:
+        columns = load_dataset(dataset_id)
+        if columns is None:
+            return jsonify({"error": f"No dataset stored with id: {dataset_id}"}), 404
+        return Response(dataset_to_csv(columns), mimetype='text/csv',
+                        headers={"Content-Disposition": f"attachment; filename={dataset_id[:12]}.csv"})
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/blobs', methods=['POST'])
+def upload_blob():
+    """Store raw bytes (request body) or base64 JSON {data, type}; returns the content hash"""
+    try:
+        if request.is_json:
+            data = request.json or {}
+            blob_hash = store_upload(data)
+            media_type = data.get('type')
+        else:
+            media_type = request.mimetype
+            blob_hash = artifact_store.put(request.get_data(cache=False), media_type)
+        return jsonify({"success": True, **artifact_store.info(blob_hash)})
+        
+    except ArtifactQuotaError as e:
+        return jsonify({"error": str(e)}), 507
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 413
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/blobs/missing', methods=['POST'])
+def missing_blobs():
+    """Report which content hashes still need uploading"""
+    hashes = (request.json or {}).get('hashes', [])
+    return jsonify({"success": True, "missing": artifact_store.missing(hashes)})
+
+@app.route('/api/blobs/<blob_hash>', methods=['GET'])
+def get_blob(blob_hash):
+    """Download a stored blob"""
+    try:
+        info = artifact_store.info(blob_hash)
+        if info is None:
+            return jsonify({"error": f"Unknown blob: {blob_hash}"}), 404
+        return send_file(artifact_store.path_for(blob_hash), mimetype=info['media_type'] or 'application/octet-stream',
+                         etag=blob_hash, max_age=31536000)
+        
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/api/blobs/stats', methods=['GET'])
+def blob_stats():
+    """Blob store size, reference and quota figures"""
+    return jsonify({"success": True, **artifact_store.stats()})
+
+@app.route('/api/blobs/gc', methods=['POST'])
+def collect_blobs():
+    """Remove expired unreferenced blobs"""
+    try:
+        return jsonify({"success": True, **artifact_store.gc()})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/vision/providers', methods=['GET'])
+def vision_providers():
+    """Rolling latency and error statistics per vision provider"""
+    return jsonify({
+        "success": True,
+        "hedging": HEDGE_BY_DEFAULT,
+        "auto_choice": vision_registry.choose(),
+        "providers": vision_registry.snapshot(),
+        "breakers": breaker_states()
+    })
+
+@app.route('/api/response-profiles', methods=['GET'])
+def response_profile_stats():
+    """Observed output lengths and the maxTokens currently used per request type"""
+    return jsonify({"success": True, "adaptive": response_profiles.adaptive, "profiles": response_profiles.snapshot()})
+
 @app.route('/api/test-injection', methods=['POST'])
 def test_injection():
     """Test endpoint for Snowflake code injection functionality"""
     try:
-        # Sample Python code to inject for testing
-        test_code = """import math
-
-        # --- Physics setup ---
-        g = 9.8           # gravity (m/s^2)
-        L = 1.0           # length of pendulum (m)
-        theta = math.radians(20)  # initial angle (20 degrees)
-        omega = 0.0       # angular velocity (rad/s)
-        dt = 0.1          # time step (s)
-
-        # --- Simulation loop ---
-        for t in range(30):  # 30 steps
-            # Equation of motion (small angle): θ'' = -(g/L) * θ
-            alpha = -(g/L) * theta     # angular acceleration
-            omega += alpha * dt        # update angular velocity
-            theta += omega * dt        # update angle
-            
-            # Convert angle to degrees for easier understanding
-            print(f"Time={t*dt:.1f}s | Angle={math.degrees(theta):.2f}° | Angular velocity={omega:.2f} rad/s")
-
-        # --- TODOs for you ---
-        # 1. Change L (length) and see how oscillation speed changes.
-        # 2. Change the initial angle (theta) and observe motion.
-        # 3. Try smaller dt (e.g. 0.01) for smoother results.
-        # 4. Extend: add damping (like air resistance): alpha = -(g/L)*theta - b*omega
-        """
+        # Sample code to inject for testing: the pendulum simulation template
+        test_code = "\n\n".join(cell['code'] for cell in render_template('pendulum'))
         
         return jsonify({
             "success": True,
@@ -231,8 +1156,40 @@ def test_injection():
 
 @app.route('/api/health', methods=['GET'])
 def health():
-    """Health check endpoint"""
-    return jsonify({"status": "healthy", "service": "LabRat API"})
+    """Health check endpoint; reports 'degraded' while any upstream circuit breaker is open"""
+    breakers = breaker_states()
+    status = "degraded" if any(b['state'] != 'closed' for b in breakers.values()) else "healthy"
+    return jsonify({"status": status, "service": "LabRat API", "breakers": breakers, "model_stub": stub_enabled()})
+
+@app.route('/api/admission', methods=['GET'])
+def admission_status():
+    """Scheduler load, rejection counts and the caller's remaining budgets"""
+    user_id, class_id = client_identity()
+    return jsonify({"success": True, "user": user_id, "class": class_id,
+                    "remaining": admission.remaining(user_id, class_id, client_address()), **admission.snapshot()})
+
+@app.route('/api/usage/report', methods=['GET'])
+def usage_report():
+    """Costliest request types (or operations, models, users...) from the usage ledger"""
+    try:
+        days = int(request.args.get('days', 7))
+        group_by = tuple(field.strip() for field in request.args.get('group_by', 'request_type').split(',') if field.strip())
+        top = int(request.args.get('top', 10))
+        return jsonify({"success": True, **usage_ledger.report(days, group_by, top)})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/api/stub/faults', methods=['GET', 'POST'])
+def stub_faults():
+    """Inspect or change the injected faults of the local model stub (only while LABRAT_MODEL_STUB is set)"""
+    if not stub_enabled():
+        return jsonify({"error": "Model stub is not enabled (set LABRAT_MODEL_STUB)"}), 404
+    try:
+        if request.method == 'POST':
+            model_stub.injector.configure(**(request.json or {}))
+        return jsonify({"success": True, **model_stub.injector.snapshot()})
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": str(e)}), 400
 
 if __name__ == '__main__':
     print("API starting...")
@@ -0,0 +1,330 @@
+"""Vectorized ODE simulation over batches of parameter sets.
+
+Models are systems of first-order ODEs whose right-hand sides are NumPy expressions over the state variables,
+the parameters and t. Every expression is evaluated once per integrator stage on arrays holding the whole batch,
+so a 1000-member parameter sweep costs about the same number of Python operations as a single run.
+
+Results are columnar float32 arrays - one (time x batch) array per state variable - returned as base64 JSON,
+a compressed .npz or an Arrow IPC stream.
+"""
+import ast
+import base64
+import io
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+try:
+    from scipy.integrate import solve_ivp
+except ImportError:  # SciPy is optional - the built-in RK4 integrator covers the common cases
+    solve_ivp = None
+
+MAX_BATCH_SIZE = 10000
+# Each step costs a few Python-level evaluations per expression (~0.1 ms), whatever the batch size
+MAX_STEPS = 20000
+# Upper bound on batch size x integration steps for one request
+MAX_WORK = 10000000
+# Syntax tree nodes per expression; evaluation cost grows with every term
+MAX_EXPRESSION_NODES = 200
+# Wall-clock budget for one simulation, checked between integrator steps
+MAX_SECONDS = float(os.getenv('LABRAT_SIMULATION_SECONDS', '5'))
+MAX_OUTPUT_POINTS = 5000
+DEFAULT_OUTPUT_POINTS = 500
+SCIPY_METHODS = ("RK45", "RK23", "DOP853", "Radau", "BDF", "LSODA")
+
+# Functions ODE expressions may call; everything else is rejected before evaluation
+FUNCTIONS = {
+    name: getattr(np, name) for name in (
+        "sin", "cos", "tan", "arcsin", "arccos", "arctan", "arctan2", "sinh", "cosh", "tanh",
+        "exp", "log", "log10", "sqrt", "abs", "sign", "minimum", "maximum", "where", "clip",
+        "radians", "degrees", "hypot",
+    )
+}
+CONSTANTS = {"pi": math.pi, "e": math.e}
+
+MODELS = {
+    "pendulum": {
+        "state": ["theta", "omega"],
+        "derivatives": ["omega", "-(g / L) * sin(theta) - damping * omega"],
+        "parameters": {"g": 9.81, "L": 1.0, "damping": 0.0},
+        "initial": {"theta": 0.35, "omega": 0.0},
+    },
+    "spring_mass": {
+        "state": ["x", "v"],
+        "derivatives": ["v", "-(k * x + c * v) / m"],
+        "parameters": {"m": 1.0, "k": 10.0, "c": 0.5},
+        "initial": {"x": 0.1, "v": 0.0},
+    },
+    "projectile": {
+        "state": ["x", "y", "vx", "vy"],
+        "derivatives": ["vx", "vy", "-drag * vx * hypot(vx, vy)", "-g - drag * vy * hypot(vx, vy)"],
+        "parameters": {"g": 9.81, "drag": 0.0},
+        "initial": {"x": 0.0, "y": 0.0, "vx": 14.14, "vy": 14.14},
+        "stop_when": "y < 0",
+    },
+    "inclined_plane": {
+        "state": ["s", "v"],
+        "derivatives": ["v", "maximum(0, g * (sin(radians(angle_deg)) - mu * cos(radians(angle_deg))))"],
+        "parameters": {"g": 9.81, "angle_deg": 30.0, "mu": 0.2},
+        "initial": {"s": 0.0, "v": 0.0},
+    },
+}
+
+ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Name, ast.Load, ast.Constant,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.FloorDiv, ast.USub, ast.UAdd,
+    ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq, ast.BitAnd, ast.BitOr, ast.Invert,
+)
+
+def compile_expression(source, names):
+    """Compile an ODE right-hand side after checking it only uses arithmetic, known names and FUNCTIONS"""
+    try:
+        tree = ast.parse(source.replace("^", "**"), mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"Invalid expression '{source}': {e.msg}")
+
+    nodes = list(ast.walk(tree))
+    if len(nodes) > MAX_EXPRESSION_NODES:
+        raise ValueError(f"Expression has {len(nodes)} syntax nodes (limit {MAX_EXPRESSION_NODES}): '{source[:80]}...'")
+    for node in nodes:
+        if not isinstance(node, ALLOWED_NODES):
+            raise ValueError(f"Unsupported syntax in '{source}': {type(node).__name__}")
+        if isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS):
+            raise ValueError(f"Unsupported function in '{source}'")
+        if isinstance(node, ast.Name) and node.id not in names and node.id not in FUNCTIONS and node.id not in CONSTANTS:
+            raise ValueError(f"Unknown name '{node.id}' in '{source}'")
+        if isinstance(node, ast.Constant):
+            if not isinstance(node.value, (int, float)):
+                raise ValueError(f"Only numeric constants are allowed in '{source}'")
+            # Float arithmetic only: '9**9**9' would otherwise build an enormous Python int
+            try:
+                node.value = float(node.value)
+            except OverflowError:
+                raise ValueError(f"Constant out of range in '{source}'")
+    return compile(tree, "<ode>", "eval")
+
+def resolve_model(spec):
+    """Merge a request's model spec over a built-in model (or take a fully custom one)"""
+    if isinstance(spec, str):
+        spec = {"name": spec}
+    base = MODELS.get(spec.get("name"), {}) if spec.get("name") else {}
+    if spec.get("name") and not base:
+        raise ValueError(f"Unknown model: {spec['name']}")
+
+    model = {
+        "state": spec.get("state", base.get("state")),
+        "derivatives": spec.get("derivatives", base.get("derivatives")),
+        "parameters": {**base.get("parameters", {}), **spec.get("parameters", {})},
+        "initial": {**base.get("initial", {}), **spec.get("initial", {})},
+        "stop_when": spec.get("stop_when", base.get("stop_when")),
+    }
+    if not model["state"] or not model["derivatives"] or len(model["state"]) != len(model["derivatives"]):
+        raise ValueError("A model needs one derivative expression per state variable")
+    missing = [name for name in model["state"] if name not in model["initial"]]
+    if missing:
+        raise ValueError(f"Missing initial values for: {', '.join(missing)}")
+    return model
+
+def build_batch(values, sweep="grid"):
+    """Expand scalar/list values into equal-length arrays: 'grid' takes the cartesian product, 'zip' pairs lists up"""
+    swept = {name: np.atleast_1d(np.asarray(value, dtype=np.float64)) for name, value in values.items()
+             if isinstance(value, (list, tuple))}
+    fixed = {name: float(value) for name, value in values.items() if name not in swept}
+
+    if not swept:
+        size = 1
+        columns = {}
+    elif sweep == "zip":
+        lengths = {len(v) for v in swept.values()}
+        if len(lengths) != 1:
+            raise ValueError("All swept values must have the same length for sweep='zip'")
+        size = lengths.pop()
+        columns = swept
+    elif sweep == "grid":
+        size = math.prod(len(v) for v in swept.values())
+        if size > MAX_BATCH_SIZE:
+            raise ValueError(f"Parameter grid has {size} combinations (limit {MAX_BATCH_SIZE})")
+        mesh = np.meshgrid(*swept.values(), indexing="ij")
+        columns = {name: grid.ravel() for name, grid in zip(swept, mesh)}
+    else:
+        raise ValueError(f"Unknown sweep mode: {sweep}")
+
+    if size > MAX_BATCH_SIZE:
+        raise ValueError(f"Batch of {size} runs exceeds the limit of {MAX_BATCH_SIZE}")
+    batch = {name: np.full(size, value) for name, value in fixed.items()}
+    batch.update(columns)
+    return batch, size, list(swept)
+
+def _check_deadline(deadline):
+    if time.perf_counter() > deadline:
+        raise ValueError(f"Simulation exceeded its {MAX_SECONDS:g} s time limit - reduce t_max, the batch or the model size")
+
+def _rk4(rhs, y0, t_out, dt, deadline):
+    """Fixed-step RK4 over the whole batch; y has shape (state, batch). Records the state at t_out"""
+    steps = int(math.ceil(t_out[-1] / dt))
+    record_at = np.searchsorted(np.arange(steps + 1) * dt, t_out - 1e-12)
+    out = np.empty((len(t_out),) + y0.shape)
+    y, next_record = y0, 0
+    for step in range(steps + 1):
+        while next_record < len(t_out) and record_at[next_record] == step:
+            out[next_record] = y
+            next_record += 1
+        if step == steps:
+            break
+        _check_deadline(deadline)
+        t = step * dt
+        k1 = rhs(t, y)
+        k2 = rhs(t + dt / 2, y + dt / 2 * k1)
+        k3 = rhs(t + dt / 2, y + dt / 2 * k2)
+        k4 = rhs(t + dt, y + dt * k3)
+        y = y + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+    return out
+
+def _solve_ivp(rhs, y0, t_out, method, rtol, atol, deadline):
+    """SciPy's adaptive solvers on the flattened batch - one big system, still one RHS call per stage"""
+    shape = y0.shape
+
+    def flat_rhs(t, y):
+        # Adaptive solvers pick their own step count, so the deadline is the only bound on it
+        _check_deadline(deadline)
+        return rhs(t, y.reshape(shape)).ravel()
+
+    solution = solve_ivp(
+        flat_rhs,
+        (0.0, float(t_out[-1])), y0.ravel(), method=method, t_eval=t_out, rtol=rtol, atol=atol
+    )
+    if not solution.success:
+        raise ValueError(f"Integrator failed: {solution.message}")
+    return solution.y.T.reshape((len(t_out),) + shape)
+
+def simulate(model_spec, parameters=None, initial=None, t_max=10.0, dt=0.01, sweep="grid",
+             output_points=DEFAULT_OUTPUT_POINTS, method="rk4", rtol=1e-6, atol=1e-9):
+    """Integrate a model for every combination of swept parameters/initial values at once"""
+    started = time.perf_counter()
+    deadline = started + MAX_SECONDS
+    model = resolve_model(model_spec)
+    param_values = {**model["parameters"], **(parameters or {})}
+    initial_values = {**model["initial"], **(initial or {})}
+    clashes = set(param_values) & (set(model["state"]) | {f"{name}0" for name in model["state"]} | {"t"})
+    if clashes:
+        raise ValueError(f"Parameter names clash with state variables: {', '.join(sorted(clashes))}")
+
+    t_max, dt = float(t_max), float(dt)
+    if t_max <= 0 or dt <= 0:
+        raise ValueError("t_max and dt must be positive")
+    steps = int(math.ceil(t_max / dt))
+    if steps > MAX_STEPS:
+        raise ValueError(f"{steps} steps exceeds the limit of {MAX_STEPS} - increase dt")
+
+    batch, size, swept = build_batch({**param_values, **{f"{name}0": v for name, v in initial_values.items()}}, sweep)
+    if size * steps > MAX_WORK:
+        raise ValueError(f"{size} runs x {steps} steps is too much work for one request")
+
+    names = set(param_values) | set(model["state"]) | {"t"}
+    derivatives = [compile_expression(expr, names) for expr in model["derivatives"]]
+    stop_when = compile_expression(model["stop_when"], names) if model["stop_when"] else None
+    namespace = {"__builtins__": {}, **FUNCTIONS, **CONSTANTS, **{name: batch[name] for name in param_values}}
+
+    def rhs(t, y):
+        scope = dict(namespace, t=t, **dict(zip(model["state"], y)))
+        return np.stack([np.broadcast_to(eval(code, scope), (size,)) for code in derivatives])
+
+    y0 = np.stack([batch[f"{name}0"] for name in model["state"]])
+    t_out = np.linspace(0.0, steps * dt, min(max(2, int(output_points)), MAX_OUTPUT_POINTS, steps + 1))
+
+    if method == "rk4":
+        states = _rk4(rhs, y0, t_out, dt, deadline)
+    elif method in SCIPY_METHODS:
+        if solve_ivp is None:
+            raise ValueError(f"Method {method} needs SciPy, which is not installed - use method='rk4'")
+        states = _solve_ivp(rhs, y0, t_out, method, rtol, atol, deadline)
+    else:
+        raise ValueError(f"Unknown integration method: {method}")
+
+    columns = {"t": t_out.astype(np.float32)}
+    stopped_at = None
+    if stop_when is not None:
+        # Hold each run at its state when the stop condition first holds (e.g. a projectile landing)
+        scope = dict(namespace, t=t_out[:, None], **{name: states[:, i, :] for i, name in enumerate(model["state"])})
+        hit = np.broadcast_to(eval(stop_when, scope), (len(t_out), size)).copy()
+        hit[0] = False
+        first = np.where(hit.any(axis=0), hit.argmax(axis=0), len(t_out) - 1)
+        index = np.minimum(np.arange(len(t_out))[:, None], first[None, :])
+        states = np.take_along_axis(states, index[:, None, :], axis=0)
+        stopped_at = t_out[first].astype(np.float32)
+
+    for i, name in enumerate(model["state"]):
+        columns[name] = states[:, i, :].astype(np.float32)
+
+    return {
+        "model": model_spec if isinstance(model_spec, str) else model_spec.get("name", "custom"),
+        "state": model["state"],
+        "batch_size": size,
+        "swept": swept,
+        "runs": {name: batch[name].tolist() for name in swept},
+        "steps": steps,
+        "method": method,
+        "columns": columns,
+        "stopped_at": stopped_at,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+    }
+
+def _metadata(result):
+    return {key: value for key, value in result.items() if key not in ("columns", "stopped_at")}
+
+def encode_json(result):
+    """Columns as base64 little-endian float32 with dtype and shape, for the JSON API"""
+    encoded = {
+        name: {
+            "dtype": "float32",
+            "shape": list(array.shape),
+            "data": base64.b64encode(np.ascontiguousarray(array, dtype="<f4").tobytes()).decode("ascii"),
+        }
+        for name, array in result["columns"].items()
+    }
+    if result["stopped_at"] is not None:
+        encoded["stopped_at"] = {
+            "dtype": "float32",
+            "shape": list(result["stopped_at"].shape),
+            "data": base64.b64encode(np.ascontiguousarray(result["stopped_at"], dtype="<f4").tobytes()).decode("ascii"),
+        }
+    return {"success": True, **_metadata(result), "columns": encoded}
+
+def encode_npz(result):
+    """Compressed .npz with one array per column plus a JSON 'metadata' entry"""
+    buffer = io.BytesIO()
+    arrays = dict(result["columns"])
+    if result["stopped_at"] is not None:
+        arrays["stopped_at"] = result["stopped_at"]
+    np.savez_compressed(buffer, metadata=np.array(json.dumps(_metadata(result))), **arrays)
+    return buffer.getvalue()
+
+def encode_arrow(result):
+    """Arrow IPC stream in long format: one row per (run, time) with the swept values as columns"""
+    import pyarrow as pa
+
+    columns = result["columns"]
+    size, points = result["batch_size"], len(columns["t"])
+    table = {
+        "run": np.repeat(np.arange(size, dtype=np.int32), points),
+        "t": np.tile(columns["t"], size),
+    }
+    for name in result["state"]:
+        table[name] = columns[name].T.ravel()
+    for name, values in result["runs"].items():
+        table[name] = np.repeat(np.asarray(values, dtype=np.float32), points)
+
+    sink = pa.BufferOutputStream()
+    arrow_table = pa.table(table).replace_schema_metadata({"labrat": json.dumps(_metadata(result))})
+    with pa.ipc.new_stream(sink, arrow_table.schema) as writer:
+        writer.write_table(arrow_table)
+    return sink.getvalue().to_pybytes()
+
+def list_models():
+    return [
+        {"name": name, "state": model["state"], "parameters": model["parameters"], "initial": model["initial"]}
+        for name, model in MODELS.items()
+    ]
@@ -0,0 +1,74 @@
+"""Bookkeeping for speculative drawing analyses.
+
+While speculation is on, the extension sends the drawing after every pause in the student's pen strokes. The
+server queues it in the low-priority 'speculative' job lane; the analysis lands in the regular analysis cache,
+keyed by image hash, so the student's "Analyze" click is a cache hit. A newer drawing from the same session
+supersedes the older one: cancelled while queued, stopped at its next checkpoint while running.
+
+This module tracks which analyses are running so a click for the same drawing waits for the speculative run
+instead of paying for a second model call, and counts how often speculation paid off.
+"""
+import threading
+from collections import OrderedDict
+
+# Speculated analysis ids remembered for hit accounting
+MAX_COMPLETED = 1000
+
+class SpeculativeRuns:
+    def __init__(self):
+        self._running = {}  # analysis id -> (event set when done, owning thread id)
+        self._completed = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(("submitted", "cached", "skipped", "superseded", "completed", "joined", "hits"), 0)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def is_running(self, key):
+        with self._lock:
+            return key in self._running
+
+    def start(self, key):
+        with self._lock:
+            self._running[key] = (threading.Event(), threading.get_ident())
+
+    def finish(self, key, success):
+        with self._lock:
+            done, _ = self._running.pop(key, (None, None))
+            if success:
+                self.counters["completed"] += 1
+                self._completed[key] = True
+                while len(self._completed) > MAX_COMPLETED:
+                    self._completed.popitem(last=False)
+        if done:
+            done.set()
+
+    def join(self, key, timeout):
+        """Wait for a speculative run of this analysis (not from the run's own thread); True if one was waited for"""
+        with self._lock:
+            done, owner = self._running.get(key, (None, None))
+        if done is None or owner == threading.get_ident():
+            return False
+        self.count("joined")
+        done.wait(timeout)
+        return True
+
+    def claim_hit(self, key):
+        """Count a click answered from a speculated analysis (once per analysis)"""
+        with self._lock:
+            if self._completed.pop(key, None):
+                self.counters["hits"] += 1
+                return True
+            return False
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self.counters)
+            running = len(self._running)
+        counters["running"] = running
+        counters["hit_rate"] = round(counters["hits"] / counters["completed"], 3) if counters["completed"] else None
+        return counters
+
+
+speculative_runs = SpeculativeRuns()
@@ -0,0 +1,238 @@
+import base64
+import hashlib
+import io
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image, ImageDraw
+
+# Binary stroke payload sent by the extension (see encodeStrokes in assistant.js):
+#   "LRS" + version byte, varint canvas width, varint canvas height, varint stroke count,
+#   then per stroke: varint pen width * 10, varint point count and, per point, zig-zag varint
+#   deltas of x*2, y*2 (half-pixel precision) and t (ms). Deltas run across the whole payload.
+STROKE_MAGIC = b"LRS"
+STROKE_FORMAT_VERSION = 1
+
+MAX_STROKE_POINTS = 200000
+# Largest canvas edge accepted from a payload; the diffing canvas is allocated at this size
+MAX_CANVAS_DIMENSION = 4096
+STROKE_COLOR = (44, 62, 80)  # Same '#2c3e50' the canvas draws with
+RENDER_MARGIN = 16
+MAX_UPSCALE = 2.0
+
+# Longest edge each vision model should receive
+RENDER_DIMENSIONS = {
+    "claude": 1568,
+    "writer": 1024,
+    "landingai": 1024,
+}
+
+SESSION_TTL_SECONDS = 2 * 60 * 60
+MAX_SESSIONS = 1000
+RENDER_CACHE_SIZE = 256
+
+
+class StrokeSyncError(Exception):
+    """The client's incremental stroke update does not line up with the server's session state"""
+
+    def __init__(self, message, server_count):
+        super().__init__(message)
+        self.server_count = server_count
+
+
+def _read_varint(data, pos):
+    result, shift = 0, 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("Truncated stroke payload")
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError("Malformed varint in stroke payload")
+
+def _read_signed(data, pos):
+    value, pos = _read_varint(data, pos)
+    return (value >> 1) ^ -(value & 1), pos
+
+def decode_strokes(payload_base64):
+    """Decode a stroke payload into ((width, height), [{"width", "points": [(x, y, t), ...]}, ...])"""
+    data = base64.b64decode(payload_base64)
+    if len(data) < 4 or data[:3] != STROKE_MAGIC:
+        raise ValueError("Not a LabRat stroke payload")
+    if data[3] != STROKE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported stroke format version: {data[3]}")
+
+    pos = 4
+    canvas_width, pos = _read_varint(data, pos)
+    canvas_height, pos = _read_varint(data, pos)
+    if not (0 < canvas_width <= MAX_CANVAS_DIMENSION and 0 < canvas_height <= MAX_CANVAS_DIMENSION):
+        raise ValueError(f"Canvas size {canvas_width}x{canvas_height} outside 1..{MAX_CANVAS_DIMENSION} pixels")
+    stroke_count, pos = _read_varint(data, pos)
+
+    strokes = []
+    total_points = 0
+    x = y = t = 0
+    for _ in range(stroke_count):
+        pen_width, pos = _read_varint(data, pos)
+        point_count, pos = _read_varint(data, pos)
+        if point_count == 0:
+            raise ValueError("Stroke without points in stroke payload")
+        total_points += point_count
+        if total_points > MAX_STROKE_POINTS:
+            raise ValueError(f"Stroke payload exceeds {MAX_STROKE_POINTS} points")
+
+        points = []
+        for _ in range(point_count):
+            dx, pos = _read_signed(data, pos)
+            dy, pos = _read_signed(data, pos)
+            dt, pos = _read_signed(data, pos)
+            x, y, t = x + dx, y + dy, t + dt
+            points.append((x / 2, y / 2, t))
+        strokes.append({"width": pen_width / 10, "points": points})
+
+    return (canvas_width, canvas_height), strokes
+
+def strokes_hash(strokes):
+    """SHA-256 over stroke geometry only, so redrawing the same picture at a different speed still dedups"""
+    digest = hashlib.sha256()
+    for stroke in strokes:
+        digest.update(f"w{stroke['width']:.1f}".encode('ascii'))
+        digest.update(",".join(f"{x:.1f}:{y:.1f}" for x, y, _ in stroke["points"]).encode('ascii'))
+        digest.update(b";")
+    return digest.hexdigest()
+
+def render_strokes(strokes, max_dimension=1568):
+    """Rasterize strokes cropped to their bounding box at the requested resolution; returns JPEG bytes and size"""
+    xs = [x for stroke in strokes for x, _, _ in stroke["points"]]
+    ys = [y for stroke in strokes for _, y, _ in stroke["points"]]
+    if not xs:
+        raise ValueError("No strokes to render")
+
+    pad = RENDER_MARGIN + max(stroke["width"] for stroke in strokes)
+    left, top = min(xs) - pad, min(ys) - pad
+    box_width, box_height = max(xs) + pad - left, max(ys) + pad - top
+    scale = min(max_dimension / max(box_width, box_height), MAX_UPSCALE)
+    width, height = max(10, round(box_width * scale)), max(10, round(box_height * scale))
+
+    img = Image.new('RGB', (width, height), (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    for stroke in strokes:
+        pen = max(1, round(stroke["width"] * scale))
+        radius = pen / 2
+        points = [((x - left) * scale, (y - top) * scale) for x, y, _ in stroke["points"]]
+        if len(points) > 1:
+            draw.line(points, fill=STROKE_COLOR, width=pen, joint='curve')
+        # Round caps, matching the canvas lineCap
+        for px, py in (points[0], points[-1]):
+            draw.ellipse((px - radius, py - radius, px + radius, py + radius), fill=STROKE_COLOR)
+
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=90, optimize=True)
+    return buffer.getvalue(), (width, height)
+
+
+def render_strokes_canvas(strokes, canvas_size):
+    """Grayscale rendering in canvas coordinates (no crop or scaling), used to diff successive analyses"""
+    width, height = (min(MAX_CANVAS_DIMENSION, max(1, int(edge))) for edge in canvas_size)
+    img = Image.new('L', (width, height), 255)
+    draw = ImageDraw.Draw(img)
+    gray = round(sum(STROKE_COLOR) / 3)
+    for stroke in strokes:
+        pen = max(1, round(stroke["width"]))
+        points = [(x, y) for x, y, _ in stroke["points"]]
+        if len(points) > 1:
+            draw.line(points, fill=gray, width=pen, joint='curve')
+        for px, py in (points[0], points[-1]):
+            draw.ellipse((px - pen / 2, py - pen / 2, px + pen / 2, py + pen / 2), fill=gray)
+    return img
+
+
+class StrokeSessions:
+    """Per-session stroke lists so the extension only uploads strokes added since the last analysis"""
+
+    def __init__(self, ttl=SESSION_TTL_SECONDS, max_sessions=MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def apply_update(self, session_id, base_count, canvas_size, new_strokes):
+        """Append strokes after base_count (0 replaces the session); returns the full stroke list"""
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            if base_count == 0 or session is None:
+                if base_count != 0:
+                    raise StrokeSyncError("Unknown stroke session - resend all strokes", 0)
+                strokes = list(new_strokes)
+            elif len(session["strokes"]) != base_count:
+                raise StrokeSyncError(
+                    f"Server has {len(session['strokes'])} strokes, client sent a delta after {base_count}",
+                    len(session["strokes"])
+                )
+            else:
+                strokes = session["strokes"] + list(new_strokes)
+
+            self._sessions[session_id] = {"strokes": strokes, "canvas_size": canvas_size, "updated_at": time.time()}
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            return strokes
+
+    def get(self, session_id):
+        """Return (canvas_size, strokes) for a live session, or None"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return (session["canvas_size"], session["strokes"]) if session else None
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session["updated_at"] >= cutoff:
+                break
+            del self._sessions[session_id]
+
+
+stroke_sessions = StrokeSessions()
+_render_cache = OrderedDict()
+_render_cache_lock = threading.Lock()
+
+def render_stroke_update(payload_base64, session_id=None, base_count=0, vision_model="claude"):
+    """Decode an (incremental) stroke upload and return a data URL rasterized for the given vision model"""
+    canvas_size, new_strokes = decode_strokes(payload_base64)
+    if session_id:
+        strokes = stroke_sessions.apply_update(session_id, int(base_count or 0), canvas_size, new_strokes)
+    else:
+        strokes = new_strokes
+
+    stroke_key = strokes_hash(strokes)
+    max_dimension = RENDER_DIMENSIONS.get(vision_model, RENDER_DIMENSIONS["claude"])
+    cache_key = (stroke_key, max_dimension)
+
+    with _render_cache_lock:
+        cached = _render_cache.get(cache_key)
+        if cached:
+            _render_cache.move_to_end(cache_key)
+
+    if cached is None:
+        jpeg_bytes, size = render_strokes(strokes, max_dimension)
+        cached = (f"data:image/jpeg;base64,{base64.b64encode(jpeg_bytes).decode('utf-8')}", size)
+        with _render_cache_lock:
+            _render_cache[cache_key] = cached
+            while len(_render_cache) > RENDER_CACHE_SIZE:
+                _render_cache.popitem(last=False)
+
+    image_data, (width, height) = cached
+    return image_data, {
+        "stroke_hash": stroke_key,
+        "stroke_count": len(strokes),
+        "point_count": sum(len(stroke["points"]) for stroke in strokes),
+        "rendered_size": [width, height],
+        "payload_bytes": len(payload_base64) * 3 // 4,
+    }
@@ -0,0 +1,280 @@
+"""Append-only ledger of model usage: tokens, cost and latency for every model call.
+
+Each Bedrock converse (and Writer) call appends one JSON line to data/usage/usage-<day>.jsonl with the
+token counts from the response's usage block (including prompt-cache reads and writes), the model's own
+latencyMs, the wall time, model id, the operation (the model.py function that made the call), and the
+request type and user taken from the request context. A background thread folds new lines into per-day
+summaries; finished days are written to summary-<day>.json and never re-read.
+
+    python usage_ledger.py report --days 7 --group-by request_type
+    python usage_ledger.py report --days 30 --group-by operation,model --top 20
+"""
+import argparse
+import contextlib
+import contextvars
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from analysis_cache import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+USAGE_DIR = os.getenv('LABRAT_USAGE_DIR', os.path.join(DATA_DIR, 'usage'))
+AGGREGATE_INTERVAL_SECONDS = float(os.getenv('LABRAT_USAGE_AGGREGATE_SECONDS', '300'))
+
+# USD per million tokens: input, output, cache read, cache write (override with LABRAT_MODEL_PRICES as JSON)
+MODEL_PRICES = {
+    "us.anthropic.claude-opus-4-20250514-v1:0": {"input": 15.0, "output": 75.0, "cache_read": 1.5, "cache_write": 18.75},
+    "us.anthropic.claude-3-5-haiku-20241022-v1:0": {"input": 0.8, "output": 4.0, "cache_read": 0.08, "cache_write": 1.0},
+}
+MODEL_PRICES.update(json.loads(os.getenv('LABRAT_MODEL_PRICES', '{}')))
+
+# Report window and row count bounds: each day of the window is a file read
+MAX_REPORT_DAYS = 366
+MAX_REPORT_ROWS = 1000
+GROUP_FIELDS = ('request_type', 'operation', 'model', 'user', 'class_id', 'provider')
+COUNTERS = ('calls', 'errors', 'input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_write_tokens',
+            'cost_usd', 'model_latency_ms', 'wall_ms')
+
+_context = contextvars.ContextVar('labrat_usage_context', default={})
+
+@contextlib.contextmanager
+def usage_context(**fields):
+    """Attribute model calls made inside the block to a request type / user / class"""
+    token = _context.set({**_context.get(), **{key: value for key, value in fields.items() if value is not None}})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+def annotate_usage(**fields):
+    """Refine the attribution of the current request (undone when the enclosing usage_context exits)"""
+    _context.set({**_context.get(), **{key: value for key, value in fields.items() if value is not None}})
+
+def current_context():
+    return dict(_context.get())
+
+def call_cost(model, input_tokens=0, output_tokens=0, cache_read_tokens=0, cache_write_tokens=0):
+    prices = MODEL_PRICES.get(model)
+    if not prices:
+        return 0.0
+    return (input_tokens * prices["input"] + output_tokens * prices["output"]
+            + cache_read_tokens * prices.get("cache_read", prices["input"])
+            + cache_write_tokens * prices.get("cache_write", prices["input"])) / 1e6
+
+
+class UsageLedger:
+    def __init__(self, root=USAGE_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+        self._today = {"day": None, "offset": 0, "groups": {}}
+        self._aggregator = None
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, day):
+        return os.path.join(self.root, f"usage-{day}.jsonl")
+
+    def record(self, model, operation, usage=None, model_latency_ms=None, wall_ms=None, error=None, provider='bedrock'):
+        """Append one call to the ledger (never raises: accounting must not break a request)"""
+        usage = usage or {}
+        entry = {
+            "ts": round(time.time(), 3),
+            **current_context(),
+            "operation": operation,
+            "model": model,
+            "provider": provider,
+            "input_tokens": usage.get("inputTokens", 0),
+            "output_tokens": usage.get("outputTokens", 0),
+            "cache_read_tokens": usage.get("cacheReadInputTokens", 0),
+            "cache_write_tokens": usage.get("cacheWriteInputTokens", 0),
+            "model_latency_ms": model_latency_ms,
+            "wall_ms": wall_ms,
+            "error": error,
+        }
+        entry["cost_usd"] = round(call_cost(model, entry["input_tokens"], entry["output_tokens"],
+                                            entry["cache_read_tokens"], entry["cache_write_tokens"]), 6)
+        try:
+            line = json.dumps(entry, separators=(',', ':')) + "\n"
+            # O_APPEND writes of one short line are atomic, so several server processes can share the file
+            fd = os.open(self._path(datetime.date.today().isoformat()), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode('utf-8'))
+            finally:
+                os.close(fd)
+        except Exception as e:
+            logger.warning(f"Could not record usage: {e}")
+        self._ensure_aggregator()
+        return entry
+
+    # --- Aggregation ---
+
+    @staticmethod
+    def _fold(groups, entry):
+        key = tuple(entry.get(field) or '' for field in GROUP_FIELDS)
+        group = groups.setdefault(key, dict.fromkeys(COUNTERS, 0))
+        group["calls"] += 1
+        group["errors"] += 1 if entry.get("error") else 0
+        for counter in COUNTERS[2:]:
+            group[counter] += entry.get(counter) or 0
+
+    def _fold_file(self, day, groups, offset=0):
+        """Fold the lines after offset into groups; returns the new offset (only complete lines are consumed)"""
+        try:
+            with open(self._path(day), 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    offset += len(line)
+                    try:
+                        self._fold(groups, json.loads(line))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return offset
+
+    def _summary_path(self, day):
+        return os.path.join(self.root, f"summary-{day}.json")
+
+    def day_summary(self, day):
+        """Aggregated groups for one day: persisted once the day is over, incremental for today"""
+        today = datetime.date.today().isoformat()
+        if day == today:
+            with self._lock:
+                if self._today["day"] != today:
+                    self._today = {"day": today, "offset": 0, "groups": {}}
+                self._today["offset"] = self._fold_file(today, self._today["groups"], self._today["offset"])
+                return dict(self._today["groups"])
+
+        try:
+            with open(self._summary_path(day), 'r') as f:
+                return {tuple(row["key"]): row["totals"] for row in json.load(f)}
+        except (FileNotFoundError, ValueError):
+            pass
+        groups = {}
+        self._fold_file(day, groups)
+        if groups and day < today:
+            tmp_path = self._summary_path(day) + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump([{"key": list(key), "totals": totals} for key, totals in groups.items()], f)
+            os.replace(tmp_path, self._summary_path(day))
+        return groups
+
+    def _ensure_aggregator(self):
+        if self._aggregator is None or not self._aggregator.is_alive():
+            self._aggregator = threading.Thread(target=self._aggregate_loop, daemon=True, name='usage-aggregator')
+            self._aggregator.start()
+
+    def _aggregate_loop(self):
+        while True:
+            time.sleep(AGGREGATE_INTERVAL_SECONDS)
+            try:
+                self.day_summary(datetime.date.today().isoformat())
+                yesterday = (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+                self.day_summary(yesterday)
+            except Exception as e:
+                logger.warning(f"Usage aggregation failed: {e}")
+
+    def report(self, days=7, group_by=('request_type',), top=10):
+        """Costliest groups over the last days, with token totals and average latencies"""
+        days = min(max(int(days), 1), MAX_REPORT_DAYS)
+        top = min(max(int(top), 1), MAX_REPORT_ROWS)
+        for field in group_by:
+            if field not in GROUP_FIELDS:
+                raise ValueError(f"Cannot group by {field} (choose from {', '.join(GROUP_FIELDS)})")
+        end = datetime.date.today()
+        combined = {}
+        for offset in range(days):
+            day = (end - datetime.timedelta(days=offset)).isoformat()
+            for key, totals in self.day_summary(day).items():
+                fields = dict(zip(GROUP_FIELDS, key))
+                group_key = tuple(fields[field] for field in group_by)
+                group = combined.setdefault(group_key, dict.fromkeys(COUNTERS, 0))
+                for counter in COUNTERS:
+                    group[counter] += totals[counter]
+
+        rows = []
+        for key, totals in combined.items():
+            calls = totals["calls"] or 1
+            rows.append({
+                **dict(zip(group_by, key)),
+                **{counter: totals[counter] for counter in COUNTERS if counter not in ('model_latency_ms', 'wall_ms')},
+                "cost_usd": round(totals["cost_usd"], 4),
+                "avg_cost_usd": round(totals["cost_usd"] / calls, 5),
+                "avg_input_tokens": round(totals["input_tokens"] / calls),
+                "avg_output_tokens": round(totals["output_tokens"] / calls),
+                "avg_model_latency_ms": round(totals["model_latency_ms"] / calls),
+                "avg_wall_ms": round(totals["wall_ms"] / calls),
+            })
+        rows.sort(key=lambda row: row["cost_usd"], reverse=True)
+        return {
+            "days": days,
+            "group_by": list(group_by),
+            "total_cost_usd": round(sum(row["cost_usd"] for row in rows), 4),
+            "total_calls": sum(row["calls"] for row in rows),
+            "rows": rows[:top],
+        }
+
+
+class MeteredClient:
+    """Wraps a bedrock-runtime client so every converse call is recorded in the ledger"""
+
+    def __init__(self, client, ledger):
+        self._client = client
+        self._ledger = ledger
+
+    def converse(self, **kwargs):
+        # The model.py function that called converse names the operation (extract_math_from_drawing, ...)
+        operation = sys._getframe(1).f_code.co_name
+        started = time.perf_counter()
+        try:
+            response = self._client.converse(**kwargs)
+        except Exception as e:
+            self._ledger.record(kwargs.get('modelId'), operation, wall_ms=round((time.perf_counter() - started) * 1000, 1),
+                                error=type(e).__name__)
+            raise
+        self._ledger.record(
+            kwargs.get('modelId'), operation,
+            usage=response.get('usage'),
+            model_latency_ms=(response.get('metrics') or {}).get('latencyMs'),
+            wall_ms=round((time.perf_counter() - started) * 1000, 1)
+        )
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+usage_ledger = UsageLedger()
+
+def print_report(report):
+    group_by = report["group_by"]
+    print(f"Last {report['days']} day(s): {report['total_calls']} calls, ${report['total_cost_usd']:.2f}")
+    header = [*group_by, "calls", "errors", "in tok", "out tok", "cache rd", "cost $", "avg $", "avg ms"]
+    print("  ".join(f"{column:>12}" for column in header))
+    for row in report["rows"]:
+        values = [str(row[field] or '-')[:12] for field in group_by] + [
+            row["calls"], row["errors"], row["input_tokens"], row["output_tokens"], row["cache_read_tokens"],
+            f"{row['cost_usd']:.2f}", f"{row['avg_cost_usd']:.4f}", row["avg_model_latency_ms"]]
+        print("  ".join(f"{value:>12}" for value in values))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LabRat model usage ledger")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    report_parser = subcommands.add_parser("report", help="Costliest request types / operations / models / users")
+    report_parser.add_argument("--days", type=int, default=7)
+    report_parser.add_argument("--group-by", default="request_type", help=f"Comma-separated: {', '.join(GROUP_FIELDS)}")
+    report_parser.add_argument("--top", type=int, default=10)
+    report_parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+    result = usage_ledger.report(args.days, tuple(args.group_by.split(',')), args.top)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
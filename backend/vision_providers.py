@@ -0,0 +1,265 @@
+"""Vision providers behind one interface, with rolling latency/error statistics and optional hedging.
+
+Each provider turns a drawing into an analysis result ({"success": True, "text", "notebook_cells", ...} or
+{"error": ...}). The registry times every call and keeps a rolling window per provider, which drives:
+
+- 'auto' selection: the available provider with the best p50 latency, penalized by its error rate
+- hedging: when the chosen provider has not answered within its own p90 latency, the same drawing is sent
+  to the next-best provider and whichever succeeds first wins. The slower call is left to finish in the
+  background so its latency still lands in the statistics. Costs one extra call on roughly 10% of requests.
+
+    LABRAT_VISION_HEDGE=1 python server.py     # hedge by default (requests can also pass "hedge": true)
+"""
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+import model_stub
+from circuit_breaker import get_breaker
+from math_ocr import get_recognizer, recognize_equation
+from model import model_id, writer_breaker, extract_math_from_drawing, analyze_with_writer_vision, analyze_with_landingai, analyze_recognized_equation
+
+logger = logging.getLogger(__name__)
+
+STATS_WINDOW = int(os.getenv('LABRAT_VISION_STATS_WINDOW', '200'))
+HEDGE_BY_DEFAULT = os.getenv('LABRAT_VISION_HEDGE', '0').lower() in ('1', 'true', 'on')
+# Below this many successful samples p90 is too noisy to hedge on
+MIN_HEDGE_SAMPLES = 10
+MIN_HEDGE_DELAY_SECONDS = 0.5
+PROVIDER_TIMEOUT_SECONDS = 120
+
+class ProviderStats:
+    """Rolling window of (latency, success) for one provider"""
+
+    def __init__(self, window=STATS_WINDOW):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedge_wins = 0
+
+    def record(self, latency, ok):
+        with self._lock:
+            self._samples.append((latency, ok))
+            self.calls += 1
+
+    def latencies(self):
+        with self._lock:
+            return np.array([latency for latency, ok in self._samples if ok], dtype=np.float64)
+
+    def percentile(self, q):
+        latencies = self.latencies()
+        return float(np.percentile(latencies, q)) if latencies.size else None
+
+    def error_rate(self):
+        with self._lock:
+            if not self._samples:
+                return 0.0
+            return sum(1 for _, ok in self._samples if not ok) / len(self._samples)
+
+    def snapshot(self):
+        latencies = self.latencies()
+        return {
+            "calls": self.calls,
+            "window": len(self._samples),
+            "error_rate": round(self.error_rate(), 3),
+            "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 1) if latencies.size else None,
+            "p90_ms": round(float(np.percentile(latencies, 90)) * 1000, 1) if latencies.size else None,
+            "p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 1) if latencies.size else None,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+class VisionProvider:
+    """Base class: subclasses set name and implement analyze()"""
+    name = None
+    # Placeholders and providers that only handle some drawings are not used for 'auto' or as hedge backups
+    selectable = True
+
+    def available(self):
+        return True
+
+    def analyze(self, image_data, include_reasoning=True, verbose=True):
+        raise NotImplementedError
+
+
+class BedrockClaudeProvider(VisionProvider):
+    name = 'claude'
+
+    def available(self):
+        return get_breaker(f"bedrock:{model_id}").available()
+
+    def analyze(self, image_data, include_reasoning=True, verbose=True):
+        return extract_math_from_drawing(image_data, include_reasoning, verbose)
+
+
+class WriterPalmyraProvider(VisionProvider):
+    name = 'writer'
+
+    def available(self):
+        return (bool(os.getenv('WRITER_API_KEY')) or model_stub.stub_enabled()) and writer_breaker.available()
+
+    def analyze(self, image_data, include_reasoning=True, verbose=True):
+        return analyze_with_writer_vision(image_data, include_reasoning, verbose)
+
+
+class LocalMathProvider(VisionProvider):
+    """The local handwritten-math recognizer; only answers for drawings that are a single equation"""
+    name = 'local'
+    selectable = False
+
+    def available(self):
+        return get_recognizer() is not None
+
+    def analyze(self, image_data, include_reasoning=True, verbose=True):
+        recognition = recognize_equation(image_data)
+        if recognition is None:
+            return {"error": "No local math recognizer configured (set LABRAT_MATH_OCR)"}
+        if recognition['latex'].count('=') != 1:
+            return {"error": "The local recognizer only handles drawings of a single equation"}
+        return analyze_recognized_equation(recognition['latex'], recognition['confidence'], include_reasoning, verbose)
+
+
+class LandingAIProvider(VisionProvider):
+    name = 'landingai'
+    selectable = False
+
+    def analyze(self, image_data, include_reasoning=True, verbose=True):
+        return analyze_with_landingai(image_data)
+
+
+class VisionRegistry:
+    """Named providers, their statistics, latency-based selection and hedged calls"""
+
+    def __init__(self, max_workers=8):
+        self.providers = {}
+        self.stats = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='vision')
+
+    def register(self, provider):
+        self.providers[provider.name] = provider
+        self.stats.setdefault(provider.name, ProviderStats())
+
+    def get(self, name):
+        if name not in self.providers:
+            raise ValueError(f"Unknown vision model: {name} (available: {', '.join(sorted(self.providers))})")
+        return self.providers[name]
+
+    def _score(self, name):
+        stats = self.stats[name]
+        p50 = stats.percentile(50)
+        if p50 is None:
+            # Untried providers get tried before the ranking settles
+            return 0.0
+        return p50 * (1 + 4 * stats.error_rate())
+
+    def ranked(self, exclude=()):
+        """Selectable, available providers, best first"""
+        names = [name for name, provider in self.providers.items()
+                 if provider.selectable and name not in exclude and provider.available()]
+        return sorted(names, key=self._score)
+
+    def choose(self):
+        ranked = self.ranked()
+        return ranked[0] if ranked else 'claude'
+
+    def _timed(self, name, image_data, include_reasoning, verbose):
+        started = time.perf_counter()
+        try:
+            result = self.providers[name].analyze(image_data, include_reasoning, verbose)
+        except Exception as e:
+            result = {"error": f"{name} vision analysis failed: {e}"}
+        self.stats[name].record(time.perf_counter() - started, bool(result.get('success')))
+        result.setdefault('provider', name)
+        return result
+
+    def hedge_delay(self, name):
+        """Seconds to wait for a provider before sending a backup request, or None if it cannot be hedged yet"""
+        latencies = self.stats[name].latencies()
+        if latencies.size < MIN_HEDGE_SAMPLES:
+            return None
+        return max(MIN_HEDGE_DELAY_SECONDS, float(np.percentile(latencies, 90)))
+
+    def analyze(self, image_data, name='claude', include_reasoning=True, verbose=True, hedge=None):
+        """Run the drawing through a provider ('auto' picks one), hedging or failing over to a second provider"""
+        if name == 'auto':
+            name = self.choose()
+        self.get(name)
+        hedge = HEDGE_BY_DEFAULT if hedge is None else hedge
+
+        requested = name
+        if not self.providers[name].available():
+            # Requested provider is down (or its breaker is open): degrade to the best one that is up
+            alternatives = self.ranked(exclude=(name,))
+            if alternatives:
+                name = alternatives[0]
+                logger.info(f"Vision provider {requested} unavailable, using {name}")
+
+        result = self._hedged(image_data, name, include_reasoning, verbose) if hedge else None
+        if result is None:
+            result = self._timed(name, image_data, include_reasoning, verbose)
+        if result.get('unavailable'):
+            # Outage rather than a bad drawing: one failover attempt with another provider
+            for backup_name in self.ranked(exclude=(name, requested)):
+                backup = self._timed(backup_name, image_data, include_reasoning, verbose)
+                if backup.get('success'):
+                    result = backup
+                break
+        if result.get('success') and result['provider'] != requested:
+            result['fallback_from'] = requested
+        return result
+
+    def _hedged(self, image_data, name, include_reasoning, verbose):
+        """Call name, and a backup once name is slower than its p90; None when hedging is not possible yet"""
+        delay = self.hedge_delay(name) if self.providers[name].selectable else None
+        # Prefer a backup whose latency is known over an untried one
+        backups = sorted(self.ranked(exclude=(name,)), key=lambda n: self.stats[n].percentile(50) is None) if delay is not None else []
+        if not backups:
+            return None
+
+        # Worker threads run in a copy of the request's context so their model calls keep its usage attribution
+        primary = self._executor.submit(contextvars.copy_context().run, self._timed, name, image_data, include_reasoning, verbose)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        backup_name = backups[0]
+        logger.info(f"Hedging {name} after {delay:.2f}s with {backup_name}")
+        backup = self._executor.submit(contextvars.copy_context().run, self._timed, backup_name, image_data, include_reasoning, False)
+        pending = {primary, backup}
+        failed = None
+        while pending:
+            done, pending = wait(pending, timeout=PROVIDER_TIMEOUT_SECONDS, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                result = future.result()
+                if result.get('success'):
+                    winner = name if future is primary else backup_name
+                    if future is backup:
+                        self.stats[backup_name].hedge_wins += 1
+                    result['hedge'] = {"primary": name, "backup": backup_name, "delay_ms": round(delay * 1000, 1), "winner": winner}
+                    return result
+                failed = result
+        return failed or {"error": f"No vision provider answered within {PROVIDER_TIMEOUT_SECONDS}s", "unavailable": True, "retry_after": 5}
+
+    def snapshot(self):
+        return {
+            name: {
+                **self.stats[name].snapshot(),
+                "available": provider.available(),
+                "selectable": provider.selectable,
+                "hedge_delay_ms": round(self.hedge_delay(name) * 1000, 1) if self.hedge_delay(name) else None,
+            }
+            for name, provider in self.providers.items()
+        }
+
+
+vision_registry = VisionRegistry()
+for _provider in (BedrockClaudeProvider(), WriterPalmyraProvider(), LocalMathProvider(), LandingAIProvider()):
+    vision_registry.register(_provider)
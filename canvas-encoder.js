@@ -0,0 +1,99 @@
+// LabRat canvas encoder (Web Worker)
+// Crops the drawing to its inked bounding box, downscales it to the vision model's target size
+// and encodes it as WebP/JPEG off the main thread, so the side panel stays responsive.
+
+const INK_PIXEL_THRESHOLD = 10; // Same blank-canvas rule as isCanvasBlank() in assistant.js
+
+function findInkBoundingBox(data, width, height) {
+  let minX = width, minY = height, maxX = -1, maxY = -1;
+  let inkPixels = 0;
+
+  for (let y = 0; y < height; y++) {
+    const rowOffset = y * width * 4;
+    for (let x = 0; x < width; x++) {
+      const i = rowOffset + x * 4;
+      // Anything that is not opaque pure white counts as ink
+      if (data[i] !== 255 || data[i + 1] !== 255 || data[i + 2] !== 255 || data[i + 3] !== 255) {
+        inkPixels++;
+        if (x < minX) minX = x;
+        if (x > maxX) maxX = x;
+        if (y < minY) minY = y;
+        if (y > maxY) maxY = y;
+      }
+    }
+  }
+
+  if (inkPixels < INK_PIXEL_THRESHOLD) return null;
+  return { x: minX, y: minY, width: maxX - minX + 1, height: maxY - minY + 1, inkPixels };
+}
+
+async function encode(canvas, mimeType, quality) {
+  let blob = await canvas.convertToBlob({ type: mimeType, quality });
+  // Browsers without a WebP encoder silently return PNG - fall back to JPEG instead
+  if (blob.type !== mimeType) {
+    blob = await canvas.convertToBlob({ type: 'image/jpeg', quality });
+  }
+  return blob;
+}
+
+self.onmessage = async (event) => {
+  const {
+    requestId,
+    bitmap,
+    maxDimension = 1568,
+    minDimension = 32,
+    margin = 16,
+    mimeType = 'image/webp',
+    quality = 0.9
+  } = event.data;
+
+  try {
+    const source = new OffscreenCanvas(bitmap.width, bitmap.height);
+    const sourceCtx = source.getContext('2d', { willReadFrequently: true });
+    sourceCtx.drawImage(bitmap, 0, 0);
+    bitmap.close();
+
+    const { data, width, height } = sourceCtx.getImageData(0, 0, source.width, source.height);
+    const box = findInkBoundingBox(data, width, height);
+    if (!box) {
+      self.postMessage({ requestId, blank: true });
+      return;
+    }
+
+    // Pad the crop so strokes touching the edge keep some context
+    const cropX = Math.max(0, box.x - margin);
+    const cropY = Math.max(0, box.y - margin);
+    const cropWidth = Math.min(width, box.x + box.width + margin) - cropX;
+    const cropHeight = Math.min(height, box.y + box.height + margin) - cropY;
+
+    const scale = Math.min(1, maxDimension / Math.max(cropWidth, cropHeight));
+    const outWidth = Math.max(minDimension, Math.round(cropWidth * scale));
+    const outHeight = Math.max(minDimension, Math.round(cropHeight * scale));
+
+    const output = new OffscreenCanvas(outWidth, outHeight);
+    const outputCtx = output.getContext('2d');
+    outputCtx.fillStyle = '#ffffff';
+    outputCtx.fillRect(0, 0, outWidth, outHeight);
+    outputCtx.imageSmoothingEnabled = true;
+    outputCtx.imageSmoothingQuality = 'high';
+    outputCtx.drawImage(source, cropX, cropY, cropWidth, cropHeight, 0, 0, Math.round(cropWidth * scale), Math.round(cropHeight * scale));
+
+    const blob = await encode(output, mimeType, quality);
+    const image = new FileReaderSync().readAsDataURL(blob);
+
+    self.postMessage({
+      requestId,
+      blank: false,
+      image,
+      width: outWidth,
+      height: outHeight,
+      format: blob.type.replace('image/', ''),
+      bytes: blob.size,
+      crop: { x: cropX, y: cropY, width: cropWidth, height: cropHeight },
+      scale,
+      sourceSize: { width, height }
+    });
+  } catch (error) {
+    self.postMessage({ requestId, error: error.message });
+  }
+};
@@ -0,0 +1,185 @@
+// LabRat Snowflake editor bridge
+// Runs in the page's own JavaScript world (manifest "world": "MAIN") so it can reach the CodeMirror
+// EditorView behind each notebook cell, which the isolated injector cannot. The injector sends requests
+// with window.postMessage; edits go through view.dispatch() so CodeMirror keeps its undo history, syntax
+// tree and Snowflake's save hooks, instead of rewriting the editor's DOM.
+//
+// Injected cells are marked by a comment line, so a later patch can find them in any editor:
+//   # %% labrat:<cell id> <description>
+//   <cell source>
+(() => {
+  const MARKER_PATTERN = /^# %% labrat:(\S+).*$/gm;
+  let lastFocusedView = null;
+
+  function editorViewOf(element) {
+    // CodeMirror 6 keeps its view on the content DOM node (cmView, or cmTile in newer releases)
+    const content = element.classList.contains('cm-content') ? element : element.querySelector('.cm-content');
+    const tile = content && (content.cmView || content.cmTile);
+    if (!tile) return null;
+    return tile.view || (tile.rootView && tile.rootView.view) || null;
+  }
+
+  function allViews() {
+    return Array.from(document.querySelectorAll('.cm-editor'))
+      .map(editor => editorViewOf(editor))
+      .filter(Boolean);
+  }
+
+  function activeView() {
+    const focused = document.querySelector('.cm-editor.cm-focused');
+    const view = (focused && editorViewOf(focused)) || lastFocusedView;
+    if (view && view.dom.isConnected) return view;
+    // Fall back to the first empty cell ("Start writing in Python...")
+    return allViews().find(candidate => candidate.state.doc.length === 0) || null;
+  }
+
+  document.addEventListener('focusin', (event) => {
+    const editor = event.target.closest && event.target.closest('.cm-editor');
+    const view = editor && editorViewOf(editor);
+    if (view) lastFocusedView = view;
+  }, true);
+
+  // Same layout as LabRatAssistant.cellRegion
+  function regionText(cell) {
+    return `# %% labrat:${cell.id} ${cell.description || ''}\n${(cell.code || '').replace(/\n+$/, '')}\n\n`;
+  }
+
+  // Every marked region in every editor: where it starts, where its source ends and where the next one starts
+  function findRegions() {
+    const regions = new Map();
+    for (const view of allViews()) {
+      const text = view.state.doc.toString();
+      const markers = Array.from(text.matchAll(MARKER_PATTERN));
+      markers.forEach((match, index) => {
+        const start = match.index;
+        const end = index + 1 < markers.length ? markers[index + 1].index : text.length;
+        const bodyFrom = Math.min(start + match[0].length + 1, end);
+        const body = text.slice(bodyFrom, end).replace(/\n+$/, '');
+        regions.set(match[1], { view, start, end, bodyFrom, body, order: regions.size });
+      });
+    }
+    return regions;
+  }
+
+  async function sourceHash(text) {
+    // Same as notebook_model.cell_hash: first 16 hex digits of SHA-256 of the source
+    const digest = await crypto.subtle.digest('SHA-256', new TextEncoder().encode(text));
+    return Array.from(new Uint8Array(digest)).map(byte => byte.toString(16).padStart(2, '0')).join('').slice(0, 16);
+  }
+
+  function insertCode(code) {
+    const view = activeView();
+    if (!view) return { success: false, error: 'No notebook cell is selected' };
+    view.dispatch(view.state.replaceSelection(code));
+    view.focus();
+    return { success: true, message: 'Code injected' };
+  }
+
+  // Apply a notebook patch from /api/notebooks/<id>/patch: one transaction per editor, only the changed ranges
+  async function applyPatch(patch) {
+    const regions = findRegions();
+    if (regions.size === 0) return { success: false, error: 'no_regions' };
+
+    const changes = new Map();  // view -> CodeMirror change specs, in the view's current coordinates
+    const addChange = (view, change) => {
+      if (!changes.has(view)) changes.set(view, []);
+      changes.get(view).push(change);
+    };
+    const insertions = new Map();  // cell id -> {view, from, parts}: text inserted at one position
+    const conflicts = [];
+    const missing = [];
+    let applied = 0;
+
+    const first = Array.from(regions.values()).sort((a, b) => a.order - b.order)[0];
+    const insertionFor = (after) => {
+      if (after && insertions.has(after)) return insertions.get(after);
+      const anchor = after && regions.get(after);
+      // Cells without a region (markdown, or deleted by the student) anchor to the first injected cell
+      const insertion = anchor
+        ? { view: anchor.view, from: anchor.end, parts: [] }
+        : { view: first.view, from: first.start, parts: [] };
+      if (anchor && anchor.end === anchor.view.state.doc.length && !anchor.view.state.doc.toString().endsWith('\n')) {
+        insertion.parts.push('\n');
+      }
+      return insertion;
+    };
+    const place = (id, after, text) => {
+      const insertion = insertionFor(after);
+      insertion.parts.push(text);
+      insertions.set(id, insertion);
+    };
+
+    for (const op of patch.ops) {
+      const cellType = op.cell ? op.cell.cell_type : op.cell_type;
+      if (cellType && cellType !== 'code') continue;
+      const region = regions.get(op.id);
+
+      if (op.op === 'add') {
+        place(op.id, op.after, regionText(op.cell));
+        applied++;
+      } else if (!region) {
+        // Markdown cells are never injected; a code cell without a region was removed by the student
+        if (op.op === 'update' && op.edits.length) missing.push(op.id);
+      } else if (op.op === 'remove') {
+        addChange(region.view, { from: region.start, to: region.end });
+        applied++;
+      } else if (op.op === 'move') {
+        addChange(region.view, { from: region.start, to: region.end });
+        place(op.id, op.after, region.view.state.doc.sliceString(region.start, region.end).replace(/\n*$/, '\n\n'));
+        const insertion = insertions.get(op.id);
+        region.movedTo = { parts: insertion.parts, index: insertion.parts.length - 1 };
+        applied++;
+      } else if (op.op === 'update') {
+        if (await sourceHash(region.body) !== op.base) {
+          // The student edited this cell since it was injected - leave their version alone
+          conflicts.push(op.id);
+          continue;
+        }
+        if (region.movedTo) {
+          // Moved in this same patch: edit the text that is being re-inserted
+          const { parts, index } = region.movedTo;
+          const header = parts[index].slice(0, parts[index].indexOf('\n') + 1);
+          let body = region.body;
+          for (const [from, to, insert] of [...op.edits].sort((a, b) => b[0] - a[0])) {
+            body = body.slice(0, from) + insert + body.slice(to);
+          }
+          parts[index] = `${header}${body}\n\n`;
+        } else {
+          for (const [from, to, insert] of op.edits) {
+            addChange(region.view, { from: region.bodyFrom + from, to: region.bodyFrom + to, insert });
+          }
+        }
+        applied++;
+      }
+    }
+
+    for (const insertion of new Set(insertions.values())) {
+      addChange(insertion.view, { from: insertion.from, insert: insertion.parts.join('') });
+    }
+    // ChangeSet.of maps unsorted and adjacent changes, so every editor is updated in one transaction
+    for (const [view, specs] of changes) {
+      view.dispatch({ changes: specs, userEvent: 'input.labrat' });
+    }
+    return { success: true, applied, unchanged: patch.unchanged || 0, conflicts, missing };
+  }
+
+  window.addEventListener('message', async (event) => {
+    if (event.source !== window || !event.data || event.data.source !== 'labrat-injector') return;
+    const { requestId, action, payload } = event.data;
+    let result;
+    try {
+      if (action === 'ping') {
+        result = { success: true, editors: allViews().length, hasActiveCell: Boolean(activeView()) };
+      } else if (action === 'insertCode') {
+        result = insertCode(payload.code);
+      } else if (action === 'applyPatch') {
+        result = await applyPatch(payload.patch);
+      } else {
+        result = { success: false, error: `Unknown action: ${action}` };
+      }
+    } catch (error) {
+      result = { success: false, error: error.message };
+    }
+    window.postMessage({ source: 'labrat-bridge', requestId, result }, '*');
+  });
+})();
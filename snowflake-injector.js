@@ -91,10 +91,64 @@ function runInjectionTest() {
     }, 2000);
 }
 
+// Requests to the editor bridge (snowflake-editor-bridge.js), which runs in the page's world and edits
+// cells through CodeMirror transactions. Resolves null when the bridge does not answer.
+const BRIDGE_TIMEOUT_MS = 1500;
+let bridgeRequestCount = 0;
+
+function callEditorBridge(action, payload = {}) {
+    return new Promise((resolve) => {
+        const requestId = `labrat-${Date.now()}-${++bridgeRequestCount}`;
+        const onMessage = (event) => {
+            if (event.source !== window || !event.data || event.data.source !== 'labrat-bridge'
+                || event.data.requestId !== requestId) return;
+            window.removeEventListener('message', onMessage);
+            clearTimeout(timer);
+            resolve(event.data.result);
+        };
+        const timer = setTimeout(() => {
+            window.removeEventListener('message', onMessage);
+            resolve(null);
+        }, BRIDGE_TIMEOUT_MS);
+        window.addEventListener('message', onMessage);
+        window.postMessage({ source: 'labrat-injector', requestId, action, payload }, '*');
+    });
+}
+
+async function handlePanelMessage(request) {
+    if (request.type === 'GET_ACTIVE_CELL') {
+        const status = await callEditorBridge('ping');
+        return status || { success: true, hasActiveCell: Boolean(document.querySelector('.cm-editor')) };
+    }
+    if (request.type === 'INJECT_CODE') {
+        // The DOM rewrite is only a fallback for pages where the bridge could not reach CodeMirror
+        const result = await callEditorBridge('insertCode', { code: request.code });
+        return result && result.success ? result : injectCodeToSnowflake(request.code);
+    }
+    if (request.type === 'APPLY_NOTEBOOK_PATCH') {
+        return (await callEditorBridge('applyPatch', { patch: request.patch }))
+            || { success: false, error: 'bridge_unavailable' };
+    }
+    return { success: false, error: `Unknown message: ${request.type}` };
+}
+
 // Listen for messages from the LabRat extension
 chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
     console.log('LabRat injector received message:', request);
     
+    if (request.type) {
+        handlePanelMessage(request).then((result) => {
+            sendResponse(result);
+            if (request.type === 'APPLY_NOTEBOOK_PATCH' && result.success) {
+                showNotification(`Updated ${result.applied} cell(s) from LabRat`, 'success');
+            } else if (request.type === 'INJECT_CODE') {
+                showNotification(result.success ? 'Code injected from LabRat' : 'Injection failed: ' + (result.error || result.message),
+                    result.success ? 'success' : 'error');
+            }
+        });
+        return true;
+    }
+    
     if (request.action === 'insertCode' && request.code) {
         const result = injectCodeToSnowflake(request.code);
         sendResponse(result);